@@ -2,9 +2,11 @@
 Defines an abstract class for dataset builder
 """
 
-from typing import Dict, Union
+import os
+from typing import Dict, Optional, Tuple, Union
 from abc import ABC, abstractmethod
 from pystac import Item
+import numpy as np
 
 
 # models imported
@@ -43,6 +45,18 @@ class DatasetBuilder(ABC):
         """
         self.file_source_config = file_source_configuration
 
+    def close(self) -> None:
+        """
+        Releases the file handles held by the file helper
+        """
+        self.file_helper.close()
+
+    def __enter__(self) -> "DatasetBuilder":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     @property
     @abstractmethod
     def file_helper(self) -> FileHelper:
@@ -94,6 +108,27 @@ class DatasetBuilder(ABC):
         """
         pass
 
+    def _allocate_output(
+        self,
+        name: str,
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        output_directory: Optional[str],
+    ) -> np.ndarray:
+        """
+        Preallocates an output buffer in memory, or as a memory mapped .npy file
+        when an output directory is given.
+        """
+        if output_directory is None:
+            return np.empty(shape, dtype=dtype)
+        os.makedirs(output_directory, exist_ok=True)
+        return np.lib.format.open_memmap(
+            os.path.join(output_directory, f"{name}.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=shape,
+        )
+
     @abstractmethod
     def vend_dataset(self) -> Union[VendableHyperspectralDataset]:
         """
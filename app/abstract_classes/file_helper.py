@@ -5,7 +5,18 @@ dealing with very hierarchical and complicated datasets
 """
 
 from abc import ABC, abstractmethod
-from typing import Any, Generic, TypeVar, List, Optional, Literal, Dict, Union
+from typing import (
+    Any,
+    Generic,
+    TypeVar,
+    List,
+    Optional,
+    Literal,
+    Dict,
+    Union,
+    Tuple,
+    Iterator,
+)
 import numpy as np
 
 from pydantic import BaseModel
@@ -15,6 +26,7 @@ from pydantic import BaseModel
 from app.models.file_processing.sources import FileSourceConfig
 from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
 from app.models.hyperspectral_concepts.references import ReferenceDefinition
+from app.models.images.image_window import ImageWindow
 from app.models.hyperspectral_concepts.file_components import (
     HyperspectralFileComponents,
     ThermalComponents,
@@ -40,6 +52,19 @@ class FileHelper(ABC, Generic[T]):
         self.file_source_config = file_source_config
         self._template = template
 
+    def close(self) -> None:
+        """
+        Releases any file handles held by the helper.
+        Subclasses holding open handles over-ride this.
+        """
+        pass
+
+    def __enter__(self) -> "FileHelper":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
     def access_dataset(self, path: str) -> Any:
         """
         Most times the datasets are loaded in a lazy manner. This allows pulling actual
@@ -82,6 +107,72 @@ class FileHelper(ABC, Generic[T]):
         """
         pass
 
+    @abstractmethod
+    def spatial_shape(
+        self, spectral_family: Optional[SpectralFamily] = None
+    ) -> Tuple[int, int]:
+        """
+        The (height, width) of the scene in pixels, read from metadata without pulling any data.
+
+        Args:
+            spectral_family (Optional[SpectralFamily]): The spectral family whose cube is measured, if applicable.
+        """
+        pass
+
+    @abstractmethod
+    def extract_window(
+        self,
+        window: ImageWindow,
+        bands: Optional[List[int] | int] = None,
+        masking_needed: Optional[bool] = False,
+        spectral_family: Optional[SpectralFamily] = None,
+    ) -> np.ndarray | np.ma.MaskedArray:
+        """
+        Extracts a spatial window from the dataset, reading only that region from disk.
+        The output stays in the native cube representation of the file.
+
+        Args:
+            window (ImageWindow): The spatial window to be read.
+            bands (Optional[List[int] | int]): The bands to be read. None reads every band.
+            masking_needed (Optional[bool]): Whether masking needs to be applied on the window that is extracted
+            spectral_family (Optional[SpectralFamily]): The spectral family of the bands to be extracted.
+        """
+        pass
+
+    def iter_windows(
+        self,
+        tile_height: int,
+        tile_width: int,
+        spectral_family: Optional[SpectralFamily] = None,
+    ) -> Iterator[ImageWindow]:
+        """
+        Tiles the scene into windows of at most tile_height x tile_width, row by row.
+        Windows on the bottom and right edges are clipped to the scene.
+        """
+        if tile_height <= 0 or tile_width <= 0:
+            raise ValueError("Tile dimensions must be greater than 0")
+        scene_height, scene_width = self.spatial_shape(spectral_family=spectral_family)
+        for row_offset in range(0, scene_height, tile_height):
+            for col_offset in range(0, scene_width, tile_width):
+                yield ImageWindow(
+                    row_offset=row_offset,
+                    col_offset=col_offset,
+                    height=min(tile_height, scene_height - row_offset),
+                    width=min(tile_width, scene_width - col_offset),
+                )
+
+    def _validate_window(
+        self, window: ImageWindow, spectral_family: Optional[SpectralFamily] = None
+    ) -> None:
+        """
+        Raises a ValueError when the window does not lie within the scene
+        """
+        scene_height, scene_width = self.spatial_shape(spectral_family=spectral_family)
+        if not window.fits_within(scene_height, scene_width):
+            raise ValueError(
+                f"Window {window} does not fit in a scene of shape {(scene_height, scene_width)}"
+            )
+
     @property
     @abstractmethod
     def template(self) -> Dict[HyperspectralFileComponents, ReferenceDefinition]:
@@ -0,0 +1,118 @@
+"""
+Defines a bit packed representation of validity cubes
+"""
+
+from typing import List, Optional, Sequence, Tuple, Union
+from pydantic import BaseModel, Field, ConfigDict, SkipValidation
+import numpy as np
+
+# Bit order used when packing, the first column of a byte is its most significant bit
+PACKING_BIT_ORDER = "big"
+
+
+class PackedValidity(BaseModel):
+    """
+    A validity cube stored with one bit per voxel instead of one byte.
+    The cube is packed along its last (column) axis so that any band, row range or window
+    can be unpacked on its own without touching the rest of the cube.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    packed: SkipValidation[np.ndarray] = Field(
+        ...,
+        description="The packed bits, a uint8 array of shape (C, H, ceil(W / 8))",
+    )
+
+    shape: Tuple[int, int, int] = Field(
+        ..., description="The (C, H, W) shape of the unpacked validity cube"
+    )
+
+    @staticmethod
+    def packed_shape(shape: Sequence[int]) -> Tuple[int, int, int]:
+        """
+        The shape of the packed array for a validity cube of the given shape
+        """
+        channels, height, width = shape
+        return channels, height, (width + 7) // 8
+
+    @classmethod
+    def from_cube(cls, cube: np.ndarray) -> "PackedValidity":
+        """
+        Packs a (C, H, W) validity cube where any non zero value is valid.
+        A 2D (H, W) mask is treated as a single band.
+        """
+        if cube.ndim == 2:
+            cube = cube[None, :, :]
+        if cube.ndim != 3:
+            raise ValueError(f"Expected a 2D or 3D validity cube, got {cube.ndim}D")
+        return cls(
+            packed=np.packbits(cube != 0, axis=-1, bitorder=PACKING_BIT_ORDER),
+            shape=cube.shape,
+        )
+
+    @staticmethod
+    def pack_block(block: np.ndarray) -> np.ndarray:
+        """
+        Packs a block of full width rows so that it can be written into a larger packed array
+        """
+        return np.packbits(block != 0, axis=-1, bitorder=PACKING_BIT_ORDER)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The number of bytes held by the packed bits
+        """
+        return self.packed.nbytes
+
+    def _unpack(
+        self,
+        bands: Union[int, slice, List[int]],
+        rows: slice,
+        cols: slice,
+    ) -> np.ndarray:
+        """
+        Unpacks only the bytes covering the requested columns and trims to the exact columns
+        """
+        col_start, col_stop, _ = cols.indices(self.shape[2])
+        col_stop = max(col_start, col_stop)
+        byte_start = col_start // 8
+        byte_stop = (col_stop + 7) // 8
+        unpacked = np.unpackbits(
+            self.packed[bands, rows, byte_start:byte_stop],
+            axis=-1,
+            bitorder=PACKING_BIT_ORDER,
+        )
+        offset = col_start - byte_start * 8
+        # (1 = valid), uint8 is viewed as int8 which is the dtype of vended validity cubes
+        return unpacked[..., offset : offset + (col_stop - col_start)].view(np.int8)
+
+    def unpack(self) -> np.ndarray:
+        """
+        Unpacks the full (C, H, W) validity cube
+        """
+        return self._unpack(slice(None), slice(None), slice(None))
+
+    def band(self, index: int) -> np.ndarray:
+        """
+        Unpacks the (H, W) validity mask of a single band
+        """
+        return self._unpack(index, slice(None), slice(None))
+
+    def window(
+        self,
+        rows: slice,
+        cols: slice,
+        bands: Optional[Union[slice, List[int]]] = None,
+    ) -> np.ndarray:
+        """
+        Unpacks the validity of a spatial window for some or all bands
+
+        Args:
+            rows (slice): The rows of the window
+            cols (slice): The columns of the window
+            bands (Optional[Union[slice, List[int]]]): The bands to unpack, all if None
+        """
+        if cols.step not in (None, 1):
+            raise ValueError("Column steps are not supported on packed validity")
+        return self._unpack(slice(None) if bands is None else bands, rows, cols)
@@ -0,0 +1,36 @@
+"""
+Defines the outcome of vending one scene of a batch
+"""
+
+from typing import Dict, Optional
+from pydantic import BaseModel, Field
+
+from app.models.dataset.vendables import VendableThermalDataset
+
+
+class SceneVendResult(BaseModel):
+    """
+    The outcome of vending a single scene of a batch.
+    A failed scene carries its error instead of a dataset, the rest of the batch is unaffected.
+    """
+
+    index: int = Field(..., ge=0, description="The position of the scene in the batch")
+    source_path: str = Field(..., description="The path of the scene")
+    succeeded: bool = Field(..., description="Whether the scene was vended")
+    dataset: Optional[VendableThermalDataset] = Field(
+        default=None, description="The vended dataset when the scene succeeded"
+    )
+    output_directory: Optional[str] = Field(
+        default=None,
+        description="The directory the dataset was saved to, when the batch writes to disk",
+    )
+    error: Optional[str] = Field(
+        default=None, description="The error and traceback when the scene failed"
+    )
+    timings: Dict[str, float] = Field(
+        default_factory=dict,
+        description="Seconds spent in each stage of vending the scene",
+    )
+    worker_pid: Optional[int] = Field(
+        default=None, description="The process the scene was vended in"
+    )
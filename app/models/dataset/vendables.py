@@ -2,26 +2,218 @@
 Defines vendable datasets for each dataset builder
 """
 
-from typing import List, Optional
-from pydantic import BaseModel, Field, ConfigDict, SkipValidation
+import os
+import json
+from typing import Any, Dict, List, Optional, Union
+from pydantic import BaseModel, Field, ConfigDict, SkipValidation, model_validator
 import numpy as np
 
 from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
+from app.models.dataset.packed_validity import PackedValidity
 
+# Persisted vendables are a directory with one .npy file per array and a manifest
+MANIFEST_FILE_NAME = "manifest.json"
+VENDABLE_FORMAT_VERSION = 1
 
-class VendableHyperspectralDataset(BaseModel):
+
+def _save_arrays(directory: str, arrays: Dict[str, np.ndarray]) -> Dict[str, Any]:
     """
-    Models a vendable Hyperspectral Dataset that can be used by downstream applications
+    Saves each array as <name>.npy in the directory and returns their manifest entries.
+    Arrays that are already memory mapped onto the target file are only flushed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    entries = {}
+    for name, array in arrays.items():
+        file_name = f"{name}.npy"
+        path = os.path.join(directory, file_name)
+        if (
+            isinstance(array, np.memmap)
+            and array.filename is not None
+            and (os.path.abspath(array.filename) == os.path.abspath(path))
+        ):
+            array.flush()
+        else:
+            np.save(path, array)
+        entries[name] = {
+            "file": file_name,
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+        }
+    return entries
+
+
+def _write_manifest(directory: str, manifest: Dict[str, Any]) -> str:
+    """
+    Writes the manifest atomically and returns its path
+    """
+    manifest_path = os.path.join(directory, MANIFEST_FILE_NAME)
+    temporary_path = f"{manifest_path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(temporary_path, manifest_path)
+    return manifest_path
+
+
+def _read_manifest(directory: str, dataset_type: str) -> Dict[str, Any]:
+    """
+    Reads a manifest and checks that it describes the expected kind of dataset
+    """
+    with open(
+        os.path.join(directory, MANIFEST_FILE_NAME), "r", encoding="utf-8"
+    ) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get("dataset_type") != dataset_type:
+        raise ValueError(
+            f"{directory} holds a {manifest.get('dataset_type')} dataset, not {dataset_type}"
+        )
+    if manifest.get("format_version") != VENDABLE_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported vendable format version {manifest.get('format_version')}"
+        )
+    return manifest
+
+
+def _load_arrays(
+    directory: str, manifest: Dict[str, Any], mmap_mode: Optional[str]
+) -> Dict[str, np.ndarray]:
+    """
+    Loads every array listed in a manifest. With a mmap_mode the arrays are
+    np.memmap views onto the files and nothing is read until it is accessed.
+    """
+    return {
+        name: np.load(os.path.join(directory, entry["file"]), mmap_mode=mmap_mode)
+        for name, entry in manifest["arrays"].items()
+    }
+
+
+class VendableDataset(BaseModel):
+    """
+    Common validity handling of vendable datasets.
+    Validity is held either as a full cube with one byte per voxel or bit packed.
+    The accessors work on both so consumers do not need to know which one is present.
     """
 
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
+    validity_cube: Optional[SkipValidation[np.ndarray]] = Field(
+        default=None, description="The full validity cube (1 = valid)"
+    )
+
+    packed_validity: Optional[PackedValidity] = Field(
+        default=None,
+        description="The validity cube packed to one bit per voxel, used instead of validity_cube",
+    )
+
+    @model_validator(mode="after")
+    def check_validity_present(self) -> "VendableDataset":
+        """
+        Exactly one representation of the validity must be present
+        """
+        if (self.validity_cube is None) == (self.packed_validity is None):
+            raise ValueError(
+                "Exactly one of validity_cube and packed_validity must be provided"
+            )
+        return self
+
+    @property
+    def is_validity_packed(self) -> bool:
+        """
+        Whether the validity is held bit packed
+        """
+        return self.packed_validity is not None
+
+    def full_validity(self) -> np.ndarray:
+        """
+        The full validity cube, unpacked if needed
+        """
+        if self.is_validity_packed:
+            return self.packed_validity.unpack()
+        return self.validity_cube
+
+    def validity_band(self, index: int) -> np.ndarray:
+        """
+        The (H, W) validity mask of a single band
+        """
+        if self.is_validity_packed:
+            return self.packed_validity.band(index)
+        return self.validity_cube[index]
+
+    def validity_window(
+        self,
+        rows: slice,
+        cols: slice,
+        bands: Optional[Union[slice, List[int]]] = None,
+    ) -> np.ndarray:
+        """
+        The validity of a spatial window for some or all bands, as a (C, h, w) array
+
+        Args:
+            rows (slice): The rows of the window
+            cols (slice): The columns of the window
+            bands (Optional[Union[slice, List[int]]]): The bands to return, all if None
+        """
+        if self.is_validity_packed:
+            return self.packed_validity.window(rows=rows, cols=cols, bands=bands)
+        return self.validity_cube[slice(None) if bands is None else bands, rows, cols]
+
+    def pack_validity(self):
+        """
+        Returns a copy of the dataset with the validity bit packed
+        """
+        if self.is_validity_packed:
+            return self
+        return self.model_copy(
+            update={
+                "validity_cube": None,
+                "packed_validity": PackedValidity.from_cube(self.validity_cube),
+            }
+        )
+
+    def validity_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        The validity arrays to persist or hand over to another process, keyed by name
+        """
+        if self.is_validity_packed:
+            return {"packed_validity_cube": self.packed_validity.packed}
+        return {"validity_cube": self.validity_cube}
+
+    def validity_manifest(self) -> Dict[str, Any]:
+        """
+        Additional manifest entries needed to restore the validity from its arrays
+        """
+        if self.is_validity_packed:
+            return {"validity_shape": list(self.packed_validity.shape)}
+        return {}
+
+    @staticmethod
+    def validity_fields(
+        arrays: Dict[str, np.ndarray], manifest: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Restores the validity fields from the arrays of validity_arrays and the entries
+        of validity_manifest
+        """
+        if "packed_validity_cube" in arrays:
+            return {
+                "packed_validity": PackedValidity(
+                    packed=arrays["packed_validity_cube"],
+                    shape=manifest["validity_shape"],
+                )
+            }
+        return {"validity_cube": arrays["validity_cube"]}
+
+
+class VendableHyperspectralDataset(VendableDataset):
+    """
+    Models a vendable Hyperspectral Dataset that can be used by downstream applications
+    """
+
     normalized_hyperspectral_cube: SkipValidation[np.ndarray] = Field(
         ..., description="A fully normalized hyperspectral cube"
     )
 
-    validity_cube: SkipValidation[np.ndarray] = Field(
-        ...,
+    validity_cube: Optional[SkipValidation[np.ndarray]] = Field(
+        default=None,
         description="The full validity cube. If a band is is in valid then every pixel in that band must be invalid.",
     )
 
@@ -39,20 +231,103 @@ class VendableHyperspectralDataset(BaseModel):
         default=[], description="An ordered list of FWHM of the wavelengths"
     )
 
+    def save(self, directory: str) -> str:
+        """
+        Persists the dataset as one .npy file per array plus a JSON manifest holding the
+        band ordering. Returns the path of the manifest.
+        """
+        arrays = _save_arrays(
+            directory,
+            {
+                "normalized_hyperspectral_cube": self.normalized_hyperspectral_cube,
+                **self.validity_arrays(),
+            },
+        )
+        return _write_manifest(
+            directory,
+            {
+                "format_version": VENDABLE_FORMAT_VERSION,
+                "dataset_type": "hyperspectral",
+                "arrays": arrays,
+                **self.validity_manifest(),
+                "spectral_family_order": [
+                    family.value for family in self.spectral_family_order
+                ],
+                "band_cw_order": [float(cw) for cw in self.band_cw_order],
+                "band_fwhm_order": [float(fwhm) for fwhm in self.band_fwhm_order or []],
+            },
+        )
+
+    @classmethod
+    def load(
+        cls, directory: str, mmap_mode: Optional[str] = "r"
+    ) -> "VendableHyperspectralDataset":
+        """
+        Loads a persisted dataset. By default the arrays are read only memory maps so the
+        load is zero-copy and pages are shared between processes opening the same scene.
+        Pass mmap_mode=None to read the arrays fully into memory.
+        """
+        manifest = _read_manifest(directory, "hyperspectral")
+        arrays = _load_arrays(directory, manifest, mmap_mode)
+        return cls(
+            normalized_hyperspectral_cube=arrays["normalized_hyperspectral_cube"],
+            **cls.validity_fields(arrays, manifest),
+            spectral_family_order=[
+                SpectralFamily(family) for family in manifest["spectral_family_order"]
+            ],
+            band_cw_order=manifest["band_cw_order"],
+            band_fwhm_order=manifest["band_fwhm_order"],
+        )
+
 
-class VendableThermalDataset(BaseModel):
+class VendableThermalDataset(VendableDataset):
     """
     Defines a vendable dataset for Landsat
     """
 
-    model_config = ConfigDict(arbitrary_types_allowed=True)
-
     normalized_thermal_cube: SkipValidation[np.ndarray] = Field(
         ...,
         description="A fully normalized thermal cube with surface temperatures in celsius",
     )
 
-    validity_cube: SkipValidation[np.ndarray] = Field(
-        ...,
+    validity_cube: Optional[SkipValidation[np.ndarray]] = Field(
+        default=None,
         description="The full validity cube. Here validity refers to the presence or absence of clouds.",
     )
+
+    def save(self, directory: str) -> str:
+        """
+        Persists the dataset as one .npy file per array plus a JSON manifest.
+        Returns the path of the manifest.
+        """
+        arrays = _save_arrays(
+            directory,
+            {
+                "normalized_thermal_cube": self.normalized_thermal_cube,
+                **self.validity_arrays(),
+            },
+        )
+        return _write_manifest(
+            directory,
+            {
+                "format_version": VENDABLE_FORMAT_VERSION,
+                "dataset_type": "thermal",
+                "arrays": arrays,
+                **self.validity_manifest(),
+            },
+        )
+
+    @classmethod
+    def load(
+        cls, directory: str, mmap_mode: Optional[str] = "r"
+    ) -> "VendableThermalDataset":
+        """
+        Loads a persisted dataset, memory mapped by default.
+        Pass mmap_mode=None to read the arrays fully into memory.
+        """
+        manifest = _read_manifest(directory, "thermal")
+        arrays = _load_arrays(directory, manifest, mmap_mode)
+        return cls(
+            normalized_thermal_cube=arrays["normalized_thermal_cube"],
+            **cls.validity_fields(arrays, manifest),
+        )
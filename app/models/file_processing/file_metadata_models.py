@@ -2,11 +2,14 @@
 Metadata components for different file types
 """
 
-from typing import Any, Optional, Tuple
+from typing import Any, Callable, Iterator, Mapping, Optional, Tuple
 from typing import Dict, List
 
 from pydantic import BaseModel, Field
 
+from app.models.hyperspectral_concepts.band import HyperpectralBandInformation
+from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
+
 
 class He5ComponentMetadata(BaseModel):
     """
@@ -29,6 +32,56 @@ class He5ComponentMetadata(BaseModel):
     )
 
 
+class LazyComponentMetadata(Mapping[str, He5ComponentMetadata]):
+    """
+    A read only mapping between component paths and their metadata.
+
+    Only the paths are known up front. The metadata for a path is built by the loader
+    the first time it is accessed and cached for the lifetime of the mapping, so that
+    files with many components do not pay for metadata that is never looked at.
+    """
+
+    def __init__(
+        self,
+        paths: List[str],
+        loader: Callable[[str], He5ComponentMetadata],
+    ):
+        self._paths: List[str] = paths
+        self._path_lookup = set(paths)
+        self._loader = loader
+        self._cache: Dict[str, He5ComponentMetadata] = {}
+
+    def __getitem__(self, path: str) -> He5ComponentMetadata:
+        if path not in self._cache:
+            if path not in self._path_lookup:
+                raise KeyError(path)
+            self._cache[path] = self._loader(path)
+        return self._cache[path]
+
+    def __contains__(self, path: object) -> bool:
+        return path in self._path_lookup
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._paths)
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    @property
+    def loaded_paths(self) -> List[str]:
+        """
+        The paths whose metadata has already been built
+        """
+        return list(self._cache.keys())
+
+    def load_all(self) -> None:
+        """
+        Eagerly builds the metadata for every path
+        """
+        for path in self._paths:
+            self[path]
+
+
 class He5Metadata(BaseModel):
     """
     Defines the full metadata for the He5 files.
@@ -37,8 +90,9 @@ class He5Metadata(BaseModel):
     components: List[str] = Field(
         default=[], description="The components of the He5 files"
     )
-    component_metadata: Dict[str, He5ComponentMetadata] = Field(
-        default={}, description="The component metadata for the He5 files"
+    component_metadata: Mapping[str, He5ComponentMetadata] = Field(
+        default={},
+        description="The component metadata for the He5 files. May be lazily populated.",
     )
     root_metadata: He5ComponentMetadata = Field(
         default=He5ComponentMetadata(),
@@ -63,3 +117,31 @@ class TIFMetadata(BaseModel):
     metadata: Dict[str, TIFProperty] = Field(
         description="The full metadata of the TIFF file"
     )
+
+
+class SceneMetadataRecord(BaseModel):
+    """
+    A persisted snapshot of everything derived from the metadata of a single scene.
+    Stored as a JSON sidecar and keyed by the fingerprint of the source file.
+    All values are JSON safe, special types are tagged when they are encoded.
+    """
+
+    fingerprint: str = Field(
+        ..., description="Fingerprint of the source file (path, size and mtime)"
+    )
+    source_path: str = Field(..., description="The path of the source file")
+    root_file_attributes: Optional[Dict[str, Any]] = Field(
+        default=None, description="Encoded root attributes of a He5 file"
+    )
+    components: Optional[List[str]] = Field(
+        default=None, description="The component paths of a He5 file"
+    )
+    tif_properties: Optional[Dict[str, Any]] = Field(
+        default=None, description="Encoded metadata properties of a TIF file"
+    )
+    band_information: Optional[
+        Dict[SpectralFamily, HyperpectralBandInformation]
+    ] = Field(default=None, description="The band information of the scene")
+    stac_item: Optional[Dict[str, Any]] = Field(
+        default=None, description="The STAC item of the scene as a dictionary"
+    )
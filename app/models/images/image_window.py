@@ -0,0 +1,40 @@
+"""
+Defines a rectangular spatial window on an image
+"""
+
+from pydantic import BaseModel, Field
+
+
+class ImageWindow(BaseModel):
+    """
+    A spatial window on a scene defined by its top left corner and its size in pixels.
+    Windows are independent of the cube representation, they only refer to rows and columns.
+    """
+
+    row_offset: int = Field(..., ge=0, description="The row of the top left corner")
+    col_offset: int = Field(..., ge=0, description="The column of the top left corner")
+    height: int = Field(..., gt=0, description="The number of rows in the window")
+    width: int = Field(..., gt=0, description="The number of columns in the window")
+
+    @property
+    def row_slice(self) -> slice:
+        """
+        The rows covered by the window as a slice
+        """
+        return slice(self.row_offset, self.row_offset + self.height)
+
+    @property
+    def col_slice(self) -> slice:
+        """
+        The columns covered by the window as a slice
+        """
+        return slice(self.col_offset, self.col_offset + self.width)
+
+    def fits_within(self, scene_height: int, scene_width: int) -> bool:
+        """
+        Whether the window lies completely inside a scene of the given size
+        """
+        return (
+            self.row_offset + self.height <= scene_height
+            and self.col_offset + self.width <= scene_width
+        )
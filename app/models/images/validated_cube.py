@@ -0,0 +1,130 @@
+"""
+Defines a lightweight pairing of an image cube with its validity
+"""
+
+from typing import Optional, Sequence, Tuple
+from pydantic import BaseModel, Field, ConfigDict, SkipValidation, model_validator
+import numpy as np
+
+from app.models.dataset.packed_validity import PackedValidity
+
+
+class ValidatedCube(BaseModel):
+    """
+    An image cube and a boolean validity mask of the same shape (True = valid).
+    A validity of None means that every pixel is valid, so scenes without invalid pixels
+    never materialise a mask. Unlike np.ma.MaskedArray, operations on the data are plain
+    numpy operations and derived cubes share the validity of their source without copies.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    data: SkipValidation[np.ndarray] = Field(..., description="The image cube")
+
+    validity: Optional[SkipValidation[np.ndarray]] = Field(
+        default=None,
+        description="A boolean array of the shape of the data, True where the data is valid. "
+        "None when every pixel is valid.",
+    )
+
+    @model_validator(mode="after")
+    def check_validity(self) -> "ValidatedCube":
+        """
+        The validity must be boolean and match the data
+        """
+        if self.validity is not None:
+            if self.validity.dtype != np.bool_:
+                raise ValueError(f"Validity must be boolean, got {self.validity.dtype}")
+            if self.validity.shape != self.data.shape:
+                raise ValueError(
+                    f"Validity shape {self.validity.shape} does not match the data {self.data.shape}"
+                )
+        return self
+
+    @classmethod
+    def from_mask(
+        cls, data: np.ndarray, mask: Optional[np.ndarray] = None
+    ) -> "ValidatedCube":
+        """
+        Builds a validated cube from data and an invalidity mask (True = invalid), as used by
+        numpy.ma. Masks without any invalid pixel are dropped.
+        """
+        if mask is None or mask is np.ma.nomask or not mask.any():
+            return cls(data=data)
+        return cls(data=data, validity=~np.broadcast_to(mask, data.shape))
+
+    @classmethod
+    def from_masked_array(cls, cube: np.ma.MaskedArray) -> "ValidatedCube":
+        """
+        Builds a validated cube from a masked array, sharing its data
+        """
+        return cls.from_mask(data=cube.data, mask=np.ma.getmask(cube))
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.data.shape
+
+    @property
+    def is_fully_valid(self) -> bool:
+        """
+        Whether every pixel is valid
+        """
+        return self.validity is None
+
+    @property
+    def valid_count(self) -> int:
+        """
+        The number of valid pixels
+        """
+        if self.validity is None:
+            return self.data.size
+        return int(np.count_nonzero(self.validity))
+
+    def validity_mask(self) -> np.ndarray:
+        """
+        The validity as a full boolean array, materialised only when every pixel is valid
+        """
+        if self.validity is None:
+            return np.ones(self.data.shape, dtype=np.bool_)
+        return self.validity
+
+    def valid_values(self) -> np.ndarray:
+        """
+        The valid values as a 1D array, the equivalent of np.ma.MaskedArray.compressed
+        """
+        if self.validity is None:
+            return self.data.ravel()
+        return self.data[self.validity]
+
+    def with_data(self, data: np.ndarray) -> "ValidatedCube":
+        """
+        A validated cube holding new data of the same shape and sharing this validity
+        """
+        return ValidatedCube(data=data, validity=self.validity)
+
+    def transpose(self, axes: Sequence[int]) -> "ValidatedCube":
+        """
+        Permutes the axes of the data and the validity together, as views
+        """
+        return ValidatedCube(
+            data=np.transpose(self.data, axes),
+            validity=None
+            if self.validity is None
+            else np.transpose(self.validity, axes),
+        )
+
+    def pack_validity(self) -> Optional[PackedValidity]:
+        """
+        The validity bit packed along the last axis, or None when every pixel is valid
+        """
+        if self.validity is None:
+            return None
+        return PackedValidity.from_cube(self.validity)
+
+    def to_masked_array(self) -> np.ma.MaskedArray:
+        """
+        The cube as a numpy masked array, for callers that still expect one
+        """
+        if self.validity is None:
+            return np.ma.MaskedArray(data=self.data)
+        return np.ma.MaskedArray(data=self.data, mask=~self.validity)
@@ -2,10 +2,15 @@
 Defines a model for the adaptive cloud masker response
 """
 
-from typing import Any
-from pydantic import BaseModel, Field, ConfigDict
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple, Union
+from pydantic import BaseModel, Field, ConfigDict, SkipValidation
 import numpy as np
-from sklearn.mixture import GaussianMixture
+
+from app.statistical_models.histogram_gaussian_mixture import HistogramGaussianMixture
+
+if TYPE_CHECKING:
+    # sklearn is only imported when a model is actually trained with it
+    from sklearn.mixture import GaussianMixture
 
 
 class AdaptiveCloudMaskerResponse(BaseModel):
@@ -21,8 +26,20 @@ class AdaptiveCloudMaskerResponse(BaseModel):
     n_comp: int = Field(
         ..., description="The number of components used in the Gaussian Mixture Model"
     )
-    model: GaussianMixture = Field(..., description="The gaussian mixture model")
+    model: SkipValidation[Union["GaussianMixture", HistogramGaussianMixture]] = Field(
+        ...,
+        description="The gaussian mixture model, fitted by sklearn or on the histogram",
+    )
     anchors: Any = Field(..., description="The percentile probes used in the model")
     pixels_masked: int = Field(
         ..., description="The total number of pixels masked by the model"
     )
+    cloud_intervals: Optional[List[Tuple[float, float]]] = Field(
+        default=None,
+        description="The (lower, upper] temperature intervals flagged as cloud, "
+        "when predicting with thresholds",
+    )
+
+
+# The sklearn model is not validated, resolving it as Any keeps sklearn from being imported
+AdaptiveCloudMaskerResponse.model_rebuild(_types_namespace={"GaussianMixture": Any})
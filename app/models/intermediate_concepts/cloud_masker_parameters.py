@@ -0,0 +1,29 @@
+"""
+Defines the persisted parameters of a fitted adaptive cloud masker
+"""
+
+from typing import List
+from pydantic import BaseModel, Field
+
+
+class CloudMaskerParameters(BaseModel):
+    """
+    Everything needed to predict with, or warm start, an adaptive cloud masker fit on a scene.
+    Parameters are shared by scenes of the same WRS path/row acquired in the same month.
+    """
+
+    wrs_path: int = Field(..., ge=0, description="The WRS path of the scene")
+    wrs_row: int = Field(..., ge=0, description="The WRS row of the scene")
+    month: int = Field(..., ge=1, le=12, description="The month of acquisition")
+    engine: str = Field(..., description="The engine the mixture was fit with")
+    n_comp: int = Field(..., gt=0, description="The number of mixture components")
+    weights: List[float] = Field(..., description="The mixture weights")
+    means: List[float] = Field(..., description="The component means in celsius")
+    variances: List[float] = Field(..., description="The component variances")
+    anchors: List[float] = Field(..., description="The initial means of the fit")
+    probe: List[float] = Field(
+        ..., description="The percentile probe of the scene the mixture was fit on"
+    )
+    scene_count: int = Field(
+        default=1, gt=0, description="The number of scenes that refined the parameters"
+    )
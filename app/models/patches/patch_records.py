@@ -0,0 +1,64 @@
+"""
+Defines a columnar selection of patches from a patch index
+"""
+
+from pydantic import BaseModel, Field, ConfigDict, SkipValidation, model_validator
+import numpy as np
+
+
+class PatchRecords(BaseModel):
+    """
+    Patches of a corpus as parallel columns, one entry per patch.
+    Everything needed to locate and pick patches, without any pixel data.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    scene_ids: SkipValidation[np.ndarray] = Field(
+        ..., description="The scene of each patch, an (N,) array of strings"
+    )
+    patch_coordinates: SkipValidation[np.ndarray] = Field(
+        ...,
+        description="The (row, col) top left corner of each patch, an (N, 2) int32 array",
+    )
+    valid_fractions: SkipValidation[np.ndarray] = Field(
+        ..., description="The fraction of valid pixels of each patch, float32"
+    )
+    cloud_fractions: SkipValidation[np.ndarray] = Field(
+        ...,
+        description="The fraction of clouded pixels of each patch, float32. "
+        "NaN for scenes indexed without a cloud mask.",
+    )
+    available_band_counts: SkipValidation[np.ndarray] = Field(
+        ..., description="The number of bands available in each patch, int32"
+    )
+
+    @model_validator(mode="after")
+    def check_lengths(self) -> "PatchRecords":
+        """
+        Every column must hold one entry per patch
+        """
+        count = self.scene_ids.shape[0]
+        if self.patch_coordinates.shape != (count, 2):
+            raise ValueError(
+                f"Expected ({count}, 2) patch coordinates, got {self.patch_coordinates.shape}"
+            )
+        for name in ("valid_fractions", "cloud_fractions", "available_band_counts"):
+            if getattr(self, name).shape != (count,):
+                raise ValueError(f"Expected {count} {name}")
+        return self
+
+    def __len__(self) -> int:
+        return self.scene_ids.shape[0]
+
+    def take(self, indices: np.ndarray) -> "PatchRecords":
+        """
+        The records at the given indices, in their order
+        """
+        return PatchRecords(
+            scene_ids=self.scene_ids[indices],
+            patch_coordinates=self.patch_coordinates[indices],
+            valid_fractions=self.valid_fractions[indices],
+            cloud_fractions=self.cloud_fractions[indices],
+            available_band_counts=self.available_band_counts[indices],
+        )
@@ -28,3 +28,10 @@ class PatchRequest(BaseModel):
         ...,
         description="The stride length taken as the patch moves horizontally and vertically on the image.",
     )
+    min_valid_fraction: float = Field(
+        default=0.0,
+        ge=0.0,
+        le=1.0,
+        description="Patches with a smaller fraction of valid pixels are dropped from the plan. "
+        "Only applies when a validity is given to the plan generator.",
+    )
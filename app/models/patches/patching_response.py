@@ -2,9 +2,10 @@
 Defines a patching plan, the concept of a patch
 """
 
-from typing import List, Tuple
+from typing import Optional
 
-from pydantic import BaseModel, Field, SkipValidation, ConfigDict
+import numpy as np
+from pydantic import BaseModel, Field, SkipValidation, ConfigDict, model_validator
 
 from app.models.patches.patching_request import PatchRequest
 
@@ -20,6 +21,44 @@ class PatchingPlan(BaseModel):
         ..., description="The request through which the patch plan was generated"
     )
 
-    patch_coordinates: List[Tuple[int, int]] = Field(
-        ..., description="The top left corner coordinates of each patch"
+    patch_coordinates: SkipValidation[np.ndarray] = Field(
+        ...,
+        description="The (row, col) top left corner coordinates of each patch, "
+        "an (N, 2) int32 array in row major order",
     )
+
+    valid_fractions: Optional[SkipValidation[np.ndarray]] = Field(
+        default=None,
+        description="The fraction of valid pixels of each patch as an (N,) float32 array, "
+        "None when the plan was generated without a validity",
+    )
+
+    @model_validator(mode="after")
+    def check_patch_coordinates(self) -> "PatchingPlan":
+        """
+        The coordinates must be an (N, 2) integer array
+        """
+        coordinates = self.patch_coordinates
+        if coordinates.ndim != 2 or coordinates.shape[1] != 2:
+            raise ValueError(
+                f"Patch coordinates must be of shape (N, 2), got {coordinates.shape}"
+            )
+        if not np.issubdtype(coordinates.dtype, np.integer):
+            raise ValueError(
+                f"Patch coordinates must be integers, got {coordinates.dtype}"
+            )
+        if self.valid_fractions is not None and self.valid_fractions.shape != (
+            coordinates.shape[0],
+        ):
+            raise ValueError(
+                f"Expected {coordinates.shape[0]} valid fractions, "
+                f"got {self.valid_fractions.shape}"
+            )
+        return self
+
+    @property
+    def patch_count(self) -> int:
+        """
+        The number of patches in the plan
+        """
+        return self.patch_coordinates.shape[0]
@@ -3,15 +3,35 @@ Adaptive Cloud masking Gaussian Mixture Model for B10
 """
 
 import logging
-from typing import Union
+from typing import Iterable, List, Literal, Optional, Tuple, Union
 import numpy as np
-from sklearn.mixture import GaussianMixture
+import numexpr as ne
 
 from app.abstract_classes.ml_model import MlModel
 from app.models.base_models.base_model import BaseModel
+from app.statistical_models.histogram_gaussian_mixture import (
+    DEFAULT_BIN_WIDTH,
+    HistogramGaussianMixture,
+    build_histogram,
+    histogram_percentiles,
+    truncate_histogram,
+)
+from app.statistical_models.streaming_statistics import (
+    DEFAULT_RESERVOIR_SIZE,
+    ReservoirSampler,
+    StreamingHistogram,
+)
+from app.statistical_models.mixture_decision_intervals import (
+    decision_intervals,
+    interval_expression,
+)
+from app.models.images.validated_cube import ValidatedCube
 from app.models.intermediate_concepts.adaptive_cloud_masker_response import (
     AdaptiveCloudMaskerResponse,
 )
+from app.models.intermediate_concepts.cloud_masker_parameters import (
+    CloudMaskerParameters,
+)
 
 DEFAULT_COMPNENT_COUNT = 5
 ADAPTIVE_COMPONENT_COUNT = 3
@@ -42,38 +62,145 @@ class B10AdaptiveCloudMasker(MlModel):
         self.model = None
         self.sample_count: int = None
         self.probe = None
+        self.engine: Literal["sklearn", "histogram"] = "sklearn"
+        self.bin_width: float = DEFAULT_BIN_WIDTH
+        self.prediction_mode: Literal["labels", "thresholds"] = "labels"
+        self.cloud_indices: Optional[np.ndarray] = None
+        self.cloud_intervals: Optional[List[Tuple[float, float]]] = None
+        self.random_seed: Optional[int] = None
+        self.warm_start: Optional[CloudMaskerParameters] = None
 
-    def configure(self, sampling_ratio: float = 0.1, **kwargs):
+    def configure(
+        self,
+        sampling_ratio: float = 0.1,
+        engine: Literal["sklearn", "histogram"] = "sklearn",
+        bin_width: float = DEFAULT_BIN_WIDTH,
+        prediction_mode: Literal["labels", "thresholds"] = "labels",
+        random_seed: Optional[int] = None,
+        warm_start: Optional[CloudMaskerParameters] = None,
+        **kwargs,
+    ):
         """
         Configure the model
+
+        Args:
+            sampling_ratio (float): The fraction of pixels the sklearn engine is fit on
+            engine (Literal["sklearn", "histogram"]): "sklearn" fits sklearn's GaussianMixture
+                on a random sample of pixels. "histogram" fits a weighted EM on a fine
+                histogram of every pixel, which is an order of magnitude faster.
+            bin_width (float): The histogram bin width in celsius for the histogram engine
+            prediction_mode (Literal["labels", "thresholds"]): "labels" labels every pixel
+                with its cluster and flags the cloud clusters. "thresholds" derives the
+                temperature intervals of the cloud clusters from the fitted mixture and
+                flags clouds with a single vectorised comparison.
+            random_seed (Optional[int]): Seeds the pixel sampling of the sklearn engine so
+                that training is reproducible. Unseeded if None.
+            warm_start (Optional[CloudMaskerParameters]): Parameters fit on a similar scene
+                (same path/row and month) that EM starts from instead of the anchors.
         """
+        if engine not in ("sklearn", "histogram"):
+            raise ValueError(f"Invalid engine: {engine}")
+        if prediction_mode not in ("labels", "thresholds"):
+            raise ValueError(f"Invalid prediction mode: {prediction_mode}")
         self.expansive_percentiles = [2, 8, 50, 92, 98]
         self.restrictive_percentiles = [2, 8, 50]
         self.significant_cloud_potential_in_celsius: float = 0.0
         self.physical_cloud_threshold_in_celsius: float = 30.0
         self.sampling_ratio: float = sampling_ratio
+        self.engine = engine
+        self.bin_width = bin_width
+        self.prediction_mode = prediction_mode
+        self.random_seed = random_seed
+        self.warm_start = warm_start
 
     def train(
-        self, input_cube: Union[np.ndarray, np.ma.MaskedArray], **kwargs
+        self, input_cube: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube], **kwargs
     ):  # Pylint
         """
         Trains the model.
 
         Inputs are in celsius always.
         """
-        if isinstance(input_cube, np.ma.MaskedArray):
-            print("Masked Array")
+        if isinstance(input_cube, ValidatedCube):
+            valid_pixels = input_cube.valid_values().reshape(-1, 1)
+        elif isinstance(input_cube, np.ma.MaskedArray):
             valid_pixels = input_cube.compressed().reshape(-1, 1)
         elif isinstance(input_cube, np.ndarray):
-            print("Normal Array")
             valid_pixels = input_cube.reshape(-1, 1)
         else:
             raise TypeError("Unsupported Data Type")
 
-        print(valid_pixels.shape)
+        logger.debug("Training on %d valid pixels", valid_pixels.shape[0])
+        if self.engine == "histogram":
+            self._train_from_histogram(valid_pixels.ravel())
+            return
+        self._train_from_samples(valid_pixels)
+
+    def train_streaming(
+        self,
+        tiles: Iterable[Union[np.ndarray, np.ma.MaskedArray, ValidatedCube]],
+        reservoir_size: int = DEFAULT_RESERVOIR_SIZE,
+    ) -> None:
+        """
+        Trains the model on a stream of tiles of a scene, holding a single tile at a time.
+
+        The histogram engine accumulates the histogram of every valid pixel across tiles, so
+        it fits the same mixture as train on the whole scene. The sklearn engine keeps a
+        uniform reservoir sample of the valid pixels that its percentiles, clip and sample
+        are drawn from instead.
+
+        Args:
+            tiles (Iterable): The tiles of the scene in celsius
+            reservoir_size (int): The number of pixels kept for the sklearn engine
+        """
+        if self.engine == "histogram":
+            accumulator = StreamingHistogram(bin_width=self.bin_width)
+        else:
+            accumulator = ReservoirSampler(
+                capacity=reservoir_size, random_seed=self.random_seed
+            )
+        for tile in tiles:
+            if isinstance(tile, ValidatedCube):
+                accumulator.add(tile.valid_values())
+            elif isinstance(tile, np.ma.MaskedArray):
+                accumulator.add(tile.compressed())
+            elif isinstance(tile, np.ndarray):
+                accumulator.add(tile)
+            else:
+                raise TypeError("Unsupported Data Type")
+
+        if self.engine == "histogram":
+            if accumulator.total == 0:
+                raise ValueError("Cannot train on a scene without valid pixels")
+            self._fit_histogram(*accumulator.histogram())
+            return
+        if accumulator.filled == 0:
+            raise ValueError("Cannot train on a scene without valid pixels")
+        logger.info(
+            "Reservoir holds %d of %d valid pixels",
+            accumulator.filled,
+            accumulator.seen,
+        )
+        self._train_from_samples(
+            accumulator.sample().reshape(-1, 1),
+            population_ratio=accumulator.seen / accumulator.filled,
+        )
+
+    def _train_from_samples(
+        self, valid_pixels: np.ndarray, population_ratio: float = 1.0
+    ) -> None:
+        """
+        Fits sklearn's GaussianMixture on a random sample of the valid pixels
+
+        Args:
+            valid_pixels (np.ndarray): The (N, 1) valid pixels, or a uniform sample of them
+            population_ratio (float): The number of valid pixels in the scene per pixel
+                given, the sample size is taken relative to the whole scene and capped
+                at the pixels given.
+        """
         # First we probe the distribution and get the physics of the scene
         probe = np.percentile(valid_pixels, self.expansive_percentiles)
-        print(probe)
+        logger.debug("Probe set to : %s", probe)
         self.probe = probe
 
         # We then apply a high temperature clip for stability
@@ -81,6 +208,46 @@ class B10AdaptiveCloudMasker(MlModel):
         p95 = np.percentile(valid_pixels, 95)
         training_data = valid_pixels[valid_pixels <= p95].reshape(-1, 1)
 
+        self._set_anchors(probe)
+
+        # Fit the GMM after sampling
+
+        self.sample_count: int = min(
+            int(training_data.shape[0] * population_ratio * self.sampling_ratio),
+            training_data.shape[0],
+        )
+        logger.info("Sample Count set to : %d", self.sample_count)
+
+        # Create a random number generator
+        rng = np.random.default_rng(self.random_seed)
+        sampled_data = rng.choice(training_data, size=self.sample_count, replace=False)
+
+        # Train the model, sklearn is imported here so that importing the masker stays cheap
+        from sklearn.mixture import (  # pylint: disable=import-outside-toplevel
+            GaussianMixture,
+        )
+
+        if self.warm_start is not None:
+            # sklearn requires the weights to sum to one in double precision
+            weights_init = np.asarray(self.warm_start.weights, dtype=np.float64)
+            self.model = GaussianMixture(
+                n_components=self.n_comp,
+                weights_init=weights_init / weights_init.sum(),
+                means_init=np.reshape(self.warm_start.means, (-1, 1)),
+                precisions_init=1.0 / np.reshape(self.warm_start.variances, (-1, 1, 1)),
+                random_state=42,
+            )
+        else:
+            self.model = GaussianMixture(
+                n_components=self.n_comp, means_init=self.anchors, random_state=42
+            )
+        self.model.fit(sampled_data)
+        self._derive_cloud_decisions()
+
+    def _set_anchors(self, probe: np.ndarray) -> None:
+        """
+        Sets the component count and the initial means from the percentile probe
+        """
         # We then perform a conditional set up
         # If the second percentile is freezing then therre is significant cloud potential
         if probe[0] < self.significant_cloud_potential_in_celsius:
@@ -101,25 +268,123 @@ class B10AdaptiveCloudMasker(MlModel):
                 ]
             ).reshape(-1, 1)
 
-        print(f"Anchors Set to {self.anchors}")
+        if self.warm_start is not None:
+            if self.warm_start.n_comp != self.n_comp:
+                raise ValueError(
+                    f"Cannot warm start {self.n_comp} components from {self.warm_start.n_comp}"
+                )
+            logger.info("Warm starting from %d scene(s)", self.warm_start.scene_count)
 
-        # Fit the GMM after sampling
+        logger.debug("Anchors set to : %s", self.anchors)
+
+    def _train_from_histogram(self, valid_pixels: np.ndarray) -> None:
+        """
+        Trains the model from a fine histogram of the valid pixels.
+        The histogram is built in a single pass, the percentiles are read from its CDF and
+        the mixture is fit by weighted EM on the bin centres, using every pixel instead of
+        a random sample.
+        """
+        counts, edges = build_histogram(valid_pixels, bin_width=self.bin_width)
+        self._fit_histogram(counts, edges)
+
+    def _fit_histogram(self, counts: np.ndarray, edges: np.ndarray) -> None:
+        """
+        Fits the mixture to a histogram of the valid pixels of a scene
+        """
+        percentiles = histogram_percentiles(
+            counts, edges, self.expansive_percentiles + [95]
+        )
+        probe, p95 = percentiles[:-1], percentiles[-1]
+        logger.debug("Probe set to : %s", probe)
+        self.probe = probe
+
+        # The same high temperature clip as the sampled engine, applied to the bin weights
+        weights = truncate_histogram(counts, edges, p95)
+        self._set_anchors(probe)
 
-        self.sample_count: int = int(training_data.shape[0] * self.sampling_ratio)
+        self.sample_count: int = int(weights.sum())
         logger.info("Sample Count set to : %d", self.sample_count)
 
-        # Create a random number generator
-        rng = np.random.default_rng()
-        sampled_data = rng.choice(training_data, size=self.sample_count, replace=False)
+        warm_start = self.warm_start
+        self.model = HistogramGaussianMixture(
+            n_components=self.n_comp,
+            means_init=self.anchors if warm_start is None else warm_start.means,
+            weights_init=None if warm_start is None else warm_start.weights,
+            variances_init=None if warm_start is None else warm_start.variances,
+        ).fit_histogram(
+            centres=(edges[:-1] + edges[1:]) / 2.0,
+            weights=weights,
+            bin_width=self.bin_width,
+        )
+        self._derive_cloud_decisions()
+
+    def _derive_cloud_decisions(self) -> None:
+        """
+        Derives the cloud clusters and their temperature intervals from the fitted mixture.
+        Run once per fit, predictions only read them.
+        """
+        # Perform physical verification by masking clusters that are actually cold
+        cluster_means = self.model.means_.flatten()
+        scene_median = self.probe[2]
+        dynamic_threshold = scene_median - 12.0
+        logger.debug("Dynamic threshold set to : %s", dynamic_threshold)
+        self.cloud_indices = np.where(cluster_means < dynamic_threshold)[0]
+        logger.debug("Cloud clusters : %s", self.cloud_indices)
 
-        # Train the model
-        self.model = GaussianMixture(
-            n_components=self.n_comp, means_init=self.anchors, random_state=42
+        self.cloud_intervals = decision_intervals(
+            weights=self.model.weights_,
+            means=self.model.means_,
+            variances=self.model.covariances_,
+            components=self.cloud_indices,
         )
-        self.model.fit(sampled_data)
+        logger.debug("Cloud intervals set to : %s", self.cloud_intervals)
+
+    def export_parameters(
+        self, wrs_path: int, wrs_row: int, month: int
+    ) -> CloudMaskerParameters:
+        """
+        The fitted parameters of the model, to persist and reuse on similar scenes
+
+        Args:
+            wrs_path (int): The WRS path of the scene the model was fit on
+            wrs_row (int): The WRS row of the scene the model was fit on
+            month (int): The month the scene was acquired in
+        """
+        if self.model is None:
+            raise ValueError("Model has not yet been fit")
+        return CloudMaskerParameters(
+            wrs_path=wrs_path,
+            wrs_row=wrs_row,
+            month=month,
+            engine=self.engine,
+            n_comp=self.n_comp,
+            weights=np.ravel(self.model.weights_).tolist(),
+            means=np.ravel(self.model.means_).tolist(),
+            variances=np.ravel(self.model.covariances_).tolist(),
+            anchors=np.ravel(self.anchors).tolist(),
+            probe=np.ravel(self.probe).tolist(),
+            scene_count=(
+                1 if self.warm_start is None else self.warm_start.scene_count + 1
+            ),
+        )
+
+    def restore(self, parameters: CloudMaskerParameters) -> None:
+        """
+        Restores a fitted model from stored parameters so that it predicts without training.
+        Predictions are those of the model the parameters were exported from.
+        """
+        self.n_comp = parameters.n_comp
+        self.anchors = np.reshape(parameters.anchors, (-1, 1))
+        self.probe = np.asarray(parameters.probe)
+        self.model = HistogramGaussianMixture.from_parameters(
+            weights=parameters.weights,
+            means=parameters.means,
+            variances=parameters.variances,
+        )
+        self._derive_cloud_decisions()
 
     def predict(
-        self, input_cube: Union[np.ndarray, np.ma.MaskedArray], **kwargs
+        self, input_cube: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube], **kwargs
     ) -> AdaptiveCloudMaskerResponse:
         """
         Perform actual prediction
@@ -127,37 +392,89 @@ class B10AdaptiveCloudMasker(MlModel):
         if self.model is None:
             raise ValueError("Model has not yet been fit")
 
-        if isinstance(input_cube, np.ma.MaskedArray):
+        if self.prediction_mode == "thresholds":
+            is_cloud = self._predict_with_thresholds(input_cube)
+        else:
+            is_cloud = self._predict_with_labels(input_cube, self.cloud_indices)
+
+        return AdaptiveCloudMaskerResponse(
+            cloud_mask=is_cloud,
+            n_comp=self.n_comp,
+            model=self.model,
+            anchors=self.anchors,
+            pixels_masked=is_cloud.sum(),
+            cloud_intervals=(
+                self.cloud_intervals if self.prediction_mode == "thresholds" else None
+            ),
+        )
+
+    def _predict_with_labels(
+        self,
+        input_cube: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube],
+        cloud_indices: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Labels every valid pixel with its most likely cluster and flags the cloud clusters
+        """
+        if isinstance(input_cube, ValidatedCube):
+            valid_pixels = input_cube.valid_values().reshape(-1, 1)
+        elif isinstance(input_cube, np.ma.MaskedArray):
             valid_pixels = input_cube.compressed().reshape(-1, 1)
         elif isinstance(input_cube, np.ndarray):
             valid_pixels = input_cube.reshape(-1, 1)
         else:
             raise TypeError("Unsupported Data Type")
+        if valid_pixels.shape[0] == 0:
+            # Tiles of a scene can lie entirely outside its footprint
+            return np.zeros(input_cube.shape, dtype=bool)
         labels_1d = self.model.predict(valid_pixels)
 
-        # Perform physical verification by masking clusters that are actually cold
-        cluster_means = self.model.means_.flatten()
-        scene_median = self.probe[2]
-        dynamic_threshold = scene_median - 12.0
-        print(dynamic_threshold)
-        cloud_indices = np.where(cluster_means < dynamic_threshold)[0]
-        print(cloud_indices)
-
         # Create the spatial grid
         label_grid = np.full(input_cube.shape, -1, dtype=np.int8)
-        if isinstance(input_cube, np.ma.MaskedArray):
+        if isinstance(input_cube, ValidatedCube):
+            if input_cube.validity is None:
+                label_grid[:] = labels_1d.reshape(input_cube.shape)
+            else:
+                label_grid[input_cube.validity] = labels_1d
+        elif isinstance(input_cube, np.ma.MaskedArray):
             label_grid[~input_cube.mask] = labels_1d
         elif isinstance(input_cube, np.ndarray):
             # For normal ndarray, mask is False everywhere
             label_grid[:] = labels_1d.reshape(input_cube.shape)
 
         # Create the final boolean mask
-        is_cloud = np.isin(label_grid, cloud_indices)
+        return np.isin(label_grid, cloud_indices)
 
-        return AdaptiveCloudMaskerResponse(
-            cloud_mask=is_cloud,
-            n_comp=self.n_comp,
-            model=self.model,
-            anchors=self.anchors,
-            pixels_masked=is_cloud.sum(),
-        )
+    def _predict_with_thresholds(
+        self,
+        input_cube: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube],
+    ) -> np.ndarray:
+        """
+        Flags clouds with a single vectorised comparison against the temperature intervals
+        that the fitted mixture assigns to the cloud clusters. No labels are computed.
+        The intervals are derived once per fit.
+        """
+        local_dict = {}
+        if isinstance(input_cube, ValidatedCube):
+            data = input_cube.data
+            if input_cube.validity is not None:
+                local_dict["valid"] = input_cube.validity
+        elif isinstance(input_cube, np.ma.MaskedArray):
+            data = input_cube.data
+            if np.ma.getmask(input_cube) is not np.ma.nomask:
+                local_dict["invalid"] = input_cube.mask
+        elif isinstance(input_cube, np.ndarray):
+            data = input_cube
+        else:
+            raise TypeError("Unsupported Data Type")
+        if not self.cloud_intervals:
+            return np.zeros(data.shape, dtype=bool)
+
+        expression, bounds = interval_expression(self.cloud_intervals, variable="x")
+        if "valid" in local_dict:
+            expression = f"({expression}) & valid"
+        elif "invalid" in local_dict:
+            expression = f"({expression}) & ~invalid"
+        local_dict.update(bounds)
+        local_dict["x"] = data
+        return ne.evaluate(expression, local_dict=local_dict)
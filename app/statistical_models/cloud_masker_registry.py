@@ -0,0 +1,97 @@
+"""
+A persistent registry of fitted cloud masker parameters.
+
+Scenes of the same WRS path/row acquired in the same month see similar temperature
+distributions, so the mixture fit on one is a good starting point for the next. Fitted
+parameters are stored as one small JSON file per path/row and month.
+"""
+
+import os
+import logging
+from typing import Optional, Tuple
+
+from app.models.dataset.applicable_metadata import ApplicableFields
+from app.models.intermediate_concepts.cloud_masker_parameters import (
+    CloudMaskerParameters,
+)
+from app.utils.stac.stac_utils.file_name_parsers import FileNameParser
+
+logger = logging.getLogger("CloudMaskerRegistry")
+logger.setLevel(logging.INFO)
+
+# Bump whenever the layout of the parameters changes so that old files are ignored
+CLOUD_MASKER_REGISTRY_VERSION = 1
+
+DEFAULT_REGISTRY_DIRECTORY = os.path.join(
+    os.path.expanduser("~"), ".cache", "hsi_anomaly_foundations", "cloud_masker"
+)
+REGISTRY_DIRECTORY_ENV_VARIABLE = "HSI_CLOUD_MASKER_REGISTRY_DIR"
+
+
+def scene_key(file_name: str) -> Tuple[int, int, int]:
+    """
+    The (WRS path, WRS row, month) of a Landsat scene from its file name
+    """
+    parsed = FileNameParser().parse(os.path.basename(file_name))
+    path_row = parsed[ApplicableFields.PATH_ROW.value]
+    return (
+        int(path_row[:3]),
+        int(path_row[3:]),
+        parsed[ApplicableFields.DATETIME.value].month,
+    )
+
+
+class CloudMaskerRegistry:
+    """
+    Stores and retrieves CloudMaskerParameters as JSON files in a registry directory
+    """
+
+    def __init__(self, registry_directory: Optional[str] = None):
+        """
+        Class constructor.
+        The registry directory defaults to $HSI_CLOUD_MASKER_REGISTRY_DIR or a directory
+        under ~/.cache
+        """
+        self.registry_directory: str = registry_directory or os.getenv(
+            REGISTRY_DIRECTORY_ENV_VARIABLE, DEFAULT_REGISTRY_DIRECTORY
+        )
+        os.makedirs(self.registry_directory, exist_ok=True)
+
+    def _parameters_path(self, wrs_path: int, wrs_row: int, month: int) -> str:
+        return os.path.join(
+            self.registry_directory,
+            f"v{CLOUD_MASKER_REGISTRY_VERSION}_p{wrs_path:03d}_r{wrs_row:03d}_m{month:02d}.json",
+        )
+
+    def load(
+        self, wrs_path: int, wrs_row: int, month: int
+    ) -> Optional[CloudMaskerParameters]:
+        """
+        Returns the stored parameters of a path/row and month or None if there are none
+        """
+        parameters_path = self._parameters_path(wrs_path, wrs_row, month)
+        if not os.path.exists(parameters_path):
+            return None
+        try:
+            with open(parameters_path, "r", encoding="utf-8") as parameters_file:
+                return CloudMaskerParameters.model_validate_json(parameters_file.read())
+        except Exception as err:  # pylint: disable=broad-except
+            # Broken parameters are never fatal, the masker is simply trained from scratch
+            logger.warning(
+                "Ignoring unreadable parameters %s: %s", parameters_path, err
+            )
+            return None
+
+    def store(self, parameters: CloudMaskerParameters) -> str:
+        """
+        Writes parameters to the registry and returns their path.
+        The write is atomic so concurrent readers never see a partial file.
+        """
+        parameters_path = self._parameters_path(
+            parameters.wrs_path, parameters.wrs_row, parameters.month
+        )
+        temporary_path = f"{parameters_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as parameters_file:
+            parameters_file.write(parameters.model_dump_json())
+        os.replace(temporary_path, parameters_path)
+        return parameters_path
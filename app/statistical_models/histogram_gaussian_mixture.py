@@ -0,0 +1,272 @@
+"""
+A one dimensional Gaussian mixture fit on a histogram instead of on individual samples
+"""
+
+import logging
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_BIN_WIDTH = 0.01
+DEFAULT_MAX_ITERATIONS = 100
+# Same convergence tolerance and variance regularisation as sklearn's GaussianMixture
+DEFAULT_TOLERANCE = 1e-3
+DEFAULT_REG_COVAR = 1e-6
+# Number of values labelled at once when predicting
+PREDICTION_CHUNK_SIZE = 1 << 20
+
+logger = logging.getLogger("HistogramGaussianMixture")
+logger.setLevel(logging.INFO)
+
+
+def build_histogram(
+    values: np.ndarray, bin_width: float = DEFAULT_BIN_WIDTH
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Bins values into a fine uniform histogram spanning their range, in one pass over the data.
+
+    Args:
+        values (np.ndarray): The values to bin
+        bin_width (float): The width of every bin
+    """
+    if bin_width <= 0:
+        raise ValueError("bin_width must be greater than 0")
+    if values.size == 0:
+        raise ValueError("Cannot build a histogram of no values")
+    lowest, highest = float(values.min()), float(values.max())
+    bin_count = max(1, int(np.ceil((highest - lowest) / bin_width)))
+    # Uniform bins on an explicit range let numpy compute bin indices directly
+    counts, edges = np.histogram(
+        values, bins=bin_count, range=(lowest, lowest + bin_count * bin_width)
+    )
+    return counts, edges
+
+
+def histogram_percentiles(
+    counts: np.ndarray, edges: np.ndarray, percentiles: Sequence[float]
+) -> np.ndarray:
+    """
+    Reads percentiles off the cumulative distribution of a histogram.
+    The values inside a bin are taken as evenly spread over it, so the error is within a bin.
+    """
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    ranks = np.asarray(percentiles, dtype=np.float64) / 100.0 * (total - 1)
+    bins = np.minimum(np.searchsorted(cumulative, ranks, side="right"), len(counts) - 1)
+    before = cumulative[bins] - counts[bins]
+    fraction = (ranks - before + 0.5) / np.maximum(counts[bins], 1)
+    return edges[bins] + np.clip(fraction, 0.0, 1.0) * (edges[bins + 1] - edges[bins])
+
+
+def truncate_histogram(
+    counts: np.ndarray, edges: np.ndarray, upper: float
+) -> np.ndarray:
+    """
+    Weights of a histogram restricted to values at or below an upper bound.
+    The bin holding the bound keeps the fraction of its width below it.
+    """
+    widths = edges[1:] - edges[:-1]
+    kept = np.clip((upper - edges[:-1]) / widths, 0.0, 1.0)
+    return counts * kept
+
+
+class HistogramGaussianMixture:
+    """
+    A Gaussian mixture for one dimensional data fit by EM on histogram bin centres weighted
+    by their counts. Fitting costs scale with the number of bins, not the number of samples.
+
+    The fitted attributes mirror those of sklearn's GaussianMixture with a full covariance
+    (means_ is (K, 1), covariances_ is (K, 1, 1)) so that the two can be used interchangeably.
+    """
+
+    def __init__(
+        self,
+        n_components: int,
+        means_init: Optional[np.ndarray] = None,
+        weights_init: Optional[np.ndarray] = None,
+        variances_init: Optional[np.ndarray] = None,
+        tol: float = DEFAULT_TOLERANCE,
+        max_iter: int = DEFAULT_MAX_ITERATIONS,
+        reg_covar: float = DEFAULT_REG_COVAR,
+    ):
+        """
+        Class constructor
+
+        Args:
+            n_components (int): The number of mixture components
+            means_init (Optional[np.ndarray]): The initial means, spread over the data if None
+            weights_init (Optional[np.ndarray]): The initial weights. Together with
+                variances_init and means_init, EM is warm started from a previous fit.
+            variances_init (Optional[np.ndarray]): The initial variances
+            tol (float): The change in the average log likelihood at which EM stops
+            max_iter (int): The maximum number of EM iterations
+            reg_covar (float): Added to every variance for numerical stability
+        """
+        self.n_components = n_components
+        self.means_init = means_init
+        self.weights_init = weights_init
+        self.variances_init = variances_init
+        self.tol = tol
+        self.max_iter = max_iter
+        self.reg_covar = reg_covar
+        self.weights_: Optional[np.ndarray] = None
+        self.means_: Optional[np.ndarray] = None
+        self.covariances_: Optional[np.ndarray] = None
+        self.converged_: bool = False
+        self.n_iter_: int = 0
+        self.lower_bound_: float = -np.inf
+
+    def _initialize(
+        self, centres: np.ndarray, weights: np.ndarray, variance_correction: float
+    ) -> None:
+        """
+        Clusters the bins with a weighted k-means started from the initial means, takes the
+        component weights and variances from the clusters and the means from means_init,
+        as sklearn does when means_init is given.
+        """
+        if self.means_init is not None:
+            means = np.asarray(self.means_init, dtype=np.float64).ravel()
+        else:
+            means = np.quantile(centres, np.linspace(0.0, 1.0, self.n_components + 2))[
+                1:-1
+            ]
+        if means.shape[0] != self.n_components:
+            raise ValueError(
+                f"Expected {self.n_components} initial means, got {means.shape[0]}"
+            )
+        if self.weights_init is not None and self.variances_init is not None:
+            # Warm start, every parameter comes from a previous fit
+            self.weights_ = np.asarray(self.weights_init, dtype=np.float64).ravel()
+            self.means_ = means
+            self.covariances_ = np.asarray(
+                self.variances_init, dtype=np.float64
+            ).ravel()
+            return
+        centroids = means.copy()
+        for _ in range(self.max_iter):
+            labels = np.argmin(np.abs(centres[:, None] - centroids[None, :]), axis=1)
+            totals = np.bincount(labels, weights=weights, minlength=self.n_components)
+            sums = np.bincount(
+                labels, weights=weights * centres, minlength=self.n_components
+            )
+            updated = np.where(totals > 0, sums / np.maximum(totals, 1e-12), centroids)
+            if np.allclose(updated, centroids):
+                break
+            centroids = updated
+        squares = np.bincount(
+            labels,
+            weights=weights * (centres - centroids[labels]) ** 2,
+            minlength=self.n_components,
+        )
+        totals = totals + 10 * np.finfo(np.float64).eps
+        self.weights_ = totals / totals.sum()
+        self.means_ = means
+        self.covariances_ = squares / totals + variance_correction + self.reg_covar
+
+    @classmethod
+    def from_parameters(
+        cls, weights: np.ndarray, means: np.ndarray, variances: np.ndarray
+    ) -> "HistogramGaussianMixture":
+        """
+        A fitted mixture restored from stored parameters, ready to predict
+        """
+        means = np.asarray(means, dtype=np.float64).reshape(-1, 1)
+        model = cls(n_components=means.shape[0])
+        model.weights_ = np.asarray(weights, dtype=np.float64).ravel()
+        model.means_ = means
+        model.covariances_ = np.asarray(variances, dtype=np.float64).reshape(-1, 1, 1)
+        model.converged_ = True
+        return model
+
+    def _estimate_weighted_log_prob(self, values: np.ndarray) -> np.ndarray:
+        """
+        log(weight_k) + log N(value | mean_k, variance_k) for every value and component
+        """
+        means = self.means_.ravel()
+        variances = self.covariances_.ravel()
+        return (
+            np.log(self.weights_)
+            - 0.5 * np.log(2.0 * np.pi * variances)
+            - 0.5 * (values[:, None] - means[None, :]) ** 2 / variances
+        )
+
+    @staticmethod
+    def _log_normalize(weighted_log_prob: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The log likelihood of every value and the log responsibilities
+        """
+        peak = weighted_log_prob.max(axis=1, keepdims=True)
+        log_norm = peak + np.log(
+            np.exp(weighted_log_prob - peak).sum(axis=1, keepdims=True)
+        )
+        return log_norm[:, 0], weighted_log_prob - log_norm
+
+    def fit_histogram(
+        self, centres: np.ndarray, weights: np.ndarray, bin_width: float = 0.0
+    ) -> "HistogramGaussianMixture":
+        """
+        Fits the mixture to a histogram
+
+        Args:
+            centres (np.ndarray): The bin centres
+            weights (np.ndarray): The (possibly fractional) counts of the bins
+            bin_width (float): The width of the bins. The variance of values spread evenly
+                over a bin (width^2 / 12) is added back to the component variances.
+        """
+        centres = np.asarray(centres, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        keep = weights > 0
+        centres, weights = centres[keep], weights[keep]
+        total = weights.sum()
+        if total <= 0:
+            raise ValueError("Cannot fit a mixture to an empty histogram")
+        variance_correction = bin_width**2 / 12.0
+        self._initialize(centres, weights, variance_correction)
+
+        self.converged_ = False
+        lower_bound = -np.inf
+        for iteration in range(1, self.max_iter + 1):
+            previous_lower_bound = lower_bound
+            # E step
+            log_norm, log_resp = self._log_normalize(
+                self._estimate_weighted_log_prob(centres)
+            )
+            lower_bound = float(weights @ log_norm / total)
+            # M step
+            weighted_resp = np.exp(log_resp) * weights[:, None]
+            component_totals = weighted_resp.sum(axis=0) + 10 * np.finfo(np.float64).eps
+            means = centres @ weighted_resp / component_totals
+            variances = (
+                ((centres[:, None] - means[None, :]) ** 2 * weighted_resp).sum(axis=0)
+                / component_totals
+                + variance_correction
+                + self.reg_covar
+            )
+            self.weights_ = component_totals / component_totals.sum()
+            self.means_ = means
+            self.covariances_ = variances
+            self.n_iter_ = iteration
+            if abs(lower_bound - previous_lower_bound) < self.tol:
+                self.converged_ = True
+                break
+        if not self.converged_:
+            logger.warning("EM did not converge after %d iterations", self.max_iter)
+        self.lower_bound_ = lower_bound
+        self.means_ = self.means_.reshape(-1, 1)
+        self.covariances_ = self.covariances_.reshape(-1, 1, 1)
+        return self
+
+    def predict(self, values: np.ndarray) -> np.ndarray:
+        """
+        The most likely component of every value, for values of shape (N,) or (N, 1)
+        """
+        if self.means_ is None:
+            raise ValueError("Model has not yet been fit")
+        values = np.asarray(values).reshape(-1)
+        labels = np.empty(values.shape[0], dtype=np.int64)
+        for start in range(0, values.shape[0], PREDICTION_CHUNK_SIZE):
+            chunk = values[start : start + PREDICTION_CHUNK_SIZE].astype(np.float64)
+            labels[start : start + PREDICTION_CHUNK_SIZE] = np.argmax(
+                self._estimate_weighted_log_prob(chunk), axis=1
+            )
+        return labels
@@ -0,0 +1,133 @@
+"""
+Closed form decision regions of one dimensional Gaussian mixtures
+"""
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+# (lower, upper] bounds of a region of values, either bound may be infinite
+Interval = Tuple[float, float]
+
+
+def _component_log_prob(
+    values: np.ndarray, weights: np.ndarray, means: np.ndarray, variances: np.ndarray
+) -> np.ndarray:
+    """
+    log(weight_k) + log N(value | mean_k, variance_k) for every value and component
+    """
+    return (
+        np.log(weights)
+        - 0.5 * np.log(2.0 * np.pi * variances)
+        - 0.5 * (values[:, None] - means[None, :]) ** 2 / variances
+    )
+
+
+def _pairwise_crossings(
+    weights: np.ndarray, means: np.ndarray, variances: np.ndarray
+) -> np.ndarray:
+    """
+    Every value at which two weighted components are equally likely.
+    Equating two weighted log densities gives a quadratic a x^2 + b x + c = 0.
+    """
+    offsets = np.log(weights) - 0.5 * np.log(2.0 * np.pi * variances)
+    crossings = []
+    for i in range(len(means)):
+        for j in range(i + 1, len(means)):
+            a = 0.5 / variances[j] - 0.5 / variances[i]
+            b = means[i] / variances[i] - means[j] / variances[j]
+            c = (
+                offsets[i]
+                - offsets[j]
+                - 0.5 * means[i] ** 2 / variances[i]
+                + 0.5 * means[j] ** 2 / variances[j]
+            )
+            if abs(a) < 1e-12 * max(abs(b), abs(c), 1.0):
+                if b != 0:
+                    crossings.append(-c / b)
+                continue
+            discriminant = b * b - 4.0 * a * c
+            if discriminant < 0:
+                continue
+            root = np.sqrt(discriminant)
+            crossings.extend([(-b - root) / (2.0 * a), (-b + root) / (2.0 * a)])
+    return np.unique(np.asarray(crossings, dtype=np.float64))
+
+
+def decision_intervals(
+    weights: Sequence[float],
+    means: Sequence[float],
+    variances: Sequence[float],
+    components: Sequence[int],
+) -> List[Interval]:
+    """
+    The regions of values that a one dimensional Gaussian mixture assigns to any of the given
+    components, as sorted, disjoint (lower, upper] intervals.
+
+    The most likely component only changes where two weighted densities cross, so the real
+    line is cut at every pairwise crossing, each piece is labelled by the winner at its
+    midpoint and adjacent pieces of the same kind are merged. A component with a larger
+    variance than its neighbours wins again in the far tails, so a selection can be made of
+    several intervals.
+
+    Args:
+        weights (Sequence[float]): The mixture weights
+        means (Sequence[float]): The component means
+        variances (Sequence[float]): The component variances
+        components (Sequence[int]): The indices of the selected components
+    """
+    weights = np.asarray(weights, dtype=np.float64).ravel()
+    means = np.asarray(means, dtype=np.float64).ravel()
+    variances = np.asarray(variances, dtype=np.float64).ravel()
+    crossings = _pairwise_crossings(weights, means, variances)
+
+    bounds = np.concatenate([[-np.inf], crossings, [np.inf]])
+    if crossings.size == 0:
+        probes = np.array([means.mean()])
+    else:
+        spacing = max(1.0, float(crossings[-1] - crossings[0]))
+        probes = np.concatenate(
+            [
+                [crossings[0] - spacing],
+                (crossings[:-1] + crossings[1:]) / 2.0,
+                [crossings[-1] + spacing],
+            ]
+        )
+    winners = np.argmax(_component_log_prob(probes, weights, means, variances), axis=1)
+    selected = np.isin(winners, np.asarray(components, dtype=np.int64))
+
+    intervals: List[Interval] = []
+    for index, is_selected in enumerate(selected):
+        if not is_selected:
+            continue
+        lower, upper = float(bounds[index]), float(bounds[index + 1])
+        if intervals and intervals[-1][1] == lower:
+            intervals[-1] = (intervals[-1][0], upper)
+        else:
+            intervals.append((lower, upper))
+    return intervals
+
+
+def interval_expression(
+    intervals: Sequence[Interval], variable: str = "x"
+) -> Tuple[str, dict]:
+    """
+    A numexpr expression testing whether a variable lies in any of the intervals, and the
+    bounds it refers to. The bounds are passed as variables so no precision is lost.
+    """
+    terms, bounds = [], {}
+    for index, (lower, upper) in enumerate(intervals):
+        conditions = []
+        if np.isfinite(lower):
+            bounds[f"lower_{index}"] = lower
+            conditions.append(f"({variable} > lower_{index})")
+        if np.isfinite(upper):
+            bounds[f"upper_{index}"] = upper
+            conditions.append(f"({variable} <= upper_{index})")
+        # An interval unbounded on both sides selects every finite value
+        terms.append(
+            "(" + " & ".join(conditions) + ")"
+            if conditions
+            else f"({variable} == {variable})"
+        )
+    return " | ".join(terms), bounds
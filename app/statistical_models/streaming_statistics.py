@@ -0,0 +1,132 @@
+"""
+Statistics accumulated over a stream of tiles, so that models can be trained on scenes
+that never fit in memory at once
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.statistical_models.histogram_gaussian_mixture import DEFAULT_BIN_WIDTH
+
+DEFAULT_RESERVOIR_SIZE = 1 << 22
+
+
+class StreamingHistogram:
+    """
+    A fine histogram built one chunk of values at a time.
+    Bins lie on a fixed grid of multiples of the bin width, so every chunk lands in the same
+    bins whatever its range and the counts only grow at their ends when new values arrive.
+    """
+
+    def __init__(self, bin_width: float = DEFAULT_BIN_WIDTH):
+        """
+        Class constructor
+
+        Args:
+            bin_width (float): The width of every bin
+        """
+        if bin_width <= 0:
+            raise ValueError("bin_width must be greater than 0")
+        self.bin_width = bin_width
+        # Index on the grid of the first bin of the counts
+        self.first_bin: int = 0
+        self.counts: np.ndarray = np.zeros(0, dtype=np.int64)
+
+    @property
+    def total(self) -> int:
+        """
+        The number of values added so far
+        """
+        return int(self.counts.sum())
+
+    def add(self, values: np.ndarray) -> None:
+        """
+        Adds a chunk of values to the histogram
+        """
+        values = np.asarray(values).ravel()
+        if values.size == 0:
+            return
+        bins = np.floor(values / self.bin_width).astype(np.int64)
+        lowest, highest = int(bins.min()), int(bins.max())
+        if self.counts.size == 0:
+            self.first_bin = lowest
+            self.counts = np.zeros(highest - lowest + 1, dtype=np.int64)
+        else:
+            # Grow the counts to cover the new values
+            last_bin = self.first_bin + self.counts.size - 1
+            prepend = max(0, self.first_bin - lowest)
+            append = max(0, highest - last_bin)
+            if prepend or append:
+                self.counts = np.pad(self.counts, (prepend, append))
+                self.first_bin -= prepend
+        self.counts += np.bincount(bins - self.first_bin, minlength=self.counts.size)
+
+    def histogram(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The counts and edges of the histogram, as returned by build_histogram
+        """
+        if self.counts.size == 0:
+            raise ValueError("Cannot build a histogram of no values")
+        edges = (self.first_bin + np.arange(self.counts.size + 1)) * self.bin_width
+        return self.counts, edges
+
+
+class ReservoirSampler:
+    """
+    A uniform random sample of fixed size drawn from a stream of values (algorithm R).
+    Every value seen so far is in the reservoir with the same probability, whatever the
+    order and the size of the chunks it arrived in.
+    """
+
+    def __init__(
+        self,
+        capacity: int = DEFAULT_RESERVOIR_SIZE,
+        random_seed: Optional[int] = None,
+        dtype: np.dtype = np.float32,
+    ):
+        """
+        Class constructor
+
+        Args:
+            capacity (int): The maximum number of values held
+            random_seed (Optional[int]): Seeds the sampling. Unseeded if None.
+            dtype (np.dtype): The dtype of the held values
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be greater than 0")
+        self.capacity = capacity
+        self.rng = np.random.default_rng(random_seed)
+        self.reservoir = np.empty(capacity, dtype=dtype)
+        self.filled: int = 0
+        self.seen: int = 0
+
+    def add(self, values: np.ndarray) -> None:
+        """
+        Offers a chunk of values to the reservoir
+        """
+        values = np.asarray(values).ravel()
+        # Fill the reservoir first
+        fill = min(self.capacity - self.filled, values.size)
+        self.reservoir[self.filled : self.filled + fill] = values[:fill]
+        self.filled += fill
+        self.seen += fill
+        remaining = values[fill:]
+        if remaining.size == 0:
+            return
+        # The i-th value of the stream (0 based) replaces a random slot with probability
+        # capacity / (i + 1). Later values overwrite earlier ones landing in the same slot,
+        # exactly as if they had been offered one at a time.
+        positions = self.seen + np.arange(1, remaining.size + 1, dtype=np.float64)
+        accepted = remaining[
+            self.rng.random(remaining.size) < self.capacity / positions
+        ]
+        slots = self.rng.integers(0, self.capacity, size=accepted.size)
+        self.reservoir[slots] = accepted
+        self.seen += remaining.size
+
+    def sample(self) -> np.ndarray:
+        """
+        The values currently held in the reservoir
+        """
+        return self.reservoir[: self.filled]
@@ -10,6 +10,7 @@ import numexpr as ne
 
 from app.abstract_classes.data_transformer import DataTransformer
 from app.models.dataset.transformations import Transformation
+from app.models.images.validated_cube import ValidatedCube
 from app.models.units.surface_temperature import Temperature
 
 # Define constants
@@ -32,18 +33,21 @@ class Lc09L2spStTransformer(DataTransformer):
 
     def transform(
         self,
-        input_data: Union[np.ndarray, np.ma.MaskedArray],
+        input_data: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube],
         unit: Temperature = Temperature.KELVIN,
         **kwargs,
-    ) -> Union[np.ndarray, np.array, np.ma.MaskedArray]:
+    ) -> Union[np.ndarray, np.array, np.ma.MaskedArray, ValidatedCube]:
         """
-        Performs the actual transformation
+        Performs the actual transformation.
+        A ValidatedCube comes back as a ValidatedCube sharing the validity of the input.
         """
         try:
             # We want to do this in a manner that avoids any hidden temporary arrays in the background.
             # And can cause MemoryErrors on large datasets. Using NumExpr solves this problem
             # it is also OS agnostic
-            if isinstance(input_data, np.ma.MaskedArray):
+            if isinstance(input_data, ValidatedCube):
+                input_dn_buffer = input_data.data
+            elif isinstance(input_data, np.ma.MaskedArray):
                 input_dn_buffer = input_data.data
             elif isinstance(input_data, np.ndarray):
                 input_dn_buffer = input_data
@@ -75,7 +79,9 @@ class Lc09L2spStTransformer(DataTransformer):
                 )
 
             # Then depending on the input the output is also formatted and masked accordingly
-            if isinstance(input_data, np.ma.MaskedArray):
+            if isinstance(input_data, ValidatedCube):
+                return input_data.with_data(output_data)
+            elif isinstance(input_data, np.ma.MaskedArray):
                 return np.ma.masked_array(output_data, mask=input_data.mask)
             elif isinstance(input_data, np.ndarray):
                 return output_data
@@ -3,21 +3,25 @@ Performs transformation of Prisma Data from DN to surface reflectance
 """
 
 import logging
-from typing import Union, List, Optional
+from typing import Iterator, Union, List, Optional, Tuple
 
 import numpy as np
-import numexpr as ne
 
 from app.abstract_classes.data_transformer import DataTransformer
 from app.models.dataset.transformations import Transformation
 from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
 from app.models.file_processing.file_metadata_models import He5Metadata
-from app.models.images.cube_representation import CubeRepresentation
-from app.utils.image_transformation.image_cube_operations import ImageCubeOperations
+from app.models.images.validated_cube import ValidatedCube
+from app.models.images.cube_representation import (
+    CubeRepresentation,
+    DIMENSION_MAPPING,
+    DIMENSIONAL_ARRANGEMENTS,
+)
 from app.models.hyperspectral_concepts.file_components import (
     HyperspectralFileComponents,
 )
 from app.templates.template_mappings import TEMPLATE_MAPPINGS, TemplateIdentifier
+from app.utils.image_transformation.lazy_cube import LazyCube
 
 
 logger = logging.getLogger("PrsL2dDnToSurfaceReflectanceTransformer")
@@ -25,6 +29,76 @@ logger.setLevel(logging.INFO)
 
 PRISMA_DIV_FACTOR = 65535
 
+# Target number of voxels per chunk of the conversion kernels, sized so that the
+# DN and error chunks stay cache resident between the reflectance and validity passes
+CHUNK_VOXELS = 1 << 21
+
+
+def _factor_shape(ndim: int, representation: CubeRepresentation) -> List[int]:
+    """
+    The shape that broadcasts a per band vector along the channel axis of a cube
+    """
+    factor_shape = [1] * ndim
+    factor_shape[DIMENSION_MAPPING[representation]["C"]] = -1
+    return factor_shape
+
+
+def _chunk_slices(shape: Tuple[int, ...]) -> Iterator[slice]:
+    """
+    Splits the first axis of a cube into chunks of about CHUNK_VOXELS voxels
+    """
+    leading = shape[0]
+    chunk = max(1, CHUNK_VOXELS // max(1, int(np.prod(shape[1:]))))
+    for start in range(0, leading, chunk):
+        yield slice(start, min(start + chunk, leading))
+
+
+def _chunk_factors(factors: np.ndarray, rows: slice, channel_axis: int) -> np.ndarray:
+    """
+    The part of broadcastable per band factors that applies to a chunk of the first axis
+    """
+    return factors[rows] if channel_axis == 0 else factors
+
+
+def _allocate_in_layout(
+    shape: Tuple[int, ...],
+    input_representation: CubeRepresentation,
+    output_representation: CubeRepresentation,
+    dtype: np.dtype,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Allocates a contiguous array in the output layout for a cube of the given input shape.
+    Returns the array and a view of it in the input layout, writing through the view
+    permutes the data on the way in.
+    """
+    input_arrangement = DIMENSIONAL_ARRANGEMENTS[input_representation]
+    output_arrangement = DIMENSIONAL_ARRANGEMENTS[output_representation]
+    output_shape = tuple(
+        shape[input_arrangement.index(dimension)] for dimension in output_arrangement
+    )
+    output = np.empty(output_shape, dtype=dtype)
+    view = output.transpose(
+        [output_arrangement.index(dimension) for dimension in input_arrangement]
+    )
+    return output, view
+
+
+def _view_in_layout(
+    array: np.ndarray,
+    input_representation: CubeRepresentation,
+    output_representation: CubeRepresentation,
+) -> np.ndarray:
+    """
+    A view of an array in another layout, permuting its axes without a copy
+    """
+    input_arrangement = DIMENSIONAL_ARRANGEMENTS[input_representation]
+    return array.transpose(
+        [
+            input_arrangement.index(dimension)
+            for dimension in DIMENSIONAL_ARRANGEMENTS[output_representation]
+        ]
+    )
+
 
 class PrsL2dDnToSurfaceReflectanceTransformer(DataTransformer):
     """
@@ -38,21 +112,37 @@ class PrsL2dDnToSurfaceReflectanceTransformer(DataTransformer):
         Class constructor
         """
         super().__init__(transformation_category=transformation_category)
-        self.cube_operations = ImageCubeOperations()
 
     def transform(
         self,
-        input_data: Union[np.ndarray, np.ma.MaskedArray],
-        cube_representation: CubeRepresentation,
-        band_mapping: List[SpectralFamily],
+        input_data: Union[np.ndarray, np.ma.MaskedArray, LazyCube, ValidatedCube],
+        cube_representation: Optional[CubeRepresentation] = None,
+        band_mapping: Optional[List[SpectralFamily]] = None,
         file_metadata: Optional[He5Metadata] = None,
         masking_indicator: float = 0.0,
-        **kwargs
-    ) -> Union[np.ndarray, np.ma.MaskedArray]:
+        output_representation: Optional[CubeRepresentation] = None,
+        **kwargs,
+    ) -> Union[np.ndarray, np.ma.MaskedArray, ValidatedCube]:
         """
         Transfroms band level hyperspectral data from digital numbers to
         surface reflectance values. Made as generic as possible to avoid
         any linkages with concepts deeply embedded in upstream layers
+
+        The cube is processed in whichever layout it arrives in, the per band factors are
+        broadcast along the channel axis, and the result is written straight into the requested
+        output layout so there is at most one permutation, fused with the computation.
+        A ValidatedCube comes back as a ValidatedCube sharing the validity of the input,
+        viewed in the output layout.
+
+        Args:
+            input_data (Union[np.ndarray, np.ma.MaskedArray, LazyCube, ValidatedCube]): The DN cube
+            cube_representation (Optional[CubeRepresentation]): The layout of the input cube,
+                may be omitted for a LazyCube
+            band_mapping (List[SpectralFamily]): The spectral family of each band in order
+            file_metadata (Optional[He5Metadata]): Metadata holding the L2 scale attributes
+            masking_indicator (float): The DN used in place of masked values
+            output_representation (Optional[CubeRepresentation]): The layout of the output,
+                the input layout if None
         """
 
         # Perform a check to see if the transformation can be supported given the product
@@ -61,9 +151,22 @@ class PrsL2dDnToSurfaceReflectanceTransformer(DataTransformer):
                 "Cannot support this transformation type at present"
             )
 
-        # From a CPU perspective casting everything in BSQ seems to be the
-        # Best fit and hence we will do that
+        if band_mapping is None:
+            raise ValueError("A band mapping is required")
+
+        input_validity: Optional[np.ndarray] = None
+        validated_input_flag = isinstance(input_data, ValidatedCube)
+        if validated_input_flag:
+            input_data, input_validity = input_data.data, input_data.validity
+
+        # Lazy cubes carry their own representation and are processed in their native layout
+        if isinstance(input_data, LazyCube) or cube_representation is None:
+            lazy_input = LazyCube.wrap(input_data, cube_representation)
+            input_data, cube_representation = lazy_input.data, lazy_input.representation
+
         input_representation: CubeRepresentation = cube_representation
+        if output_representation is None:
+            output_representation = input_representation
 
         # The process of conversion will be as follows.
         # We will operate on unmasked numpy arrays only
@@ -74,109 +177,222 @@ class PrsL2dDnToSurfaceReflectanceTransformer(DataTransformer):
         if isinstance(input_data, np.ma.MaskedArray):
             input_array = input_data.data
             masked_input_flag = True
-            input_mask = input_data.mask
+            input_mask = np.ma.getmaskarray(input_data)
         elif isinstance(input_data, np.ndarray):
             input_array = input_data
         else:
             raise TypeError("Format not supported")
 
-        # Shape things up
-        if input_representation == CubeRepresentation.BSQ:
-            pass
-        else:
-            input_array = self.cube_operations.convert_cube(
-                cube=input_array,
-                from_format=input_representation,
-                to_format=CubeRepresentation.BSQ,
-                output_form="numpy",
-            )
-            if masked_input_flag:
-                input_mask = self.cube_operations.convert_cube(
-                    cube=input_mask,
-                    from_format=input_representation,
-                    to_format=CubeRepresentation.BSQ,
-                    output_form="numpy",
-                )
-        # Now we have the input data in the right shape and other the mask if applicable.
-        # One safe bet is to conver the input data array to 0 where ever there is a mask
-        if masked_input_flag:
-            input_array[input_mask] = masking_indicator
-
-        # First we pre-allocate
+        # First we pre-allocate in the output layout and take a view of it in the input layout
         # This means that there will be exactly one array in memory
-        output_data: np.ndarray = np.empty(input_array.shape, dtype=np.float32)
+        output_data, output_view = _allocate_in_layout(
+            shape=input_array.shape,
+            input_representation=input_representation,
+            output_representation=output_representation,
+            dtype=np.float32,
+        )
         logger.info("Output array shape: %s", output_data.shape)
 
-        # Now this is where we need to be a bit careful
-        # We will have SWIR bands and we will have VNIR bands too.
-        # Need to esnure that the scale factors for these bands are applied properly
-        # Or numexpr will have a problem.
-
-        # To make the conversion, based on spectral family
-        # We will need an additive factor and a scaling factor
-        # Additive factor is the min scale
-        # Scaling factor is the max - min divided by the appropriate DIV factor
-        # First construct empty arrays
+        # Shape the per band factors so that they broadcast along the channel axis
         # Remember that shapes are super important or broadcasting will fail
-        scaling_factors = np.empty((input_array.shape[0], 1, 1), dtype=np.float32)
-        additive_factors = np.empty((input_array.shape[0], 1, 1), dtype=np.float32)
-        if self.transformation_category == Transformation.PRS_L2D_DN_TO_SR:
-            # Get the appropriate template
-            template = TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL)
-            # Having got the template we can store the different factors
-            vnir_max = file_metadata.root_metadata.file_attributes.get(
-                template.get(
-                    HyperspectralFileComponents.L2_SCALE_MAX_VNIR
-                ).root_metadata_field_name
+        scale, offset = self.band_factors(
+            band_mapping=band_mapping, file_metadata=file_metadata
+        )
+        factor_shape = _factor_shape(input_array.ndim, input_representation)
+        scaling_factors = scale.reshape(factor_shape)
+        additive_factors = offset.reshape(factor_shape)
+
+        # Now we can actually make the numerical computation, reflectance = dn * SF + AF
+        channel_axis = DIMENSION_MAPPING[input_representation]["C"]
+        for rows in _chunk_slices(input_array.shape):
+            chunk_scale = _chunk_factors(scaling_factors, rows, channel_axis)
+            chunk_offset = _chunk_factors(additive_factors, rows, channel_axis)
+            reflectance_chunk = output_view[rows]
+            np.multiply(input_array[rows], chunk_scale, out=reflectance_chunk)
+            np.add(reflectance_chunk, chunk_offset, out=reflectance_chunk)
+
+        # Masked values are converted as if they held the masking indicator.
+        # The input is left untouched.
+        if validated_input_flag:
+            if input_validity is not None:
+                np.copyto(
+                    output_view,
+                    masking_indicator * scaling_factors + additive_factors,
+                    where=~input_validity,
+                )
+            return ValidatedCube(
+                data=output_data,
+                validity=None
+                if input_validity is None
+                else _view_in_layout(
+                    input_validity, input_representation, output_representation
+                ),
             )
-            vnir_min = file_metadata.root_metadata.file_attributes.get(
-                template.get(
-                    HyperspectralFileComponents.L2_SCALE_MIN_VNIR
-                ).root_metadata_field_name
+        if masked_input_flag:
+            np.copyto(
+                output_view,
+                masking_indicator * scaling_factors + additive_factors,
+                where=input_mask,
             )
-            swir_max = file_metadata.root_metadata.file_attributes.get(
-                template.get(
-                    HyperspectralFileComponents.L2_SCALE_MAX_SWIR
-                ).root_metadata_field_name
+            output_mask, output_mask_view = _allocate_in_layout(
+                shape=input_mask.shape,
+                input_representation=input_representation,
+                output_representation=output_representation,
+                dtype=bool,
             )
-            swir_min = file_metadata.root_metadata.file_attributes.get(
-                template.get(
-                    HyperspectralFileComponents.L2_SCALE_MIN_SWIR
-                ).root_metadata_field_name
+            output_mask_view[...] = input_mask
+            output_data = np.ma.masked_where(output_mask, output_data)
+
+        return output_data
+
+    def band_factors(
+        self, band_mapping: List[SpectralFamily], file_metadata: He5Metadata
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Computes the per band scaling and additive factors as float32 vectors
+        such that reflectance = dn * scale + offset.
+
+        Args:
+            band_mapping (List[SpectralFamily]): The spectral family of each band in order
+            file_metadata (He5Metadata): Metadata holding the L2 scale attributes
+        """
+        if self.transformation_category != Transformation.PRS_L2D_DN_TO_SR:
+            raise NotImplementedError(
+                "Cannot support this transformation type at present"
             )
-            # Then we can compute the swir and vnir additive and scales
-            vnir_add: float = vnir_min
-            vnir_scale: float = (vnir_max - vnir_min) / PRISMA_DIV_FACTOR
-            swir_add: float = swir_min
-            swir_scale: float = (swir_max - swir_min) / PRISMA_DIV_FACTOR
-
-            # Now these are obtained, we can loop and populate the respective factors
-            for i, spectral_family in enumerate(band_mapping):
-                if spectral_family == SpectralFamily.SWIR:
-                    scaling_factors[i] = swir_scale
-                    additive_factors[i] = swir_add
-                elif spectral_family == SpectralFamily.VNIR:
-                    scaling_factors[i] = vnir_scale
-                    additive_factors[i] = vnir_add
-        else:
-            # Nothing to do here
-            # We would have errored out earlier
-            pass
+        # Additive factor is the min scale
+        # Scaling factor is the max - min divided by the appropriate DIV factor
+        template = TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL)
+        file_attributes = file_metadata.root_metadata.file_attributes
 
-        # Now we can actually make the numerical computation
-        vars_dict = {"dn": input_array, "SF": scaling_factors, "AF": additive_factors}
-        ne.evaluate("dn * SF + AF", local_dict=vars_dict, out=output_data)
+        def attribute(component: HyperspectralFileComponents) -> float:
+            return file_attributes.get(template.get(component).root_metadata_field_name)
 
-        # Now we can do the post processing
-        if masked_input_flag:
-            output_data = np.ma.masked_where(input_mask, output_data)
+        vnir_max = attribute(HyperspectralFileComponents.L2_SCALE_MAX_VNIR)
+        vnir_min = attribute(HyperspectralFileComponents.L2_SCALE_MIN_VNIR)
+        swir_max = attribute(HyperspectralFileComponents.L2_SCALE_MAX_SWIR)
+        swir_min = attribute(HyperspectralFileComponents.L2_SCALE_MIN_SWIR)
+        factors = {
+            SpectralFamily.SWIR: ((swir_max - swir_min) / PRISMA_DIV_FACTOR, swir_min),
+            SpectralFamily.VNIR: ((vnir_max - vnir_min) / PRISMA_DIV_FACTOR, vnir_min),
+        }
+
+        scaling_factors = np.empty(len(band_mapping), dtype=np.float32)
+        additive_factors = np.empty(len(band_mapping), dtype=np.float32)
+        for i, spectral_family in enumerate(band_mapping):
+            if spectral_family not in factors:
+                raise ValueError(f"No L2 scale factors for {spectral_family}")
+            scaling_factors[i], additive_factors[i] = factors[spectral_family]
+        return scaling_factors, additive_factors
+
+    def transform_with_validity(
+        self,
+        input_data: Union[np.ndarray, LazyCube],
+        error_data: Union[np.ndarray, LazyCube],
+        cube_representation: Optional[CubeRepresentation],
+        band_mapping: List[SpectralFamily],
+        file_metadata: He5Metadata,
+        band_validity: Optional[np.ndarray] = None,
+        reflectance_out: Optional[np.ndarray] = None,
+        validity_out: Optional[np.ndarray] = None,
+        output_representation: Optional[CubeRepresentation] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Converts DN to surface reflectance and builds the combined validity mask in one fused pass.
 
-        if input_representation == CubeRepresentation.BSQ:
-            return output_data
+        A voxel is valid (1) when its DN is non-zero, its error matrix value is 0 and its band
+        is valid. The cube is walked in chunks along its first axis and every step runs on the
+        same chunk back to back while it is in cache, writing into the outputs in place, so the
+        inputs are streamed from memory once and no full size intermediate masks are created.
+        In place ufuncs are used rather than numexpr, which upcasts the uint16 / uint8 inputs
+        and evaluates broadcast operands element by element and was measured to be slower here.
+        Channel factors are broadcast along whichever axis holds the channels and the outputs
+        are allocated in the requested layout, permuting on the way in.
+
+        Args:
+            input_data (Union[np.ndarray, LazyCube]): The DN cube
+            error_data (Union[np.ndarray, LazyCube]): The error matrix cube, same shape and
+                layout as the DN cube
+            cube_representation (Optional[CubeRepresentation]): The layout of both cubes,
+                may be None for lazy cubes
+            band_mapping (List[SpectralFamily]): The spectral family of each band in order
+            file_metadata (He5Metadata): Metadata holding the L2 scale attributes
+            band_validity (Optional[np.ndarray]): Per band validity flags, all valid if None
+            reflectance_out (Optional[np.ndarray]): A float32 buffer (or view) in the input layout
+                to write reflectance into
+            validity_out (Optional[np.ndarray]): An int8 buffer (or view) in the input layout
+                to write validity into
+            output_representation (Optional[CubeRepresentation]): The layout of outputs that are
+                allocated here, the input layout if None. Supplied buffers are returned as is.
+        """
+        if isinstance(input_data, LazyCube) or cube_representation is None:
+            lazy_input = LazyCube.wrap(input_data, cube_representation)
+            input_data, cube_representation = lazy_input.data, lazy_input.representation
+        error_data = LazyCube.wrap(error_data, cube_representation).data
+        if input_data.shape != error_data.shape:
+            raise ValueError(
+                f"DN cube {input_data.shape} and error cube {error_data.shape} differ in shape"
+            )
+        channel_axis = DIMENSION_MAPPING[cube_representation]["C"]
+        if len(band_mapping) != input_data.shape[channel_axis]:
+            raise ValueError("The band mapping does not match the number of channels")
+
+        scale, offset = self.band_factors(
+            band_mapping=band_mapping, file_metadata=file_metadata
+        )
+        if band_validity is None:
+            band_validity = np.ones(len(band_mapping), dtype=bool)
+        # Shape the per band vectors so that they broadcast along the channel axis
+        factor_shape = _factor_shape(input_data.ndim, cube_representation)
+        scale = scale.reshape(factor_shape)
+        offset = offset.reshape(factor_shape)
+        band_validity = np.asarray(band_validity, dtype=bool).reshape(factor_shape)
+
+        if output_representation is None:
+            output_representation = cube_representation
+        if reflectance_out is None:
+            reflectance_result, reflectance_out = _allocate_in_layout(
+                shape=input_data.shape,
+                input_representation=cube_representation,
+                output_representation=output_representation,
+                dtype=np.float32,
+            )
         else:
-            return self.cube_operations.convert_cube(
-                cube=output_data,
-                from_format=CubeRepresentation.BSQ,
-                to_format=input_representation,
-                output_form="numpy",
+            reflectance_result = reflectance_out
+        if validity_out is None:
+            validity_result, validity_out = _allocate_in_layout(
+                shape=input_data.shape,
+                input_representation=cube_representation,
+                output_representation=output_representation,
+                dtype=np.int8,
             )
+        else:
+            validity_result = validity_out
+        if reflectance_out.shape != input_data.shape or (
+            validity_out.shape != input_data.shape
+        ):
+            raise ValueError("Output buffers must have the shape of the input")
+        # The validity is written as booleans straight into the int8 buffer through a bool view
+        validity_view = validity_out.view(bool)
+
+        # A single reusable scratch buffer for the error check of one chunk
+        error_check = None
+        for rows in _chunk_slices(input_data.shape):
+            chunk_scale = _chunk_factors(scale, rows, channel_axis)
+            chunk_offset = _chunk_factors(offset, rows, channel_axis)
+            chunk_validity = _chunk_factors(band_validity, rows, channel_axis)
+            dn_chunk = input_data[rows]
+            reflectance_chunk = reflectance_out[rows]
+            validity_chunk = validity_view[rows]
+            if error_check is None:
+                error_check = np.empty(dn_chunk.shape, dtype=bool)
+            chunk_error_check = error_check[: dn_chunk.shape[0]]
+            # reflectance = dn * SF + AF
+            np.multiply(dn_chunk, chunk_scale, out=reflectance_chunk)
+            np.add(reflectance_chunk, chunk_offset, out=reflectance_chunk)
+            # validity = (dn != 0) & (err == 0) & band validity
+            np.not_equal(dn_chunk, 0, out=validity_chunk)
+            np.equal(error_data[rows], 0, out=chunk_error_check)
+            np.logical_and(validity_chunk, chunk_error_check, out=validity_chunk)
+            np.logical_and(validity_chunk, chunk_validity, out=validity_chunk)
+        return reflectance_result, validity_result
@@ -0,0 +1,386 @@
+"""
+Vends many Landsat scenes in parallel over a process pool
+"""
+
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.models.dataset.scene_vend_result import SceneVendResult
+from app.models.dataset.vendables import VendableThermalDataset
+from app.models.file_processing.sources import FileSourceConfig
+from app.statistical_models.cloud_masker_registry import CloudMaskerRegistry
+from app.utils.dataset_builder.landsat_dataset_builder import LandsatDataBuilder
+from app.utils.files.metadata_cache import MetadataCache
+
+logger = logging.getLogger("LandsatBatchBuilder")
+logger.setLevel(logging.INFO)
+
+# Describes the arrays a worker left in shared memory and how to rebuild the dataset
+SharedHandoff = Dict[str, Any]
+
+
+def _initialize_worker(numexpr_threads: int) -> None:
+    """
+    Limits the threads of every worker so that the pool does not oversubscribe the cores
+    """
+    import numexpr as ne  # pylint: disable=import-outside-toplevel
+
+    ne.set_num_threads(numexpr_threads)
+
+
+def _share_arrays(arrays: Dict[str, np.ndarray]) -> Dict[str, Dict[str, Any]]:
+    """
+    Copies arrays into new shared memory blocks and describes them.
+    The blocks outlive this process, the receiver unlinks them.
+    """
+    shared = {}
+    try:
+        for name, array in arrays.items():
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared[name] = {
+                "shm": block.name,
+                "shape": list(array.shape),
+                "dtype": array.dtype.str,
+            }
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            block.close()
+    except Exception:
+        _release_arrays(shared)
+        raise
+    return shared
+
+
+class _SharedBlockArray:
+    """
+    Exposes a shared memory block through the array interface. Arrays made from it keep
+    it as their base, so the block stays mapped for as long as any array uses it and is
+    closed once the last one is gone.
+    """
+
+    def __init__(
+        self, block: shared_memory.SharedMemory, shape: List[int], dtype: np.dtype
+    ):
+        self.block = block
+        self.__array_interface__ = np.ndarray(
+            shape, dtype=dtype, buffer=block.buf
+        ).__array_interface__
+
+
+def _collect_arrays(shared: Dict[str, Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """
+    Maps arrays out of shared memory without copying them.
+    The names of the blocks are unlinked straight away, the memory itself is released
+    when the arrays are garbage collected, so nothing is left behind in /dev/shm.
+    """
+    arrays = {}
+    try:
+        for name, entry in shared.items():
+            block = shared_memory.SharedMemory(name=entry["shm"])
+            block.unlink()
+            arrays[name] = np.asarray(
+                _SharedBlockArray(block, entry["shape"], np.dtype(entry["dtype"]))
+            )
+    except Exception:
+        _release_arrays(shared)
+        raise
+    return arrays
+
+
+def _release_arrays(shared: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Unlinks shared memory blocks, ignoring those already gone
+    """
+    for entry in shared.values():
+        try:
+            block = shared_memory.SharedMemory(name=entry["shm"])
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
+
+
+def _vend_scene(
+    index: int,
+    source: FileSourceConfig,
+    vend_kwargs: Dict[str, Any],
+    output_directory: Optional[str],
+    metadata_cache: Optional[MetadataCache],
+    masker_registry: Optional[CloudMaskerRegistry],
+) -> Tuple[SceneVendResult, Optional[SharedHandoff]]:
+    """
+    Vends one scene inside a worker. Any error is caught and returned in the result
+    so that a bad scene never takes the batch down.
+    """
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+    builder = None
+    try:
+        builder = LandsatDataBuilder(
+            file_source_configuration=source,
+            metadata_cache=metadata_cache,
+            masker_registry=masker_registry,
+        )
+        timings["initialize"] = time.perf_counter() - started
+
+        stage_started = time.perf_counter()
+        vendable = builder.vend_dataset(
+            output_directory=output_directory, **vend_kwargs
+        )
+        timings["vend"] = time.perf_counter() - stage_started
+        timings.update(builder.stage_timings)
+
+        stage_started = time.perf_counter()
+        handoff = None
+        if output_directory is not None:
+            # Streaming vends have already saved, saving again only flushes
+            vendable.save(output_directory)
+        else:
+            handoff = {
+                "arrays": _share_arrays(
+                    {
+                        "normalized_thermal_cube": vendable.normalized_thermal_cube,
+                        **vendable.validity_arrays(),
+                    }
+                ),
+                "manifest": vendable.validity_manifest(),
+            }
+        timings["handoff"] = time.perf_counter() - stage_started
+        timings["total"] = time.perf_counter() - started
+        return (
+            SceneVendResult(
+                index=index,
+                source_path=source.source_path,
+                succeeded=True,
+                output_directory=output_directory,
+                timings=timings,
+                worker_pid=os.getpid(),
+            ),
+            handoff,
+        )
+    except Exception:  # pylint: disable=broad-except
+        timings["total"] = time.perf_counter() - started
+        return (
+            SceneVendResult(
+                index=index,
+                source_path=source.source_path,
+                succeeded=False,
+                error=traceback.format_exc(),
+                timings=timings,
+                worker_pid=os.getpid(),
+            ),
+            None,
+        )
+    finally:
+        if builder is not None:
+            builder.close()
+
+
+class LandsatBatchBuilder:
+    """
+    Vends a batch of Landsat scenes over a pool of processes.
+
+    Each scene is read, converted to ST, cloud masked and vended in a worker. At most
+    max_in_flight scenes are submitted at once so that memory stays bounded by the scenes
+    being processed and the results not yet consumed. Datasets come back through shared
+    memory instead of being pickled, or are saved by the workers when an output directory
+    is given. A scene that fails, or whose worker dies, is reported as failed and the rest
+    of the batch carries on.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        numexpr_threads: int = 1,
+        metadata_cache: Optional[MetadataCache] = None,
+        masker_registry: Optional[CloudMaskerRegistry] = None,
+    ):
+        """
+        Class constructor
+
+        Args:
+            max_workers (Optional[int]): The number of worker processes, one per core if None
+            max_in_flight (Optional[int]): The maximum number of scenes submitted at once,
+                max_workers if None
+            numexpr_threads (int): The numexpr threads of every worker
+            metadata_cache (Optional[MetadataCache]): Shared by the builders of every scene
+            masker_registry (Optional[CloudMaskerRegistry]): Shared by the builders of every
+                scene. Stores are atomic so workers can write to it concurrently.
+        """
+        self.max_workers: int = (
+            max_workers if max_workers is not None else os.cpu_count() or 1
+        )
+        self.max_in_flight: int = (
+            max_in_flight if max_in_flight is not None else self.max_workers
+        )
+        if self.max_workers <= 0 or self.max_in_flight <= 0:
+            raise ValueError("max_workers and max_in_flight must be greater than 0")
+        self.numexpr_threads = numexpr_threads
+        self.metadata_cache = metadata_cache
+        self.masker_registry = masker_registry
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # Spawned workers do not inherit the GDAL and numexpr state of the parent
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_initialize_worker,
+            initargs=(self.numexpr_threads,),
+        )
+
+    @staticmethod
+    def _scene_directory(
+        output_directory: Optional[str], index: int, source: FileSourceConfig
+    ) -> Optional[str]:
+        """
+        The subdirectory a scene is saved to, prefixed with its index so names never clash
+        """
+        if output_directory is None:
+            return None
+        stem = os.path.splitext(os.path.basename(source.source_path))[0]
+        return os.path.join(output_directory, f"{index:05d}_{stem}")
+
+    @staticmethod
+    def _collect(
+        result: SceneVendResult, handoff: Optional[SharedHandoff]
+    ) -> SceneVendResult:
+        """
+        Attaches the dataset of a succeeded scene to its result
+        """
+        if not result.succeeded:
+            return result
+        started = time.perf_counter()
+        try:
+            if handoff is not None:
+                arrays = _collect_arrays(handoff["arrays"])
+                result.dataset = VendableThermalDataset(
+                    normalized_thermal_cube=arrays["normalized_thermal_cube"],
+                    **VendableThermalDataset.validity_fields(
+                        arrays, handoff["manifest"]
+                    ),
+                )
+            else:
+                result.dataset = VendableThermalDataset.load(result.output_directory)
+        except Exception:  # pylint: disable=broad-except
+            result.succeeded = False
+            result.error = traceback.format_exc()
+        result.timings["collect"] = time.perf_counter() - started
+        return result
+
+    def iter_vend(
+        self,
+        sources: Sequence[FileSourceConfig],
+        output_directory: Optional[str] = None,
+        **vend_kwargs,
+    ) -> Iterator[SceneVendResult]:
+        """
+        Vends every scene and yields the results as scenes complete.
+        New scenes are only submitted as results are consumed, so a slow consumer
+        holds back the batch instead of accumulating datasets.
+
+        Without an output directory the arrays of a dataset are the shared memory the
+        worker wrote them to, mapped without a copy. That memory is released once the
+        dataset's arrays are garbage collected, drop results once consumed.
+
+        Args:
+            sources (Sequence[FileSourceConfig]): The scenes to vend
+            output_directory (Optional[str]): Save every dataset in its own subdirectory
+                of this directory. Results then hold the saved datasets memory mapped.
+                Combine with streaming=True so workers never hold a scene in memory.
+            vend_kwargs: Passed to LandsatDataBuilder.vend_dataset for every scene
+        """
+        pending = list(enumerate(sources))[::-1]
+        # Every future remembers the generation of the pool it was submitted to
+        in_flight: Dict[Future, Tuple[int, FileSourceConfig, int]] = {}
+        executor = self._new_executor()
+        generation = 0
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.max_in_flight:
+                    index, source = pending.pop()
+                    future = executor.submit(
+                        _vend_scene,
+                        index,
+                        source,
+                        vend_kwargs,
+                        self._scene_directory(output_directory, index, source),
+                        self.metadata_cache,
+                        self.masker_registry,
+                    )
+                    in_flight[future] = (index, source, generation)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    index, source, submitted_to = in_flight.pop(future)
+                    try:
+                        result, handoff = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (e.g. a crash in native code), every scene in
+                        # flight on its pool is reported failed and the pool is replaced
+                        broken = broken or submitted_to == generation
+                        result, handoff = (
+                            SceneVendResult(
+                                index=index,
+                                source_path=source.source_path,
+                                succeeded=False,
+                                error="The worker process terminated abruptly",
+                            ),
+                            None,
+                        )
+                    result = self._collect(result, handoff)
+                    if result.succeeded:
+                        logger.info(
+                            "Vended %s in %.2fs",
+                            result.source_path,
+                            result.timings["total"],
+                        )
+                    else:
+                        logger.error(
+                            "Failed to vend %s: %s", result.source_path, result.error
+                        )
+                    yield result
+                if broken:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    executor = self._new_executor()
+                    generation += 1
+        finally:
+            # Release the results of scenes that were never consumed
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future in in_flight:
+                if future.cancelled() or future.exception() is not None:
+                    continue
+                _, handoff = future.result()
+                if handoff is not None:
+                    _release_arrays(handoff["arrays"])
+
+    def vend(
+        self,
+        sources: Sequence[FileSourceConfig],
+        output_directory: Optional[str] = None,
+        **vend_kwargs,
+    ) -> List[SceneVendResult]:
+        """
+        Vends every scene and returns the results in the order of the sources.
+        Refer to iter_vend for the arguments.
+        """
+        results = list(
+            self.iter_vend(sources, output_directory=output_directory, **vend_kwargs)
+        )
+        return sorted(results, key=lambda result: result.index)
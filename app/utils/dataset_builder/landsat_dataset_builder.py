@@ -2,8 +2,9 @@
 Dataset builder for landsat thermal datasets
 """
 
+import time
 import logging
-from typing import Union
+from typing import Dict, Iterator, Literal, Union, Optional
 
 from pystac import Item
 import numpy as np
@@ -11,8 +12,11 @@ import numpy as np
 from app.abstract_classes.dataset_builder import DatasetBuilder
 from app.abstract_classes.file_helper import FileHelper
 from app.models.dataset.vendables import VendableThermalDataset
+from app.models.dataset.packed_validity import PackedValidity
 from app.utils.stac.stac_utils.stac_items import StacCreator
 from app.models.file_processing.sources import FileSourceConfig
+from app.models.file_processing.file_metadata_models import TIFMetadata
+from app.models.images.validated_cube import ValidatedCube
 from app.utils.image_transformation.image_cube_operations import (
     ImageCubeOperations,
     CubeRepresentation,
@@ -23,12 +27,21 @@ from app.utils.data_transformations.l2sp_dn_to_temperature_transformer import (
 )
 
 from app.statistical_models.b10_adaptive_cloud_masker import B10AdaptiveCloudMasker
+from app.statistical_models.streaming_statistics import DEFAULT_RESERVOIR_SIZE
 from app.models.units.surface_temperature import Temperature
 from app.utils.files.tif_helper import TIFHelper
+from app.utils.files.metadata_cache import MetadataCache
+from app.statistical_models.cloud_masker_registry import (
+    CloudMaskerRegistry,
+    scene_key,
+)
 
 logger = logging.getLogger("LandsatDataBuilder")
 logger.setLevel(logging.INFO)
 
+# Landsat rows are ~8000 pixels wide, a block of 512 rows is ~16 MB of temperatures
+DEFAULT_STREAMING_BLOCK_ROWS = 512
+
 
 class LandsatDataBuilder(DatasetBuilder):
     """
@@ -39,26 +52,60 @@ class LandsatDataBuilder(DatasetBuilder):
     - Convert DN values to ST using the configured transformer.
     - Assemble normalized hyperspectral cube and validity masks for downstream use.
     - Produce a vendable dataset in a canonical BSQ representation.
+
+    After every vend, stage_timings holds the seconds spent reading the scene, converting
+    it to ST, cloud masking it and writing the vendable outputs.
     """
 
-    def __init__(self, file_source_configuration: FileSourceConfig):
+    def __init__(
+        self,
+        file_source_configuration: FileSourceConfig,
+        metadata_cache: Optional[MetadataCache] = None,
+        masker_registry: Optional[CloudMaskerRegistry] = None,
+    ):
         """
         Initializes the builder and prepares metadata and helpers.
+
+        When a metadata cache is supplied, the STAC item and TIF metadata are read from
+        the scene's sidecar if one exists (without opening the file), and written to it otherwise.
+        When a masker registry is supplied, the cloud masker is warm started from the
+        parameters stored for the scene's path/row and month, and its fit is stored back.
         """
         super().__init__(file_source_configuration=file_source_configuration)
-        # Create the STAC item as early as possible for metadata access.
-        logger.info("Creating STAC item for PRISMA dataset.")
-        self._stac_item = StacCreator(
-            file_path=self.file_source_config.source_path
-        ).build_stack()
-        # Load the helper for TIF access and parse band metadata.
-        logger.info("Initializing HE5 helper and extracting band metadata.")
-        self._file_helper: TIFHelper = self.initialize_helper()
-        logger.info("Band metadata loaded for SWIR/VNIR.")
+        self.metadata_cache = metadata_cache
+        self.masker_registry = masker_registry
+        source_path = self.file_source_config.source_path
+        cached_record = (
+            metadata_cache.load(source_path) if metadata_cache is not None else None
+        )
+        if cached_record is not None:
+            logger.info("Loading Landsat metadata from the sidecar cache.")
+            self._file_helper: TIFHelper = self.initialize_helper(
+                file_metadata=MetadataCache.decode_tif_metadata(cached_record)
+            )
+            self._stac_item = Item.from_dict(cached_record.stac_item)
+        else:
+            # Load the helper for TIF access first so that its file handle can be shared.
+            logger.info("Initializing TIF helper and extracting metadata.")
+            self._file_helper: TIFHelper = self.initialize_helper()
+            # Create the STAC item reusing the open dataset for the bounds.
+            logger.info("Creating STAC item for Landsat dataset.")
+            self._stac_item = StacCreator(
+                file_path=source_path,
+                raster_dataset=self._file_helper.dataset,
+            ).build_stack()
+            if metadata_cache is not None:
+                record = metadata_cache.new_record(source_path)
+                MetadataCache.encode_tif_metadata(
+                    record, self._file_helper.file_metadata
+                )
+                record.stac_item = self._stac_item.to_dict(transform_hrefs=False)
+                metadata_cache.store(record)
         self.dn_to_surface_temperature_transformer = Lc09L2spStTransformer()
         self.b10_cloud_masker = B10AdaptiveCloudMasker()
         logger.info("Loaded all transformations")
         self.cube_reshaper = ImageCubeOperations()
+        self.stage_timings: Dict[str, float] = {}
 
     @property
     def stac_item(self) -> Item:
@@ -78,16 +125,19 @@ class LandsatDataBuilder(DatasetBuilder):
     def default_cube_representation(self) -> CubeRepresentation:
         return CubeRepresentation.BSQ
 
-    def initialize_helper(self) -> TIFHelper:
+    def initialize_helper(
+        self, file_metadata: Optional[TIFMetadata] = None
+    ) -> TIFHelper:
         return TIFHelper(
             file_source_config=self.file_source_config,
             template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+            file_metadata=file_metadata,
         )
 
     def _transformation_pipeline(
         self,
-        input_data: Union[np.ndarray, np.ma.MaskedArray],
-    ) -> Union[np.ndarray, np.ma.MaskedArray]:
+        input_data: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube],
+    ) -> Union[np.ndarray, np.ma.MaskedArray, ValidatedCube]:
         """
         A transformation pipeline for the dataset.
         """
@@ -100,44 +150,255 @@ class LandsatDataBuilder(DatasetBuilder):
     def extract_band_information(self) -> None:
         return None
 
-    def vend_dataset(self) -> VendableThermalDataset:
+    def _record_stage(self, stage: str, started: float) -> float:
+        """
+        Adds the time elapsed since started to the stage's timing and returns the current time
+        """
+        now = time.perf_counter()
+        self.stage_timings[stage] = self.stage_timings.get(stage, 0.0) + now - started
+        return now
+
+    def _configure_cloud_masker(
+        self,
+        cloud_masker_engine: Literal["sklearn", "histogram"],
+        cloud_prediction_mode: Literal["labels", "thresholds"],
+        random_seed: Optional[int],
+    ) -> None:
+        """
+        Configures the cloud masker, warm starting from similar scenes when a registry
+        is available
+        """
+        warm_start = None
+        if self.masker_registry is not None:
+            warm_start = self.masker_registry.load(
+                *scene_key(self.file_source_config.source_path)
+            )
+        self.b10_cloud_masker.configure(
+            engine=cloud_masker_engine,
+            prediction_mode=cloud_prediction_mode,
+            random_seed=random_seed,
+            warm_start=warm_start,
+        )
+
+    def _register_cloud_masker(self) -> None:
+        """
+        Stores the fit of the cloud masker when a registry is available
+        """
+        if self.masker_registry is not None:
+            self.masker_registry.store(
+                self.b10_cloud_masker.export_parameters(
+                    *scene_key(self.file_source_config.source_path)
+                )
+            )
+
+    def _stream_temperature_blocks(
+        self,
+        block_rows: int,
+        output_cube: np.ndarray,
+        validity_cube: np.ndarray,
+        pack_validity: bool,
+    ) -> Iterator[ValidatedCube]:
+        """
+        Converts the scene to ST one block of rows at a time, writing every block and its
+        validity into the outputs before yielding it
+        """
+        _, width = self.file_helper.spatial_shape()
+        for window in self.file_helper.iter_windows(
+            tile_height=block_rows, tile_width=width
+        ):
+            started = time.perf_counter()
+            raw_block = self.file_helper.extract_window(window, validated=True)
+            started = self._record_stage("read", started)
+            st_block = self._transformation_pipeline(raw_block)
+            started = self._record_stage("transform", started)
+            output_cube[:, window.row_slice, :] = st_block.data
+            if pack_validity:
+                validity_cube[:, window.row_slice, :] = PackedValidity.pack_block(
+                    st_block.validity_mask()
+                )
+            else:
+                validity_cube[:, window.row_slice, :] = st_block.validity_mask()
+            self._record_stage("write", started)
+            yield st_block
+
+    def _vend_dataset_streaming(
+        self,
+        block_rows: int,
+        output_directory: Optional[str],
+        pack_validity: bool,
+        cloud_masker_engine: Literal["sklearn", "histogram"],
+        cloud_prediction_mode: Literal["labels", "thresholds"],
+        random_seed: Optional[int],
+        reservoir_size: int,
+    ) -> VendableThermalDataset:
+        """
+        Vends the dataset by processing the scene in blocks of rows, in two passes.
+
+        The first pass converts every block to ST straight into the output cube, records its
+        validity and feeds the valid temperatures to the cloud masker, which needs the whole
+        scene before it can predict. The second pass predicts the cloud mask of every block
+        from the output cube and folds it into the validity. Peak memory stays at a few blocks
+        on top of the outputs, which are memory mapped when an output directory is given.
+        """
+        height, width = self.file_helper.spatial_shape()
+        channels = self.file_helper.file_metadata.metadata.get("count").value
+        output_cube = self._allocate_output(
+            "normalized_thermal_cube",
+            (channels, height, width),
+            np.float32,
+            output_directory,
+        )
+        if pack_validity:
+            # Blocks span full rows so each one packs independently along the columns
+            validity_cube = self._allocate_output(
+                "packed_validity_cube",
+                PackedValidity.packed_shape((channels, height, width)),
+                np.uint8,
+                output_directory,
+            )
+            packed_validity = PackedValidity(
+                packed=validity_cube, shape=(channels, height, width)
+            )
+        else:
+            validity_cube = self._allocate_output(
+                "validity_cube", (channels, height, width), np.int8, output_directory
+            )
+
+        # Pass 1, ST conversion and training. The blocks are read, converted and written
+        # while the masker trains, so only the rest of the pass counts as cloud masking
+        started = time.perf_counter()
+        block_stages = sum(self.stage_timings.values())
+        self._configure_cloud_masker(
+            cloud_masker_engine, cloud_prediction_mode, random_seed
+        )
+        self.b10_cloud_masker.train_streaming(
+            self._stream_temperature_blocks(
+                block_rows, output_cube, validity_cube, pack_validity
+            ),
+            reservoir_size=reservoir_size,
+        )
+        self._register_cloud_masker()
+        block_stages = sum(self.stage_timings.values()) - block_stages
+        self.stage_timings["cloud_mask"] = time.perf_counter() - started - block_stages
+
+        # Pass 2, cloud masking, 1 = valid and not clouded
+        started = time.perf_counter()
+        pixels_masked = 0
+        for window in self.file_helper.iter_windows(
+            tile_height=block_rows, tile_width=width
+        ):
+            if pack_validity:
+                block_validity = packed_validity.window(
+                    rows=window.row_slice, cols=slice(None)
+                ).view(np.bool_)
+            else:
+                # A view onto the output, updated in place
+                block_validity = validity_cube[:, window.row_slice, :].view(np.bool_)
+            cloud_detection = self.b10_cloud_masker.predict(
+                ValidatedCube(
+                    data=output_cube[:, window.row_slice, :], validity=block_validity
+                )
+            )
+            pixels_masked += int(cloud_detection.pixels_masked)
+            block_validity &= ~cloud_detection.cloud_mask
+            if pack_validity:
+                validity_cube[:, window.row_slice, :] = PackedValidity.pack_block(
+                    block_validity
+                )
+        logger.info("Clouded Pixels %s", pixels_masked)
+        started = self._record_stage("cloud_mask", started)
+
+        if pack_validity:
+            validity_fields = {"packed_validity": packed_validity}
+        else:
+            validity_fields = {"validity_cube": validity_cube}
+        vendable = VendableThermalDataset(
+            normalized_thermal_cube=output_cube, **validity_fields
+        )
+        if output_directory is not None:
+            # The arrays already live in the directory, saving flushes them and adds the manifest
+            vendable.save(output_directory)
+        self._record_stage("write", started)
+        return vendable
+
+    def vend_dataset(
+        self,
+        pack_validity: bool = False,
+        cloud_masker_engine: Literal["sklearn", "histogram"] = "sklearn",
+        cloud_prediction_mode: Literal["labels", "thresholds"] = "labels",
+        random_seed: Optional[int] = None,
+        streaming: bool = False,
+        block_rows: int = DEFAULT_STREAMING_BLOCK_ROWS,
+        output_directory: Optional[str] = None,
+        reservoir_size: int = DEFAULT_RESERVOIR_SIZE,
+    ) -> VendableThermalDataset:
         """
         Returns a vendable thermal dataset
+
+        Args:
+            pack_validity (bool): Hold the validity cube bit packed, using 8x less memory.
+            cloud_masker_engine (Literal["sklearn", "histogram"]): The engine the B10 cloud
+                masker is trained with, refer to B10AdaptiveCloudMasker.configure.
+            cloud_prediction_mode (Literal["labels", "thresholds"]): How the B10 cloud
+                masker predicts, refer to B10AdaptiveCloudMasker.configure.
+            random_seed (Optional[int]): Seeds the cloud masker so that vending is reproducible.
+            streaming (bool): Process the scene in blocks of rows with a bounded peak memory.
+            block_rows (int): The number of rows per block when streaming.
+            output_directory (Optional[str]): When streaming, write the outputs as memory mapped
+                .npy files in this directory instead of holding them in memory. The directory
+                can be reopened with VendableThermalDataset.load.
+            reservoir_size (int): When streaming, the number of pixels the sklearn engine
+                samples its training data from.
         """
+        self.stage_timings = {}
+        if streaming:
+            return self._vend_dataset_streaming(
+                block_rows=block_rows,
+                output_directory=output_directory,
+                pack_validity=pack_validity,
+                cloud_masker_engine=cloud_masker_engine,
+                cloud_prediction_mode=cloud_prediction_mode,
+                random_seed=random_seed,
+                reservoir_size=reservoir_size,
+            )
 
-        # First collect the thermal image in its native format with masking
+        # First collect the thermal image in its native format with its validity.
+        # The validity is a boolean array (True = valid) and is None when no pixel is invalid,
+        # it is shared by every derived cube without copies.
         logger.info("Collecting raw image")
-        raw_masked_image = self.file_helper.extract_specific_bands(
-            bands=[], masking_needed=True, mode="all"
+        started = time.perf_counter()
+        raw_image = self.file_helper.extract_specific_bands(
+            bands=[], mode="all", validated=True
         )
-        raw_image = raw_masked_image.data
-        # Flips the bits in the raw data mask 1 is valid and 0 is invalid
-        validity_mask = (~raw_masked_image.mask).astype(np.int8)
-        logger.info("Valid pixels %s", validity_mask.sum())
-        logger.info("Validity mask shape %s", validity_mask.shape)
+        logger.info("Valid pixels %s", raw_image.valid_count)
+        started = self._record_stage("read", started)
 
         # Transform the raw image into ST
         st_image = self._transformation_pipeline(raw_image)
-        print(f"Max Temp = {st_image.max()}")
-        print(f"Min Temp = {st_image.min()}")
+        logger.info("Max Temp = %s", st_image.data.max())
+        logger.info("Min Temp = %s", st_image.data.min())
+        started = self._record_stage("transform", started)
 
         # get the cloud masks
-        # Train the masker
-        self.b10_cloud_masker.configure()
-        # Always use the original mask and not the flipped mask
-        self.b10_cloud_masker.train(
-            input_cube=np.ma.MaskedArray(data=st_image, mask=raw_masked_image.mask)
+        # Train the masker, warm starting from similar scenes when a registry is available
+        self._configure_cloud_masker(
+            cloud_masker_engine, cloud_prediction_mode, random_seed
         )
-        cloud_detection = self.b10_cloud_masker.predict(
-            np.ma.MaskedArray(data=st_image, mask=raw_masked_image.mask)
-        )
-        # Flip the cloud mask 0 = cloud, 1 = no cloud
-        cloud_mask = (~cloud_detection.cloud_mask).astype(np.int8)
-        logger.info("Unclouded Pixels %s", cloud_mask.sum())
-        logger.info("Cloud Mask Shape %s", cloud_mask.shape)
-        # Get the overall mask
-        overall_mask = cloud_mask * validity_mask
-
-        return VendableThermalDataset(
-            normalized_thermal_cube=st_image, validity_cube=overall_mask
+        self.b10_cloud_masker.train(input_cube=st_image)
+        self._register_cloud_masker()
+        cloud_detection = self.b10_cloud_masker.predict(st_image)
+        logger.info("Clouded Pixels %s", cloud_detection.pixels_masked)
+        # Get the overall mask, 1 = valid and not clouded
+        overall_mask = ~cloud_detection.cloud_mask
+        if st_image.validity is not None:
+            overall_mask &= st_image.validity
+        overall_mask = overall_mask.view(np.int8)
+        started = self._record_stage("cloud_mask", started)
+
+        vendable = VendableThermalDataset(
+            normalized_thermal_cube=st_image.data, validity_cube=overall_mask
         )
+        if pack_validity:
+            vendable = vendable.pack_validity()
+        self._record_stage("write", started)
+        return vendable
@@ -3,7 +3,7 @@ Concrete implementation of the Prisma Dataset Builder
 """
 
 import logging
-from typing import Dict, Union, List
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 from pystac import Item
@@ -11,9 +11,12 @@ from pystac import Item
 from app.abstract_classes.dataset_builder import DatasetBuilder
 from app.abstract_classes.file_helper import FileHelper
 from app.models.dataset.vendables import VendableHyperspectralDataset
+from app.models.dataset.packed_validity import PackedValidity
 from app.models.file_processing.sources import FileSourceConfig
+from app.models.file_processing.file_metadata_models import He5Metadata
 from app.models.images.cube_representation import CubeRepresentation
 from app.utils.files.he5_helper import HE5Helper
+from app.utils.files.metadata_cache import MetadataCache
 from app.templates.template_mappings import TEMPLATE_MAPPINGS, TemplateIdentifier
 from app.models.hyperspectral_concepts.band import (
     HyperpectralBandInformation,
@@ -31,6 +34,12 @@ from app.utils.stac.stac_utils.stac_items import StacCreator
 logger = logging.getLogger("PrismaDatasetBuilder")
 logger.setLevel(logging.INFO)
 
+# Rows processed per block when vending in streaming mode
+DEFAULT_STREAMING_BLOCK_ROWS = 64
+
+# Families are always vended SWIR followed by VNIR
+PROCESSING_ORDER = [SpectralFamily.SWIR, SpectralFamily.VNIR]
+
 
 class PrismaDatasetBuilder(DatasetBuilder):
     """
@@ -43,20 +52,46 @@ class PrismaDatasetBuilder(DatasetBuilder):
     - Produce a vendable dataset in a canonical BSQ representation.
     """
 
-    def __init__(self, file_source_configuration: FileSourceConfig):
+    def __init__(
+        self,
+        file_source_configuration: FileSourceConfig,
+        metadata_cache: Optional[MetadataCache] = None,
+    ):
         """
         Initializes the builder and prepares metadata and helpers.
+
+        When a metadata cache is supplied, the STAC item, He5 metadata and band tables
+        are read from the scene's sidecar if one exists, and written to it otherwise.
         """
         super().__init__(file_source_configuration=file_source_configuration)
-        # Create the STAC item as early as possible for metadata access.
-        logger.info("Creating STAC item for PRISMA dataset.")
-        self._stac_item = StacCreator(
-            file_path=self.file_source_config.source_path
-        ).build_stack()
-        # Load the helper for HE5 access and parse band metadata.
-        logger.info("Initializing HE5 helper and extracting band metadata.")
-        self._file_helper: HE5Helper = self.initialize_helper()
-        self._band_information = self.extract_band_information()
+        self.metadata_cache = metadata_cache
+        source_path = self.file_source_config.source_path
+        cached_record = (
+            metadata_cache.load(source_path) if metadata_cache is not None else None
+        )
+        if cached_record is not None:
+            logger.info("Loading PRISMA metadata from the sidecar cache.")
+            self._stac_item = Item.from_dict(cached_record.stac_item)
+            self._file_helper: HE5Helper = self.initialize_helper(
+                file_metadata=MetadataCache.decode_he5_metadata(cached_record)
+            )
+            self._band_information = cached_record.band_information
+        else:
+            # Create the STAC item as early as possible for metadata access.
+            logger.info("Creating STAC item for PRISMA dataset.")
+            self._stac_item = StacCreator(file_path=source_path).build_stack()
+            # Load the helper for HE5 access and parse band metadata.
+            logger.info("Initializing HE5 helper and extracting band metadata.")
+            self._file_helper: HE5Helper = self.initialize_helper()
+            self._band_information = self.extract_band_information()
+            if metadata_cache is not None:
+                record = metadata_cache.new_record(source_path)
+                MetadataCache.encode_he5_metadata(
+                    record, self._file_helper.file_metadata
+                )
+                record.band_information = self._band_information
+                record.stac_item = self._stac_item.to_dict(transform_hrefs=False)
+                metadata_cache.store(record)
         logger.info("Band metadata loaded for SWIR/VNIR.")
         self.dn_to_reflectance_transformer = PrsL2dDnToSurfaceReflectanceTransformer()
         logger.info("Loaded all transformations")
@@ -80,30 +115,15 @@ class PrismaDatasetBuilder(DatasetBuilder):
     def default_cube_representation(self) -> CubeRepresentation:
         return CubeRepresentation.BIL
 
-    def initialize_helper(self) -> HE5Helper:
+    def initialize_helper(
+        self, file_metadata: Optional[He5Metadata] = None
+    ) -> HE5Helper:
         return HE5Helper(
             file_source_config=self.file_source_config,
             template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+            file_metadata=file_metadata,
         )
 
-    def _transformation_pipeline(
-        self,
-        input_data: Union[np.ndarray, np.ma.MaskedArray],
-        band_mapping: List[SpectralFamily],
-    ) -> Union[np.ndarray, np.ma.MaskedArray]:
-        """
-        A transformation pipeline for the dataset.
-        """
-        # Convert to reflectance values
-        dn_to_ref_transformed = self.dn_to_reflectance_transformer.transform(
-            input_data=input_data,
-            cube_representation=self.default_cube_representation,
-            band_mapping=band_mapping,
-            file_metadata=self.file_helper.file_metadata,
-            masking_indicator=0,
-        )
-        return dn_to_ref_transformed
-
     def extract_band_information(
         self,
     ) -> Dict[SpectralFamily, HyperpectralBandInformation]:
@@ -191,96 +211,262 @@ class PrismaDatasetBuilder(DatasetBuilder):
         logger.info("Band information extracted for SWIR and VNIR.")
         return output_dict
 
-    def vend_dataset(self) -> VendableHyperspectralDataset:
+    def _fused_pipeline(
+        self,
+        input_data: np.ndarray,
+        error_data: np.ndarray,
+        band_mapping: List[SpectralFamily],
+        band_validity: np.ndarray,
+        reflectance_out: Optional[np.ndarray] = None,
+        validity_out: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Converts a DN cube to reflectance and builds its validity in a single fused pass
+        """
+        return self.dn_to_reflectance_transformer.transform_with_validity(
+            input_data=input_data,
+            error_data=error_data,
+            cube_representation=self.default_cube_representation,
+            band_mapping=band_mapping,
+            file_metadata=self.file_helper.file_metadata,
+            band_validity=band_validity,
+            reflectance_out=reflectance_out,
+            validity_out=validity_out,
+        )
+
+    def _band_order(
+        self, family: SpectralFamily
+    ) -> Tuple[List[int], List[float], List[float]]:
+        """
+        Validity flags, center wavelengths and FWHMs of a family's bands in index order
+        """
+        bands = self.band_information.get(family)
+        indices = sorted([*bands.bands_by_index.keys()])
+        band_validity = []
+        band_cw = []
+        band_fwhm = []
+        for index in indices:
+            band_detail = bands.bands_by_index.get(index)
+            band_validity.append(int(band_detail.is_valid))
+            band_cw.append(band_detail.wavelength)
+            band_fwhm.append(band_detail.full_width_at_half_maximum)
+        return band_validity, band_cw, band_fwhm
+
+    def _channel_layout(self) -> Dict[str, Any]:
+        """
+        Lays out the output channels, SWIR followed by VNIR, with the ordering metadata
+        of every channel and the slice of channels held by each family
+        """
+        layout = {
+            "spectral_family_order": [],
+            "band_validity": [],
+            "band_cw_order": [],
+            "band_fwhm_order": [],
+            "family_channels": {},
+        }
+        for family in PROCESSING_ORDER:
+            family_validity, family_cw, family_fwhm = self._band_order(family)
+            channel_start = len(layout["band_validity"])
+            layout["family_channels"][family] = slice(
+                channel_start, channel_start + len(family_validity)
+            )
+            layout["spectral_family_order"].extend([family] * len(family_validity))
+            layout["band_validity"].extend(family_validity)
+            layout["band_cw_order"].extend(family_cw)
+            layout["band_fwhm_order"].extend(family_fwhm)
+        layout["band_validity"] = np.asarray(layout["band_validity"], dtype=bool)
+        return layout
+
+    def _scene_shape(self) -> Tuple[int, int]:
+        """
+        The spatial shape shared by the SWIR and VNIR cubes
+        """
+        height, width = self.file_helper.spatial_shape(SpectralFamily.SWIR)
+        if self.file_helper.spatial_shape(SpectralFamily.VNIR) != (height, width):
+            raise ValueError("SWIR and VNIR cubes do not share a spatial shape")
+        return height, width
+
+    def _vend_dataset_streaming(
+        self,
+        block_rows: int,
+        output_directory: Optional[str],
+        pack_validity: bool = False,
+    ) -> VendableHyperspectralDataset:
+        """
+        Vends the dataset by processing the scene in blocks of rows.
+
+        The BSQ outputs are preallocated (in memory or memory mapped) and every block is
+        read as a hyperslab and run through the fused reflectance and validity kernel, which
+        writes straight into its slot of the outputs. Only one block of one spectral family is
+        alive at a time, so with C bands, H rows, W columns and Cf bands in the largest family
+        the peak memory is bounded by
+
+            C * H * W * 5 bytes (float32 cube + int8 validity, zero if memory mapped,
+                C * H * W * 4.125 bytes with packed validity)
+            + block_rows * Cf * W * ~20 bytes (DN, error matrix and kernel temporaries)
+
+        independent of the number of blocks.
+        """
+        if block_rows <= 0:
+            raise ValueError("block_rows must be greater than 0")
+        logger.info(
+            "Building vendable hyperspectral dataset in blocks of %d rows.", block_rows
+        )
+
+        layout = self._channel_layout()
+        height, width = self._scene_shape()
+        channels = len(layout["band_validity"])
+
+        output_cube = self._allocate_output(
+            "normalized_hyperspectral_cube",
+            (channels, height, width),
+            np.float32,
+            output_directory,
+        )
+        if pack_validity:
+            # Blocks span full rows so each one packs independently along the columns
+            validity_cube = self._allocate_output(
+                "packed_validity_cube",
+                PackedValidity.packed_shape((channels, height, width)),
+                np.uint8,
+                output_directory,
+            )
+        else:
+            validity_cube = self._allocate_output(
+                "validity_cube", (channels, height, width), np.int8, output_directory
+            )
+
+        for window in self.file_helper.iter_windows(
+            tile_height=block_rows,
+            tile_width=width,
+            spectral_family=SpectralFamily.SWIR,
+        ):
+            for family in PROCESSING_ORDER:
+                channel_slice = layout["family_channels"][family]
+                # BIL blocks of shape (rows, Cf, W)
+                dn_block = self.file_helper.extract_window(
+                    window, spectral_family=family
+                )
+                error_block = self.file_helper.extract_error_window(
+                    window, spectral_family=family
+                )
+                # BIL views onto the BSQ slots so the kernel transposes on the way out
+                _, block_validity = self._fused_pipeline(
+                    input_data=dn_block,
+                    error_data=error_block,
+                    band_mapping=[family] * dn_block.shape[1],
+                    band_validity=layout["band_validity"][channel_slice],
+                    reflectance_out=output_cube[
+                        channel_slice, window.row_slice, :
+                    ].transpose(1, 0, 2),
+                    validity_out=None
+                    if pack_validity
+                    else validity_cube[channel_slice, window.row_slice, :].transpose(
+                        1, 0, 2
+                    ),
+                )
+                if pack_validity:
+                    validity_cube[
+                        channel_slice, window.row_slice, :
+                    ] = PackedValidity.pack_block(block_validity.transpose(1, 0, 2))
+                del dn_block, error_block, block_validity
+
+        logger.info("Vendable dataset assembled. Cube shape: %s", output_cube.shape)
+        if pack_validity:
+            validity_fields = {
+                "packed_validity": PackedValidity(
+                    packed=validity_cube, shape=(channels, height, width)
+                )
+            }
+        else:
+            validity_fields = {"validity_cube": validity_cube}
+        vendable = VendableHyperspectralDataset(
+            normalized_hyperspectral_cube=output_cube,
+            **validity_fields,
+            spectral_family_order=layout["spectral_family_order"],
+            band_cw_order=layout["band_cw_order"],
+            band_fwhm_order=layout["band_fwhm_order"],
+        )
+        if output_directory is not None:
+            # The arrays already live in the directory, saving flushes them and adds the manifest
+            vendable.save(output_directory)
+        return vendable
+
+    def vend_dataset(
+        self,
+        streaming: bool = False,
+        block_rows: int = DEFAULT_STREAMING_BLOCK_ROWS,
+        output_directory: Optional[str] = None,
+        pack_validity: bool = False,
+    ) -> VendableHyperspectralDataset:
         """
         Vends the full hyperspectral dataset that is usable by downstream applications.
         For convention and ease of use, we force it to be a BSQ format in representation.
+
+        Args:
+            streaming (bool): Process the scene in blocks of rows with a bounded peak memory.
+            block_rows (int): The number of rows per block when streaming.
+            output_directory (Optional[str]): When streaming, write the outputs as memory mapped
+                .npy files in this directory instead of holding them in memory. The directory
+                can be reopened with VendableHyperspectralDataset.load.
+            pack_validity (bool): Hold the validity cube bit packed, using 8x less memory.
         """
+        if streaming:
+            return self._vend_dataset_streaming(
+                block_rows=block_rows,
+                output_directory=output_directory,
+                pack_validity=pack_validity,
+            )
 
         # Assemble a normalized cube that merges SWIR and VNIR and build validity masks.
         logger.info("Building vendable hyperspectral dataset.")
 
-        # First we will construct the normalized cube
-        # We will arrange as SWIR followd by VNIR
-        spectral_family_by_position = []
-        band_validity_by_position = []
-        band_cw_by_position = []
-
-        output_cubes = []
-        error_pixel_cubes = []
-        invalid_value_masks = []
+        # We will arrange as SWIR followed by VNIR
+        layout = self._channel_layout()
+        height, width = self._scene_shape()
+        channels = len(layout["band_validity"])
 
-        processing_order = [SpectralFamily.SWIR, SpectralFamily.VNIR]
+        # Preallocate the merged BSQ outputs, each family is written into its channels
+        # through a BIL view so there is no concatenation, no intermediate masks and
+        # the raw BIL cube is permuted to BSQ in the same pass that converts it
+        output_cube = np.empty((channels, height, width), dtype=np.float32)
+        overall_validity_mask = np.empty((channels, height, width), dtype=np.int8)
 
-        for family in processing_order:
+        for family in PROCESSING_ORDER:
             logger.info("Processing spectral family: %s", family)
-            bands = self.band_information.get(family)
-            indices = sorted([*bands.bands_by_index.keys()])
-            # Record ordering, validity flags, and wavelength metadata for downstream use.
-            for index in indices:
-                spectral_family_by_position.append(family)
-                band_detail = bands.bands_by_index.get(index)
-                band_validity_by_position.append(int(band_detail.is_valid))
-                band_cw_by_position.append(band_detail.wavelength)
-
-            # Pull the unnormalized cube for the family and compute validity masks.
+            channel_slice = layout["family_channels"][family]
+            # Pull the unnormalized cube and error matrices for the family.
             unnormalized_cube = self.file_helper.extract_specific_bands(
                 bands=[],
                 masking_needed=False,
                 spectral_family=family,
                 mode="all",
             )
-            # Validity mask where values are non-zero (1 = valid).
-            invalid_value_masks.append((unnormalized_cube != 0.0).astype(np.int8))
-            # Normalize DN values to reflectance.
-            normalized_cube = self._transformation_pipeline(
-                input_data=unnormalized_cube,
-                band_mapping=[family] * unnormalized_cube.shape[1],
-            )
-            output_cubes.append(normalized_cube)
-            # Error pixels are 0 when valid (1 = valid).
             error_pixels = self.file_helper.extract_error_matrices(
                 bands=[], spectral_family=family, mode="all"
             )
-            error_pixel_cubes.append((error_pixels == 0.0).astype(np.int8))
+            # Normalize DN values to reflectance and combine the validity signals (1 = valid).
+            self._fused_pipeline(
+                input_data=unnormalized_cube,
+                error_data=error_pixels,
+                band_mapping=[family] * unnormalized_cube.shape[1],
+                band_validity=layout["band_validity"][channel_slice],
+                reflectance_out=output_cube[channel_slice].transpose(1, 0, 2),
+                validity_out=overall_validity_mask[channel_slice].transpose(1, 0, 2),
+            )
             logger.info(
                 "Family %s processed. Cube shape: %s", family, unnormalized_cube.shape
             )
-
-        logger.info("Concatenating cubes and assembling masks.")
-        output_cube = np.concatenate(output_cubes, axis=1)
-        logger.info("Output Cube Intermediate BIL Shape %s", output_cube.shape)
-        invalid_value_cube = np.concatenate(invalid_value_masks, axis=1)
-        logger.info(
-            "Invalid Value Cube Intermediate BIL Shape %s", invalid_value_cube.shape
-        )
-        error_pixel_cube = np.concatenate(error_pixel_cubes, axis=1)
-        logger.info(
-            "Error Pixel Cube Intermediate BIL Shape %s", error_pixel_cube.shape
-        )
-
-        # Broadcast per-band validity into a cube (1 = valid).
-        band_validity = np.asarray(band_validity_by_position, dtype=np.uint8)
-        valid_band_cube = np.broadcast_to(
-            band_validity[None, :, None], output_cube.shape
-        )
-
-        # Combine all validity signals into a single mask.
-        overall_validity_mask = valid_band_cube * error_pixel_cube * invalid_value_cube
+            del unnormalized_cube, error_pixels
 
         logger.info("Vendable dataset assembled. Cube shape: %s", output_cube.shape)
-        # Reshape and produce vendable
-        return VendableHyperspectralDataset(
-            normalized_hyperspectral_cube=self.cube_reshaper.convert_cube(
-                cube=output_cube,
-                from_format=self.default_cube_representation,
-                to_format=CubeRepresentation.BSQ,
-            ),
-            validity_cube=self.cube_reshaper.convert_cube(
-                cube=overall_validity_mask,
-                from_format=self.default_cube_representation,
-                to_format=CubeRepresentation.BSQ,
-            ),
-            spectral_family_order=spectral_family_by_position,
-            band_cw_order=band_cw_by_position,
+        vendable = VendableHyperspectralDataset(
+            normalized_hyperspectral_cube=output_cube,
+            validity_cube=overall_validity_mask,
+            spectral_family_order=layout["spectral_family_order"],
+            band_cw_order=layout["band_cw_order"],
+            band_fwhm_order=layout["band_fwhm_order"],
         )
+        if pack_validity:
+            return vendable.pack_validity()
+        return vendable
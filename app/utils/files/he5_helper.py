@@ -4,7 +4,7 @@ HE5 files
 """
 
 import logging
-from typing import Dict, Any, Literal, List, Optional, Union
+from typing import Dict, Any, Literal, List, Optional, Union, Tuple
 
 import numpy as np
 import h5py
@@ -17,12 +17,15 @@ from app.models.file_processing.sources import FileSourceConfig
 from app.models.file_processing.file_metadata_models import (
     He5ComponentMetadata,
     He5Metadata,
+    LazyComponentMetadata,
 )
 from app.models.hyperspectral_concepts.file_components import (
     HyperspectralFileComponents,
     ThermalComponents,
 )
 from app.models.hyperspectral_concepts.references import ReferenceDefinition
+from app.models.images.image_window import ImageWindow
+from app.models.images.validated_cube import ValidatedCube
 
 
 logger = logging.getLogger("He5Helper")
@@ -43,9 +46,16 @@ class HE5Helper(FileHelper):
         template: Dict[
             Union[HyperspectralFileComponents, ThermalComponents], ReferenceDefinition
         ],
+        eager_metadata: bool = False,
+        file_metadata: Optional[He5Metadata] = None,
     ):
         """
         Class constructor for file loading
+
+        Component metadata is built lazily on first access unless eager_metadata is set,
+        in which case every component is visited up front. Previously extracted metadata
+        (e.g. from the metadata cache) can be supplied to skip reading the root attributes
+        and visiting the file.
         """
         # Initialize the file loader helper
         super().__init__(file_source_config=file_source_config, template=template)
@@ -57,11 +67,34 @@ class HE5Helper(FileHelper):
         logger.info(
             "Setting file metadata for he5 file %s", self.file_source_config.source_path
         )
-        self._file_metadata: He5Metadata = self._construct_metadata_structure()
+        if file_metadata is not None:
+            # Only the lazy component metadata needs to be wired up to this file
+            file_metadata.component_metadata = LazyComponentMetadata(
+                paths=file_metadata.components, loader=self._build_component_metadata
+            )
+            self._file_metadata: He5Metadata = file_metadata
+        else:
+            self._file_metadata: He5Metadata = self._construct_metadata_structure()
+        if eager_metadata:
+            self._file_metadata.component_metadata.load_all()
 
         # Additional things needed for proper file handling
         self.masked_pixel_value: int = 0
 
+    def close(self) -> None:
+        """
+        Closes the underlying h5py file
+        """
+        self.raw_structure.close()
+
+    def _validated(self, output: np.ndarray) -> ValidatedCube:
+        """
+        Pairs data read from a cube with its validity, pixels holding the masked pixel
+        value being invalid. The validity is dropped when every pixel is valid.
+        """
+        validity = output != self.masked_pixel_value
+        return ValidatedCube(data=output, validity=None if validity.all() else validity)
+
     @property
     def file_metadata(self) -> He5Metadata:
         return self._file_metadata
@@ -70,16 +103,76 @@ class HE5Helper(FileHelper):
     def template(self) -> Dict[HyperspectralFileComponents, ReferenceDefinition]:
         return self._template
 
-    def access_dataset(self, path: str) -> Any:
+    def _get_dataset(self, path: str) -> Dataset:
         """
-        Given a path, returns the dataset at that path
+        Returns the lazy h5py dataset handle at a path without reading any data
         """
         # First check if the path is a dataset
-        if path not in self.file_metadata.components:
+        if path not in self.file_metadata.component_metadata:
             raise TypeError(f"Path {path} not found in the file")
-        if not isinstance(self.raw_structure[path], Dataset):
+        dataset = self.raw_structure[path]
+        if not isinstance(dataset, Dataset):
             raise KeyError(f"Path {path} is not a dataset")
-        return self.raw_structure[path][()]
+        return dataset
+
+    def access_dataset(self, path: str) -> Any:
+        """
+        Given a path, returns the dataset at that path
+        """
+        return self._get_dataset(path)[()]
+
+    def access_hyperslab(
+        self,
+        path: str,
+        bands: Optional[List[int] | int] = None,
+        rows: Optional[slice] = None,
+        cols: Optional[slice] = None,
+    ) -> np.ndarray:
+        """
+        Reads only a hyperslab of a BIL dataset from disk.
+
+        The band selection and the optional row / column window are pushed down into h5py
+        so that only the chunks covering the selection are read and decompressed. This
+        avoids materialising the whole cube when only a handful of bands are needed.
+
+        Args:
+            path (str): The path of the dataset within the file. Assumed to be BIL (H, C, W).
+            bands (Optional[List[int] | int]): Band indices in the order they are wanted.
+                None selects every band.
+            rows (Optional[slice]): Row window. None selects every row.
+            cols (Optional[slice]): Column window. None selects every column.
+        """
+        dataset = self._get_dataset(path)
+        row_selection = rows if rows is not None else slice(None)
+        col_selection = cols if cols is not None else slice(None)
+
+        if bands is None:
+            return dataset[row_selection, :, col_selection]
+
+        band_count = dataset.shape[1]
+        requested = np.atleast_1d(np.asarray(bands, dtype=np.int64))
+        if requested.size == 0:
+            # Nothing to read, but keep the spatial shape consistent
+            return dataset[row_selection, 0:0, col_selection]
+        if requested.min() < -band_count or requested.max() >= band_count:
+            raise IndexError(
+                f"Band indices {requested.tolist()} out of range for {band_count} bands"
+            )
+        requested = np.where(requested < 0, requested + band_count, requested)
+
+        # h5py only accepts strictly increasing indices, so read the unique sorted bands
+        # and restore the requested order (and duplicates) in memory afterwards.
+        unique_bands, inverse = np.unique(requested, return_inverse=True)
+        if unique_bands[-1] - unique_bands[0] + 1 == unique_bands.size:
+            # A contiguous run is a plain slice which HDF5 handles most efficiently
+            band_selection = slice(int(unique_bands[0]), int(unique_bands[-1]) + 1)
+        else:
+            band_selection = unique_bands.tolist()
+        output = dataset[row_selection, band_selection, col_selection]
+
+        if unique_bands.size != requested.size or np.any(np.diff(requested) <= 0):
+            output = output[:, inverse, :]
+        return output
 
     def _get_clean_attrs(self, key_path: str | None = None) -> Dict[str, Any]:
         """
@@ -98,13 +191,31 @@ class HE5Helper(FileHelper):
                 clean_attrs[k] = v
         return clean_attrs
 
+    def _build_component_metadata(self, path: str) -> He5ComponentMetadata:
+        """
+        Builds the metadata for a single component path
+        """
+        component = self.raw_structure[path]
+        metadata = He5ComponentMetadata()
+        metadata.type = type(component)
+        # Check if this is a dataset
+        if isinstance(component, Dataset):
+            metadata.shape = component.shape
+            # We can add a small check to see if it a tensor or a scalar
+            metadata.is_scalar = metadata.shape == ()
+        metadata.file_attributes = self._get_clean_attrs(path)
+        return metadata
+
     def _construct_metadata_structure(self) -> He5Metadata:
         """
-        Constructs a metadata structure for the He5 file
+        Constructs a metadata structure for the He5 file.
+
+        Root metadata is needed by every consumer and is read straight away. Only the
+        component paths are collected for everything else, their metadata is built
+        on first access and cached per file.
         """
         output = He5Metadata()
         metadata_paths = []
-        metadata_structure = {}
 
         # First we need to get the root metadata
         root_meta = He5ComponentMetadata()
@@ -116,61 +227,126 @@ class HE5Helper(FileHelper):
         output.root_metadata = root_meta
 
         # Visit each key in the raw structure and add it to the metadata paths
-        self.raw_structure.visit(lambda name: metadata_paths.append(name))
+        self.raw_structure.visit(metadata_paths.append)
         output.components = metadata_paths
 
-        # Now for each path build up the metdata structure
-        for path in metadata_paths:
-            metadata = He5ComponentMetadata()
-            metadata.type = type(self.raw_structure[path])
-            metadata_structure[path] = metadata
-            # Check if this is a dataset
-            if isinstance(self.raw_structure[path], Dataset):
-                metadata.shape = self.raw_structure[path].shape
-                # We can add a small check to see if it a tensor or a scalar
-                if metadata.shape == ():
-                    metadata.is_scalar = True
-                else:
-                    metadata.is_scalar = False
-            metadata.file_attributes = self._get_clean_attrs(path)
-            output.component_metadata[path] = metadata
+        # Component metadata is populated lazily
+        output.component_metadata = LazyComponentMetadata(
+            paths=metadata_paths, loader=self._build_component_metadata
+        )
         return output
 
+    def _cube_path(
+        self, spectral_family: Optional[SpectralFamily], error_matrix: bool = False
+    ) -> str:
+        """
+        Resolves the file path of the cube (or its error matrix) for a spectral family
+        """
+        if spectral_family == SpectralFamily.SWIR:
+            component = (
+                HyperspectralFileComponents.SWIR_PIXEL_ERR_MATRIX
+                if error_matrix
+                else HyperspectralFileComponents.SWIR_CUBE_DATA
+            )
+        elif spectral_family == SpectralFamily.VNIR:
+            component = (
+                HyperspectralFileComponents.VNIR_PIXEL_ERR_MATRIX
+                if error_matrix
+                else HyperspectralFileComponents.VNIR_CUBE_DATA
+            )
+        else:
+            raise KeyError(
+                "Mapping Key for Spectral Family not found",
+            )
+        return self.template.get(component).file_name
+
+    def spatial_shape(
+        self, spectral_family: Optional[SpectralFamily] = None
+    ) -> Tuple[int, int]:
+        """
+        The (height, width) of the cube of a spectral family.
+        Cubes are BIL so the shape is (H, C, W).
+        """
+        shape = self._get_dataset(self._cube_path(spectral_family)).shape
+        return shape[0], shape[2]
+
+    def extract_window(
+        self,
+        window: ImageWindow,
+        bands: Optional[List[int] | int] = None,
+        masking_needed: Optional[bool] = False,
+        spectral_family: Optional[SpectralFamily] = None,
+        validated: bool = False,
+    ) -> np.ndarray | np.ma.MaskedArray | ValidatedCube:
+        """
+        Extracts a spatial window of a cube as a BIL array.
+        Refer to base class for documentation.
+        With validated, a ValidatedCube of the window and its validity is returned
+        instead of an array, and masking_needed is ignored.
+        """
+        self._validate_window(window, spectral_family=spectral_family)
+        try:
+            output = self.access_hyperslab(
+                self._cube_path(spectral_family),
+                bands=bands,
+                rows=window.row_slice,
+                cols=window.col_slice,
+            )
+            if validated:
+                return self._validated(output)
+            if masking_needed:
+                output = np.ma.masked_where(output == self.masked_pixel_value, output)
+            return output
+        except Exception as err:
+            logger.error("Error in window extraction: %s", str(err))
+            raise err
+
+    def extract_error_window(
+        self,
+        window: ImageWindow,
+        bands: Optional[List[int] | int] = None,
+        spectral_family: Optional[SpectralFamily] = None,
+    ) -> np.ndarray:
+        """
+        Extracts a spatial window of the error matrix of a cube as a BIL array.
+        Applicable for Prisma.
+        """
+        self._validate_window(window, spectral_family=spectral_family)
+        return self.access_hyperslab(
+            self._cube_path(spectral_family, error_matrix=True),
+            bands=bands,
+            rows=window.row_slice,
+            cols=window.col_slice,
+        )
+
     def extract_specific_bands(
         self,
         bands: List[int],
         masking_needed: Optional[bool] = False,
         spectral_family: Optional[SpectralFamily] = None,
         mode: Literal["all", "specific"] = "specific",
-    ) -> np.ndarray | np.ma.MaskedArray:
+        validated: bool = False,
+    ) -> np.ndarray | np.ma.MaskedArray | ValidatedCube:
         """
         Extracts bands from the dataset.
         Refer to base class for documentation.
         Will return a numpy array.
+        With validated, a ValidatedCube of the data and its validity is returned
+        instead of an array, and masking_needed is ignored.
         """
         # First we access the dataset and store it.
         # To do that we need the spectral family
-        if spectral_family == SpectralFamily.SWIR:
-            path = self.template.get(
-                HyperspectralFileComponents.SWIR_CUBE_DATA
-            ).file_name
-        elif spectral_family == SpectralFamily.VNIR:
-            path = self.template.get(
-                HyperspectralFileComponents.VNIR_CUBE_DATA
-            ).file_name
-        else:
-            raise KeyError(
-                "Mapping Key for Spectral Family not found",
-            )
+        path = self._cube_path(spectral_family)
         # Now that we have the path we can perform further operations
         # Access the data in the path
         try:
-            raw_cube = self.access_dataset(path)
-            # Slice out only the bands in the cube that matter
+            # Only the requested bands are read from disk
             if mode == "all":
-                output = raw_cube
+                output = self.access_hyperslab(path)
             elif mode == "specific":
-                output = raw_cube[:, bands, :]
+                output = self.access_hyperslab(path, bands=bands)
+            if validated:
+                return self._validated(output)
             # Check if we need masking
             if masking_needed:
                 output = np.ma.masked_where(output == 0, output)
@@ -195,28 +371,16 @@ class HE5Helper(FileHelper):
         """
         # First we access the dataset and store it.
         # To do that we need the spectral family
-        if spectral_family == SpectralFamily.SWIR:
-            path = self.template.get(
-                HyperspectralFileComponents.SWIR_PIXEL_ERR_MATRIX
-            ).file_name
-        elif spectral_family == SpectralFamily.VNIR:
-            path = self.template.get(
-                HyperspectralFileComponents.VNIR_PIXEL_ERR_MATRIX
-            ).file_name
-        else:
-            raise KeyError(
-                "Mapping Key for Spectral Family not found",
-            )
+        path = self._cube_path(spectral_family, error_matrix=True)
         # Now that we have the path we can perform further operations
         # Access the data in the path
         try:
-            raw_cube = self.access_dataset(path)
-            # Slice out only the bands in the cube that matter
+            # Only the requested bands are read from disk
             output = None
             if mode == "all":
-                output = raw_cube
+                output = self.access_hyperslab(path)
             elif mode == "specific":
-                output = raw_cube[:, bands, :]
+                output = self.access_hyperslab(path, bands=bands)
             return output
         except Exception as err:
             logger.error("Error in band extaction: %s", str(err))
@@ -0,0 +1,208 @@
+"""
+A persistent sidecar cache for scene metadata.
+
+Parsing metadata (file names, bounding boxes, He5 attributes, TIF profiles, band tables)
+is repeated every time a dataset builder is created for a scene. Scenes are touched many
+times by the pipeline, so the results are persisted as a small JSON file per scene keyed by
+the path, size and modification time of the source file. Any change to the file changes
+the key and forces a rebuild.
+"""
+
+import os
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+
+import h5py
+import numpy as np
+from rasterio.transform import Affine
+from rasterio.crs import CRS
+from rasterio.coords import BoundingBox
+
+from app.models.file_processing.file_metadata_models import (
+    He5ComponentMetadata,
+    He5Metadata,
+    SceneMetadataRecord,
+    TIFMetadata,
+    TIFProperty,
+)
+
+logger = logging.getLogger("MetadataCache")
+logger.setLevel(logging.INFO)
+
+# Bump whenever the layout of the record changes so that old sidecars are ignored
+METADATA_CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(
+    os.path.expanduser("~"), ".cache", "hsi_anomaly_foundations", "metadata"
+)
+CACHE_DIRECTORY_ENV_VARIABLE = "HSI_METADATA_CACHE_DIR"
+
+
+def encode_value(value: Any) -> Any:
+    """
+    Recursively converts metadata values into JSON safe values.
+    Types that JSON cannot represent faithfully are tagged so they can be restored.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == "S":
+            items = np.char.decode(value, "utf-8", errors="ignore").tolist()
+        else:
+            items = value.tolist()
+        return {"__ndarray__": items, "dtype": value.dtype.str}
+    if isinstance(value, np.generic):
+        return {"__npscalar__": value.item(), "dtype": value.dtype.str}
+    if isinstance(value, CRS):
+        return {"__crs__": value.to_wkt()}
+    if isinstance(value, Affine):
+        return {"__affine__": list(value)[:6]}
+    if isinstance(value, BoundingBox):
+        return {"__bounds__": list(value)}
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="ignore")
+    if isinstance(value, dict):
+        return {str(key): encode_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"Cannot encode metadata value of type {type(value)}")
+
+
+def decode_value(value: Any) -> Any:
+    """
+    Reverses encode_value
+    """
+    if isinstance(value, dict):
+        if "__ndarray__" in value:
+            return np.asarray(value["__ndarray__"], dtype=np.dtype(value["dtype"]))
+        if "__npscalar__" in value:
+            return np.dtype(value["dtype"]).type(value["__npscalar__"])
+        if "__crs__" in value:
+            return CRS.from_wkt(value["__crs__"])
+        if "__affine__" in value:
+            return Affine(*value["__affine__"])
+        if "__bounds__" in value:
+            return BoundingBox(*value["__bounds__"])
+        return {key: decode_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+class MetadataCache:
+    """
+    Stores and retrieves SceneMetadataRecords as JSON sidecars in a cache directory.
+    """
+
+    def __init__(self, cache_directory: Optional[str] = None):
+        """
+        Class constructor.
+        The cache directory defaults to $HSI_METADATA_CACHE_DIR or a directory under ~/.cache
+        """
+        self.cache_directory: str = cache_directory or os.getenv(
+            CACHE_DIRECTORY_ENV_VARIABLE, DEFAULT_CACHE_DIRECTORY
+        )
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(path: str) -> str:
+        """
+        Fingerprints a file by its absolute path, size and modification time
+        """
+        stats = os.stat(path)
+        key = f"{METADATA_CACHE_VERSION}|{os.path.abspath(path)}|{stats.st_size}|{stats.st_mtime_ns}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _sidecar_path(self, fingerprint: str) -> str:
+        return os.path.join(self.cache_directory, f"{fingerprint}.json")
+
+    def new_record(self, path: str) -> SceneMetadataRecord:
+        """
+        Creates an empty record for a file which can be filled in and stored
+        """
+        return SceneMetadataRecord(
+            fingerprint=self.fingerprint(path), source_path=os.path.abspath(path)
+        )
+
+    def load(self, path: str) -> Optional[SceneMetadataRecord]:
+        """
+        Returns the cached record for a file or None if there is no valid record
+        """
+        sidecar_path = self._sidecar_path(self.fingerprint(path))
+        if not os.path.exists(sidecar_path):
+            return None
+        try:
+            with open(sidecar_path, "r", encoding="utf-8") as sidecar:
+                return SceneMetadataRecord.model_validate_json(sidecar.read())
+        except Exception as err:  # pylint: disable=broad-except
+            # A broken sidecar is never fatal, the metadata is simply rebuilt
+            logger.warning("Ignoring unreadable sidecar %s: %s", sidecar_path, err)
+            return None
+
+    def store(self, record: SceneMetadataRecord) -> str:
+        """
+        Writes a record to the cache and returns the sidecar path.
+        The write is atomic so concurrent readers never see a partial file.
+        """
+        sidecar_path = self._sidecar_path(record.fingerprint)
+        temporary_path = f"{sidecar_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as sidecar:
+            sidecar.write(record.model_dump_json())
+        os.replace(temporary_path, sidecar_path)
+        return sidecar_path
+
+    @staticmethod
+    def encode_he5_metadata(
+        record: SceneMetadataRecord, metadata: He5Metadata
+    ) -> SceneMetadataRecord:
+        """
+        Stores the root attributes and component paths of He5 metadata on a record.
+        Component metadata is not stored, it is rebuilt lazily from the file.
+        """
+        record.root_file_attributes = encode_value(
+            metadata.root_metadata.file_attributes or {}
+        )
+        record.components = list(metadata.components)
+        return record
+
+    @staticmethod
+    def decode_he5_metadata(record: SceneMetadataRecord) -> Optional[He5Metadata]:
+        """
+        Restores He5 metadata from a record if it holds any
+        """
+        if record.root_file_attributes is None or record.components is None:
+            return None
+        root_metadata = He5ComponentMetadata(
+            type=h5py.File,
+            shape=None,
+            is_scalar=False,
+            file_attributes=decode_value(record.root_file_attributes),
+        )
+        return He5Metadata(components=record.components, root_metadata=root_metadata)
+
+    @staticmethod
+    def encode_tif_metadata(
+        record: SceneMetadataRecord, metadata: TIFMetadata
+    ) -> SceneMetadataRecord:
+        """
+        Stores the metadata properties of a TIF file on a record
+        """
+        record.tif_properties = {
+            key: encode_value(tif_property.value)
+            for key, tif_property in metadata.metadata.items()
+        }
+        return record
+
+    @staticmethod
+    def decode_tif_metadata(record: SceneMetadataRecord) -> Optional[TIFMetadata]:
+        """
+        Restores TIF metadata from a record if it holds any
+        """
+        if record.tif_properties is None:
+            return None
+        properties: Dict[str, TIFProperty] = {
+            key: TIFProperty(name=key, value=decode_value(value))
+            for key, value in record.tif_properties.items()
+        }
+        return TIFMetadata(metadata=properties)
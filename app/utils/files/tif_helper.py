@@ -2,16 +2,20 @@
 Implements a concrete TIFHelper class
 """
 
-from typing import Dict, List, Optional, Literal
+from typing import Dict, List, Optional, Literal, Tuple
 import logging
 
 import numpy as np
 import rasterio
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
 from app.models.file_processing.sources import FileSourceConfig
 from app.models.file_processing.file_metadata_models import TIFMetadata, TIFProperty
 from app.models.hyperspectral_concepts.file_components import ThermalComponents
 from app.models.hyperspectral_concepts.references import ReferenceDefinition
 from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
+from app.models.images.image_window import ImageWindow
+from app.models.images.validated_cube import ValidatedCube
 from app.abstract_classes.file_helper import FileHelper
 
 
@@ -22,19 +26,55 @@ logger.setLevel(logging.INFO)
 class TIFHelper(FileHelper):
     """
     A helper class for working with tif files.
+
+    The helper keeps a single rasterio dataset handle open for its lifetime and every
+    read (metadata, bands, windows, bounds) goes through it. Close it explicitly with
+    close() or use the helper as a context manager.
     """
 
     def __init__(
         self,
         file_source_config: FileSourceConfig,
         template: Dict[ThermalComponents, ReferenceDefinition],
+        file_metadata: Optional[TIFMetadata] = None,
     ):
         """
         Class constructor for file loading
+
+        Previously extracted metadata (e.g. from the metadata cache) can be supplied,
+        in which case the file is not opened until data is actually read.
         """
         super().__init__(file_source_config=file_source_config, template=template)
         self._file_source_config: FileSourceConfig = file_source_config
-        self._file_metadata: TIFMetadata = self._construct_metadata_structure()
+        # The number of times the file has been opened. Useful to catch regressions where
+        # the file is opened repeatedly.
+        self.open_count: int = 0
+        self._dataset: Optional[DatasetReader] = None
+        self._file_metadata: TIFMetadata = (
+            file_metadata
+            if file_metadata is not None
+            else self._construct_metadata_structure()
+        )
+
+    @property
+    def dataset(self) -> DatasetReader:
+        """
+        The open rasterio dataset handle. Opened on first access and re-opened
+        if accessed after the helper has been closed.
+        """
+        if self._dataset is None or self._dataset.closed:
+            logger.debug("Opening TIF file: %s", self.file_source_config.source_path)
+            self._dataset = rasterio.open(self.file_source_config.source_path)
+            self.open_count += 1
+        return self._dataset
+
+    def close(self) -> None:
+        """
+        Closes the rasterio dataset handle if it is open
+        """
+        if self._dataset is not None and not self._dataset.closed:
+            self._dataset.close()
+        self._dataset = None
 
     @property
     def file_metadata(self) -> TIFMetadata:
@@ -59,11 +99,14 @@ class TIFHelper(FileHelper):
             self.file_source_config.source_path,
         )
 
+        # Everything is pulled from the same handle
+        src = self.dataset
+
         # First pull information from profile
         logger.debug(
             "Pulling information from profile: %s", self.file_source_config.source_path
         )
-        profile = rasterio.open(self.file_source_config.source_path).profile
+        profile = src.profile
         for key, value in profile.items():
             property_dict[key] = TIFProperty(name=key, value=value)
 
@@ -71,7 +114,7 @@ class TIFHelper(FileHelper):
         logger.debug(
             "Pulling information from tags: %s", self.file_source_config.source_path
         )
-        tags = rasterio.open(self.file_source_config.source_path).tags()
+        tags = src.tags()
         for key, value in tags.items():
             property_dict[key] = TIFProperty(name=key, value=value)
 
@@ -79,10 +122,28 @@ class TIFHelper(FileHelper):
         logger.debug(
             "Pulling information from bounds: %s", self.file_source_config.source_path
         )
-        bounds = rasterio.open(self.file_source_config.source_path).bounds
+        bounds = src.bounds
         property_dict["bounds"] = TIFProperty(name="bounds", value=bounds)
         return TIFMetadata(metadata=property_dict)
 
+    def _read(
+        self,
+        bands: Optional[List[int]],
+        window: Optional[Window],
+        masking_needed: bool,
+        validated: bool,
+    ) -> np.ma.MaskedArray | np.ndarray | ValidatedCube:
+        """
+        Reads bands (all bands if None) from the whole raster or a window.
+        With validated, the data is read unmasked and paired with the dataset validity masks
+        as a boolean validity, which is dropped when every pixel is valid.
+        """
+        if not validated:
+            return self.dataset.read(bands, window=window, masked=masking_needed)
+        data = self.dataset.read(bands, window=window)
+        validity = self.dataset.read_masks(bands, window=window) != 0
+        return ValidatedCube(data=data, validity=None if validity.all() else validity)
+
     # spectral family need not be relevant for TIF files and thermal datasets
     # But since the abstract class defines the method, it is kept here are optional with a default of none
     # The value will not be used.
@@ -92,10 +153,13 @@ class TIFHelper(FileHelper):
         masking_needed: bool = False,
         spectral_family: Optional[SpectralFamily] = None,
         mode: Literal["all", "specific"] = "specific",
-    ) -> np.ma.MaskedArray | np.ndarray:
+        validated: bool = False,
+    ) -> np.ma.MaskedArray | np.ndarray | ValidatedCube:
         """
         Extracts bands from the TIF file.
         Refer to the base class for method docstring.
+        With validated, a ValidatedCube of the data and its validity is returned
+        instead of an array, and masking_needed is ignored.
         """
         if isinstance(bands, int):
             bands = [bands]
@@ -105,16 +169,16 @@ class TIFHelper(FileHelper):
             self.file_source_config.source_path,
         )
         try:
-            with rasterio.open(self.file_source_config.source_path) as src:
-                # Read only specific bands or read in all the bands.
-                # Notice here that the masking concepts are slightly different and need
-                # some refinement. The mask is already coming out as part of the dataset pull.
-                # This is great, but needs some more work to understand fully.
-                if mode == "specific":
-                    band_data = src.read(bands, masked=masking_needed)
-                else:
-                    band_data = src.read(masked=masking_needed)
-            return band_data
+            # Read only specific bands or read in all the bands.
+            # Notice here that the masking concepts are slightly different and need
+            # some refinement. The mask is already coming out as part of the dataset pull.
+            # This is great, but needs some more work to understand fully.
+            return self._read(
+                bands if mode == "specific" else None,
+                window=None,
+                masking_needed=masking_needed,
+                validated=validated,
+            )
         except Exception as e:
             logger.error(
                 "Error extracting bands %s from %s : %s",
@@ -123,3 +187,53 @@ class TIFHelper(FileHelper):
                 e,
             )
             raise e
+
+    def spatial_shape(
+        self, spectral_family: Optional[SpectralFamily] = None
+    ) -> Tuple[int, int]:
+        """
+        The (height, width) of the raster as recorded in its profile.
+        Spectral family is not relevant for TIF files.
+        """
+        return (
+            self.file_metadata.metadata.get("height").value,
+            self.file_metadata.metadata.get("width").value,
+        )
+
+    def extract_window(
+        self,
+        window: ImageWindow,
+        bands: Optional[List[int] | int] = None,
+        masking_needed: Optional[bool] = False,
+        spectral_family: Optional[SpectralFamily] = None,
+        validated: bool = False,
+    ) -> np.ndarray | np.ma.MaskedArray | ValidatedCube:
+        """
+        Extracts a spatial window from the TIF file as a BSQ array using a rasterio Window read.
+        Bands are 1-indexed as in rasterio. Refer to the base class for method docstring.
+        With validated, a ValidatedCube of the window and its validity is returned.
+        """
+        self._validate_window(window)
+        if isinstance(bands, int):
+            bands = [bands]
+        raster_window = Window(
+            col_off=window.col_offset,
+            row_off=window.row_offset,
+            width=window.width,
+            height=window.height,
+        )
+        try:
+            return self._read(
+                bands,
+                window=raster_window,
+                masking_needed=masking_needed,
+                validated=validated,
+            )
+        except Exception as e:
+            logger.error(
+                "Error extracting window %s from %s : %s",
+                window,
+                self.file_source_config.source_path,
+                e,
+            )
+            raise e
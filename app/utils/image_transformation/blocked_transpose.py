@@ -0,0 +1,122 @@
+"""
+Cache blocked out of place transposition of image cubes
+"""
+
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Tile edge (in elements) along the axes that are contiguous in the source or in the output
+DEFAULT_BLOCK_EDGE = 256
+# Tile edge along every other axis
+DEFAULT_BLOCK_DEPTH = 4
+
+
+def plan_tiles(
+    shape: Sequence[int],
+    permutation: Sequence[int],
+    block_edge: int = DEFAULT_BLOCK_EDGE,
+    block_depth: int = DEFAULT_BLOCK_DEPTH,
+) -> Tuple[int, ...]:
+    """
+    Chooses the tile shape, in output axes, for transposing a cube of the given source shape.
+
+    A plain strided copy reads the source along its contiguous (last) axis with a large stride
+    in the output, or the other way around, and misses the cache on nearly every element when
+    the contiguous axis moves. Tiles are long (block_edge) along both the source and the output
+    contiguous axes and thin (block_depth) along the rest, so each tile reads and writes
+    block_edge long runs and fits in cache.
+    When the contiguous axis stays in place the copy is already row by row and is only split
+    into slabs along the leading output axis.
+
+    Args:
+        shape (Sequence[int]): The shape of the source cube
+        permutation (Sequence[int]): The axes of the source in output order
+        block_edge (int): The tile edge along the contiguous axes
+        block_depth (int): The tile edge along the other axes
+    """
+    if block_edge <= 0 or block_depth <= 0:
+        raise ValueError("Block sizes must be greater than 0")
+    ndim = len(shape)
+    last_axis = ndim - 1
+    output_shape = [shape[axis] for axis in permutation]
+    if permutation[last_axis] == last_axis:
+        # Already a copy of contiguous rows, only split the leading axis into slabs
+        # so that workers have something to share
+        return (1,) + tuple(output_shape[1:])
+    tile = [block_depth] * ndim
+    tile[last_axis] = block_edge
+    tile[list(permutation).index(last_axis)] = block_edge
+    return tuple(min(edge, extent) for edge, extent in zip(tile, output_shape))
+
+
+def _tile_slices(
+    output_shape: Sequence[int], tile: Sequence[int]
+) -> List[Tuple[slice, ...]]:
+    """
+    All tiles of the output as tuples of slices
+    """
+    ranges = [range(0, extent, edge) for extent, edge in zip(output_shape, tile)]
+    return [
+        tuple(slice(start, start + edge) for start, edge in zip(starts, tile))
+        for starts in itertools.product(*ranges)
+    ]
+
+
+def blocked_transpose(
+    array: np.ndarray,
+    permutation: Sequence[int],
+    out: Optional[np.ndarray] = None,
+    block_edge: int = DEFAULT_BLOCK_EDGE,
+    block_depth: int = DEFAULT_BLOCK_DEPTH,
+    workers: int = 1,
+) -> np.ndarray:
+    """
+    Transposes an array out of place, tile by tile.
+
+    Args:
+        array (np.ndarray): The source array
+        permutation (Sequence[int]): The axes of the source in output order, as in np.transpose
+        out (Optional[np.ndarray]): A buffer of the transposed shape and the source dtype to
+            write into. A contiguous buffer is allocated if None.
+        block_edge (int): The tile edge along the contiguous axes
+        block_depth (int): The tile edge along the other axes
+        workers (int): The number of threads copying tiles. Numpy releases the GIL while
+            copying so tiles are copied in parallel.
+    """
+    if sorted(permutation) != list(range(array.ndim)):
+        raise ValueError(f"{permutation} is not a permutation of {array.ndim} axes")
+    if workers <= 0:
+        raise ValueError("workers must be greater than 0")
+    source = np.transpose(array, permutation)
+    if out is None:
+        out = np.empty(source.shape, dtype=array.dtype)
+    elif out.shape != source.shape or out.dtype != array.dtype:
+        raise ValueError(
+            f"Output buffer {out.shape} {out.dtype} does not match {source.shape} {array.dtype}"
+        )
+    elif np.shares_memory(out, array):
+        raise ValueError("The output buffer must not overlap the source")
+
+    tiles = _tile_slices(
+        source.shape, plan_tiles(array.shape, permutation, block_edge, block_depth)
+    )
+
+    def copy_tiles(tile_group: List[Tuple[slice, ...]]) -> None:
+        for tile in tile_group:
+            out[tile] = source[tile]
+
+    if workers == 1 or len(tiles) == 1:
+        copy_tiles(tiles)
+    else:
+        # Contiguous runs of tiles per worker keep each thread's writes close together
+        group_size = -(-len(tiles) // workers)
+        groups = [
+            tiles[start : start + group_size]
+            for start in range(0, len(tiles), group_size)
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(copy_tiles, groups))
+    return out
@@ -2,8 +2,8 @@
 Perform transformation operations on image cubes
 """
 
-from typing import Dict, List, Literal, Union
-import torch
+import sys
+from typing import TYPE_CHECKING, Dict, List, Literal, Optional, Tuple, Union
 import numpy as np
 
 from app.models.images.cube_representation import (
@@ -11,13 +11,30 @@ from app.models.images.cube_representation import (
     DIMENSION_MAPPING,
     DIMENSIONAL_ARRANGEMENTS,
 )
+from app.models.images.validated_cube import ValidatedCube
+from app.utils.image_transformation.blocked_transpose import blocked_transpose
 from app.utils.torch_helpers.device_selection import get_device
 
+if TYPE_CHECKING:
+    import torch
+
+
+def is_tensor(cube: object) -> bool:
+    """
+    Whether an object is a torch tensor, without importing torch.
+    If torch has never been imported nothing can be a tensor.
+    """
+    torch_module = sys.modules.get("torch")
+    return torch_module is not None and isinstance(cube, torch_module.Tensor)
+
 
 class ImageCubeOperations:
     """
     Operations on an image cube to transform it into multiple
     representations.
+
+    Construction is cheap: torch is only imported, and the device only selected, when the
+    torch backend is first used. The numpy and blocked backends never touch torch.
     """
 
     def __init__(self):
@@ -25,19 +42,83 @@ class ImageCubeOperations:
         self.arrangements: Dict[CubeRepresentation, List[str]] = (
             DIMENSIONAL_ARRANGEMENTS
         )
-        self.device = get_device()
-        print(f"Using device: {self.device}")
+
+    @property
+    def device(self) -> "torch.device":
+        """
+        The device used by the torch backend, selected once per process
+        """
+        return get_device()
+
+    def permutation(
+        self, from_format: CubeRepresentation, to_format: CubeRepresentation
+    ) -> Tuple[int, ...]:
+        """
+        The axis permutation that takes a cube from one format to another
+        """
+        from_dim_map = self.dimension_map.get(from_format)
+        to_dim_arrangement = self.arrangements.get(to_format)
+        return tuple(
+            from_dim_map.get(dim)
+            for dim in to_dim_arrangement  # pyright: ignore[reportOptionalIterable]
+        )
 
     def convert_cube(
         self,
-        cube: Union[np.ndarray, np.ma.MaskedArray, torch.Tensor],
+        cube: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube, "torch.Tensor"],
         from_format: CubeRepresentation,
         to_format: CubeRepresentation,
         output_form: Literal["tensor", "numpy"] = "numpy",
-    ) -> Union[torch.Tensor, np.ndarray, np.ma.MaskedArray]:
+        backend: Literal["auto", "torch", "numpy", "blocked"] = "auto",
+        contiguous: bool = False,
+        out: Optional[np.ndarray] = None,
+        workers: int = 1,
+    ) -> Union["torch.Tensor", np.ndarray, np.ma.MaskedArray, ValidatedCube]:
         """
         Converts a cube from one format to another
+
+        Args:
+            cube (Union[np.ndarray, np.ma.MaskedArray, ValidatedCube, torch.Tensor]): The cube
+                to convert. A ValidatedCube is converted with its validity by the numpy or
+                blocked backends, a missing validity stays missing.
+            from_format (CubeRepresentation): The current format of the cube
+            to_format (CubeRepresentation): The format to convert to
+            output_form (Literal["tensor", "numpy"]): Whether to return a tensor or a numpy array
+            backend (Literal["auto", "torch", "numpy", "blocked"]): The backend that permutes
+                the cube. "auto" uses numpy when both the input and the output are numpy arrays.
+                "blocked" copies into a contiguous output tile by tile, which is cache friendly
+                for full scene conversions that move the contiguous axis.
+            contiguous (bool): With the numpy backend, return a contiguous array, copied once
+                unless the permuted cube is already contiguous. By default a zero-copy
+                (non contiguous) view of the input is returned, as the torch backend does on CPU.
+            out (Optional[np.ndarray]): With the numpy or blocked backends, a buffer of the
+                converted shape and dtype to write the (unmasked) data into.
+            workers (int): With the blocked backend, the number of threads copying tiles.
         """
+        if backend == "auto":
+            backend = (
+                "numpy"
+                if isinstance(cube, (np.ndarray, ValidatedCube))
+                and output_form == "numpy"
+                else "torch"
+            )
+        if backend in ("numpy", "blocked"):
+            return self._convert_cube_numpy(
+                cube=cube,
+                from_format=from_format,
+                to_format=to_format,
+                output_form=output_form,
+                contiguous=contiguous,
+                blocked=backend == "blocked",
+                out=out,
+                workers=workers,
+            )
+        if backend != "torch":
+            raise ValueError(f"Invalid backend: {backend}")
+        if isinstance(cube, ValidatedCube):
+            raise ValueError("Validated cubes are converted by the numpy backends only")
+        import torch  # pylint: disable=import-outside-toplevel
+
         # We will need to handled masked cubes in a special manner
         # The idea is that if the input is a masked array and the output from is numpy
         # Then, we must return as masked array as default behavior/
@@ -67,12 +148,7 @@ class ImageCubeOperations:
                 cube = cube.float()
             cube = cube.to(self.device)
         # For the from format, get the dimension_map
-        from_dim_map = self.dimension_map.get(from_format)
-        to_dim_arrangement = self.arrangements.get(to_format)
-        final_permutation_arrangement = tuple(
-            from_dim_map.get(dim)
-            for dim in to_dim_arrangement  # pyright: ignore[reportOptionalIterable]
-        )
+        final_permutation_arrangement = self.permutation(from_format, to_format)
         transformed = cube.permute(*final_permutation_arrangement)
         transformed_mask = None
         if is_masked_input:
@@ -90,3 +166,51 @@ class ImageCubeOperations:
             return transformed.detach().cpu().numpy()
         else:
             raise ValueError(f"Invalid output form: {output_form}")
+
+    def _convert_cube_numpy(
+        self,
+        cube: Union[np.ndarray, np.ma.MaskedArray, ValidatedCube, "torch.Tensor"],
+        from_format: CubeRepresentation,
+        to_format: CubeRepresentation,
+        output_form: Literal["tensor", "numpy"],
+        contiguous: bool,
+        blocked: bool = False,
+        out: Optional[np.ndarray] = None,
+        workers: int = 1,
+    ) -> Union[np.ndarray, np.ma.MaskedArray, ValidatedCube]:
+        """
+        Permutes a cube with numpy alone. The dtype is preserved and nothing is moved to a device,
+        the result is either a view of the input or a single contiguous copy, made with a plain
+        strided copy or tile by tile when blocked.
+        """
+        if output_form != "numpy":
+            raise ValueError("The numpy backend can only produce numpy outputs")
+        if is_tensor(cube):
+            cube = cube.detach().cpu().numpy()
+        permutation = self.permutation(from_format, to_format)
+
+        def permute(
+            array: np.ndarray, buffer: Optional[np.ndarray] = None
+        ) -> np.ndarray:
+            if blocked:
+                return blocked_transpose(
+                    array, permutation, out=buffer, workers=workers
+                )
+            transposed = np.transpose(array, permutation)
+            if buffer is not None:
+                np.copyto(buffer, transposed)
+                return buffer
+            return np.ascontiguousarray(transposed) if contiguous else transposed
+
+        if isinstance(cube, ValidatedCube):
+            return ValidatedCube(
+                data=permute(cube.data, out),
+                validity=None if cube.validity is None else permute(cube.validity),
+            )
+        if isinstance(cube, np.ma.MaskedArray):
+            mask = np.ma.getmask(cube)
+            return np.ma.MaskedArray(
+                data=permute(cube.data, out),
+                mask=mask if mask is np.ma.nomask else permute(mask),
+            )
+        return permute(cube, out)
@@ -0,0 +1,192 @@
+"""
+A lazy view of an image cube that defers layout conversions
+"""
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from app.models.images.cube_representation import (
+    CubeRepresentation,
+    DIMENSION_MAPPING,
+)
+from app.utils.image_transformation.image_cube_operations import ImageCubeOperations
+
+CubeArray = Union[np.ndarray, np.ma.MaskedArray]
+
+
+class LazyCube:
+    """
+    Wraps a cube together with its representation.
+
+    Bands, pixels and windows are read straight from the cube in its native layout and only the
+    part that is asked for is materialised. Full layout conversions are memoised so that a
+    scene is permuted at most once per layout no matter how many consumers ask for it.
+    """
+
+    def __init__(self, data: CubeArray, representation: CubeRepresentation):
+        """
+        Class constructor
+
+        Args:
+            data (CubeArray): A 3D cube, masked or not
+            representation (CubeRepresentation): The layout of the cube
+        """
+        if data.ndim != 3:
+            raise ValueError(f"Expected a 3D cube, got {data.ndim}D")
+        self._data = data
+        self._representation = CubeRepresentation(representation)
+        self._layouts: Dict[CubeRepresentation, CubeArray] = {
+            self._representation: data
+        }
+        self._cube_operations: Optional[ImageCubeOperations] = None
+
+    @classmethod
+    def wrap(
+        cls,
+        cube: Union["LazyCube", CubeArray],
+        representation: Optional[CubeRepresentation] = None,
+    ) -> "LazyCube":
+        """
+        Returns lazy cubes unchanged and wraps arrays of the given representation
+        """
+        if isinstance(cube, LazyCube):
+            if representation is not None and representation != cube.representation:
+                raise ValueError(
+                    f"The cube is in {cube.representation.value}, not {representation.value}"
+                )
+            return cube
+        if representation is None:
+            raise ValueError("A representation is needed to wrap an array")
+        return cls(data=cube, representation=representation)
+
+    @property
+    def data(self) -> CubeArray:
+        """
+        The cube in its native layout
+        """
+        return self._data
+
+    @property
+    def representation(self) -> CubeRepresentation:
+        """
+        The native layout of the cube
+        """
+        return self._representation
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._data.dtype
+
+    def _axis(self, dimension: str) -> int:
+        return DIMENSION_MAPPING[self._representation][dimension]
+
+    @property
+    def height(self) -> int:
+        return self._data.shape[self._axis("H")]
+
+    @property
+    def width(self) -> int:
+        return self._data.shape[self._axis("W")]
+
+    @property
+    def channels(self) -> int:
+        return self._data.shape[self._axis("C")]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """
+        The (C, H, W) sizes of the cube, independent of its layout
+        """
+        return self.channels, self.height, self.width
+
+    @property
+    def cached_layouts(self) -> List[CubeRepresentation]:
+        """
+        The layouts that are currently materialised
+        """
+        return list(self._layouts.keys())
+
+    def _index(
+        self,
+        bands: Union[int, slice, List[int]] = slice(None),
+        rows: Union[int, slice] = slice(None),
+        cols: Union[int, slice] = slice(None),
+    ) -> Tuple:
+        """
+        Builds an index into the native cube from band, row and column selections
+        """
+        index = [None, None, None]
+        index[self._axis("C")] = bands
+        index[self._axis("H")] = rows
+        index[self._axis("W")] = cols
+        return tuple(index)
+
+    def band(self, index: int) -> CubeArray:
+        """
+        A single band as an (H, W) view of the native cube
+        """
+        return self._data[self._index(bands=index)]
+
+    def pixel(self, row: int, col: int) -> CubeArray:
+        """
+        The spectrum of a single pixel as a (C,) view of the native cube
+        """
+        return self._data[self._index(rows=row, cols=col)]
+
+    def window(
+        self,
+        rows: slice,
+        cols: slice,
+        bands: Optional[Union[slice, List[int]]] = None,
+        layout: Optional[CubeRepresentation] = None,
+    ) -> CubeArray:
+        """
+        A spatial window, optionally restricted to some bands, in the requested layout.
+        Only the window is permuted, as one contiguous copy, when the layout differs.
+
+        Args:
+            rows (slice): The rows of the window
+            cols (slice): The columns of the window
+            bands (Optional[Union[slice, List[int]]]): The bands to return, all if None
+            layout (Optional[CubeRepresentation]): The layout of the result, native if None
+        """
+        window = self._data[
+            self._index(
+                bands=slice(None) if bands is None else bands, rows=rows, cols=cols
+            )
+        ]
+        if layout is None or layout == self._representation:
+            return window
+        return self._operations().convert_cube(
+            cube=window,
+            from_format=self._representation,
+            to_format=layout,
+            backend="numpy",
+            contiguous=True,
+        )
+
+    def as_layout(self, layout: CubeRepresentation) -> CubeArray:
+        """
+        The full cube in the requested layout. Conversions are contiguous and memoised.
+        """
+        layout = CubeRepresentation(layout)
+        if layout not in self._layouts:
+            self._layouts[layout] = self._operations().convert_cube(
+                cube=self._data,
+                from_format=self._representation,
+                to_format=layout,
+                backend="blocked",
+            )
+        return self._layouts[layout]
+
+    def clear_cache(self) -> None:
+        """
+        Releases every memoised conversion
+        """
+        self._layouts = {self._representation: self._data}
+
+    def _operations(self) -> ImageCubeOperations:
+        if self._cube_operations is None:
+            self._cube_operations = ImageCubeOperations()
+        return self._cube_operations
@@ -4,11 +4,43 @@ Generating a patch plan for a cube
 
 import logging
 
-from typing import List
+from typing import Optional, Union
 import numpy as np
 
+from app.models.dataset.packed_validity import PackedValidity
+from app.models.images.cube_representation import CubeRepresentation
 from app.models.patches.patching_request import PatchRequest
 from app.models.patches.patching_response import PatchingPlan
+from app.utils.image_transformation.lazy_cube import LazyCube
+from app.utils.patch_generation.integral_image import (
+    pixel_validity,
+    summed_area_table,
+    window_sums,
+)
+
+logger = logging.getLogger("PatchPlanGenerator")
+logger.setLevel(logging.INFO)
+
+
+def _axis_coordinates(extent: int, patch_extent: int, stride: int) -> np.ndarray:
+    """
+    The offsets of the patches along one axis of the cube.
+
+    Offsets step by the stride from 0. The first offset whose patch would reach the end of
+    the axis is snapped back so that the patch ends exactly on the edge, and is the last one.
+    When every offset leaves room after its patch there is no snapped patch.
+
+    Args:
+        extent (int): The size of the cube along the axis
+        patch_extent (int): The size of a patch along the axis
+        stride (int): The step between consecutive offsets
+    """
+    candidates = np.arange(0, extent, stride, dtype=np.int32)
+    fits = candidates + patch_extent < extent
+    offsets = candidates[fits]
+    if not fits.all():
+        offsets = np.append(offsets, np.int32(extent - patch_extent))
+    return offsets
 
 
 class PatchPlanGenerator:
@@ -20,15 +52,35 @@ class PatchPlanGenerator:
         pass
 
     def generate_patching_plan(
-        self, input_cube: np.ndarray, request: PatchRequest
+        self,
+        input_cube: Union[np.ndarray, LazyCube],
+        request: PatchRequest,
+        validity: Optional[Union[np.ndarray, PackedValidity]] = None,
     ) -> PatchingPlan:
         """
-        Generates a patching plan for a patch request
+        Generates a patching plan for a patch request.
+        Arrays are taken to be BSQ, lazy cubes may be in any layout and are never converted.
+
+        With a validity, every patch is scored by its fraction of valid pixels and patches
+        below the request's min_valid_fraction are dropped. The fractions are read from a
+        summed-area table of the validity, so scoring costs one pass over the scene plus
+        four lookups per patch whatever the patch size.
+
+        Args:
+            input_cube (Union[np.ndarray, LazyCube]): The cube to patch
+            request (PatchRequest): The patch request
+            validity (Optional[Union[np.ndarray, PackedValidity]]): An (H, W) mask or a
+                (C, H, W) validity cube such as the one of a vendable dataset (non zero =
+                valid). A pixel is valid when it is valid in every band.
         """
 
         # Store variables
-        cube_height = input_cube.shape[1]
-        cube_width = input_cube.shape[2]
+        lazy_cube = LazyCube.wrap(
+            input_cube,
+            None if isinstance(input_cube, LazyCube) else CubeRepresentation.BSQ,
+        )
+        cube_height = lazy_cube.height
+        cube_width = lazy_cube.width
 
         if request.stride <= 0:
             raise ValueError("Stride must be greater than 0 to avoid an infinite loop.")
@@ -42,45 +94,46 @@ class PatchPlanGenerator:
                 f"The input cube has a height : {cube_width} while the patch requested is larger : {request.width}"
             )
 
-        # the idea is to first generate the x coords
-        row_coords = []
-        row = 0
-        while True:
-            # check if row is outside the height bounds
-            if row >= cube_height:
-                break
-            # Check if the patch lies outside the cube
-            if row + request.height >= cube_height:
-                # In the even that the patch lies outside the cube
-                # Set the patch row coord to be such that row + patch_height  = height. So row = Height - patch_height
-                # this is the last patch basically
-                row_coords.append(cube_height - request.height)
-                # Then break
-                break
-            # Otherwise we are good and we can just move on
-            row_coords.append(row)
-            row += request.stride
-
-        # the same logic applies for the y_coords too
-        col_coords = []
-        col = 0
-        while True:
-            # check if col is outside the width bounds
-            if col >= cube_width:
-                break
-            # Check if the patch lies outside the cube
-            if col + request.width >= cube_width:
-                # In the even that the patch lies outside the cube
-                # Set the patch x coord to be such that col + patch_width  = width. So x = width - patch_width
-                # this is the last patch basically
-                col_coords.append(cube_width - request.width)
-                # Then break
-                break
-            # Otherwise we are good and we can just move on
-            col_coords.append(col)
-            col += request.stride
-
-        # Now we have x and y we can basically permute
-        final_coords = [(r, c) for r in row_coords for c in col_coords]
-
-        return PatchingPlan(originating_request=request, patch_coordinates=final_coords)
+        # Row and column offsets are generated independently, every pair is a patch
+        row_coords = _axis_coordinates(cube_height, request.height, request.stride)
+        col_coords = _axis_coordinates(cube_width, request.width, request.stride)
+
+        # Row major order, every row offset is paired with every column offset
+        final_coords = np.empty((row_coords.size * col_coords.size, 2), dtype=np.int32)
+        final_coords[:, 0] = np.repeat(row_coords, col_coords.size)
+        final_coords[:, 1] = np.tile(col_coords, row_coords.size)
+
+        if validity is None:
+            if request.min_valid_fraction > 0:
+                raise ValueError("A validity is needed to filter patches by validity")
+            return PatchingPlan(
+                originating_request=request, patch_coordinates=final_coords
+            )
+
+        valid_pixels = pixel_validity(validity)
+        if valid_pixels.shape != (cube_height, cube_width):
+            raise ValueError(
+                f"The validity covers {valid_pixels.shape} pixels, the cube {(cube_height, cube_width)}"
+            )
+        valid_counts = window_sums(
+            summed_area_table(valid_pixels),
+            final_coords[:, 0],
+            final_coords[:, 1],
+            request.height,
+            request.width,
+        )
+        valid_fractions = (valid_counts / (request.height * request.width)).astype(
+            np.float32
+        )
+        keep = valid_fractions >= request.min_valid_fraction
+        logger.info(
+            "Kept %d of %d patches with a valid fraction of at least %s",
+            np.count_nonzero(keep),
+            keep.size,
+            request.min_valid_fraction,
+        )
+        return PatchingPlan(
+            originating_request=request,
+            patch_coordinates=final_coords[keep],
+            valid_fractions=valid_fractions[keep],
+        )
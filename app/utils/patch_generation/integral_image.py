@@ -0,0 +1,66 @@
+"""
+Summed-area tables for counting valid pixels under many windows in constant time each
+"""
+
+from typing import Union
+
+import numpy as np
+
+from app.models.dataset.packed_validity import PackedValidity
+
+
+def pixel_validity(validity: Union[np.ndarray, PackedValidity]) -> np.ndarray:
+    """
+    The (H, W) boolean validity of pixels from a validity mask or cube (non zero = valid).
+    A pixel of a (C, H, W) cube is valid only when it is valid in every band. Packed cubes are
+    unpacked one band at a time.
+    """
+    if isinstance(validity, PackedValidity):
+        pixels = validity.band(0) != 0
+        for band in range(1, validity.shape[0]):
+            pixels &= validity.band(band) != 0
+        return pixels
+    if validity.ndim == 2:
+        return validity != 0
+    if validity.ndim != 3:
+        raise ValueError(f"Expected a 2D or 3D validity, got {validity.ndim}D")
+    return np.all(validity != 0, axis=0)
+
+
+def summed_area_table(mask: np.ndarray) -> np.ndarray:
+    """
+    The (H + 1, W + 1) summed-area table of a 2D mask, table[r, c] being the number of
+    set pixels above and left of (r, c). The leading row and column of zeros spare
+    window sums any edge cases. The narrowest integer type that can hold the total is used.
+    """
+    height, width = mask.shape
+    dtype = np.int32 if height * width < np.iinfo(np.int32).max else np.int64
+    table = np.zeros((height + 1, width + 1), dtype=dtype)
+    # Prefix sums along the contiguous rows, then a running sum down the table one row at a
+    # time, which streams through memory where a cumsum along axis 0 strides across it
+    np.cumsum(mask, axis=1, dtype=dtype, out=table[1:, 1:])
+    for row in range(2, height + 1):
+        np.add(table[row], table[row - 1], out=table[row])
+    return table
+
+
+def window_sums(
+    table: np.ndarray,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    height: int,
+    width: int,
+) -> np.ndarray:
+    """
+    The number of set pixels in each height x width window with top left corners
+    (rows, cols), read from a summed-area table with four lookups per window.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    bottom, right = rows + height, cols + width
+    return (
+        table[bottom, right]
+        - table[rows, right]
+        - table[bottom, cols]
+        + table[rows, cols]
+    )
@@ -0,0 +1,142 @@
+"""
+Extracting the patches of a patching plan as views or into reusable batch buffers
+"""
+
+from typing import Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from app.models.images.cube_representation import DIMENSION_MAPPING
+from app.models.patches.patching_response import PatchingPlan
+from app.utils.image_transformation.lazy_cube import LazyCube
+
+
+class PatchExtractor:
+    """
+    Serves the patches of a patching plan from a cube.
+
+    Every possible patch of the cube is exposed as a strided view of shape
+    (C, H - h + 1, W - w + 1, h, w), so a single patch is a view that costs nothing to take.
+    Batches of patches are gathered into one (B, C, h, w) buffer that the caller can reuse
+    across batches, so loaders do not allocate per patch.
+    """
+
+    def __init__(
+        self,
+        plan: PatchingPlan,
+        input_cube: Optional[Union[np.ndarray, LazyCube]] = None,
+    ):
+        """
+        Class constructor
+
+        Args:
+            plan (PatchingPlan): The plan whose patches are extracted
+            input_cube (Optional[Union[np.ndarray, LazyCube]]): The cube to extract from,
+                the cube of the plan's request if None. Arrays are taken to be BSQ, lazy
+                cubes may be in any layout and are viewed as BSQ without a conversion.
+                Masked arrays are patched on their data.
+        """
+        if input_cube is None:
+            input_cube = plan.originating_request.input_cube
+        if isinstance(input_cube, LazyCube):
+            # A BSQ view of the native cube, strided rather than converted
+            axes = DIMENSION_MAPPING[input_cube.representation]
+            cube = np.transpose(input_cube.data, (axes["C"], axes["H"], axes["W"]))
+        else:
+            cube = input_cube
+        cube = np.ma.getdata(cube)
+        if cube.ndim != 3:
+            raise ValueError(f"Expected a 3D cube, got {cube.ndim}D")
+
+        self.plan = plan
+        self.cube = cube
+        self.patch_height: int = plan.originating_request.height
+        self.patch_width: int = plan.originating_request.width
+        coordinates = plan.patch_coordinates
+        if coordinates.shape[0] > 0 and (
+            coordinates.min() < 0
+            or coordinates[:, 0].max() + self.patch_height > cube.shape[1]
+            or coordinates[:, 1].max() + self.patch_width > cube.shape[2]
+        ):
+            raise ValueError(
+                f"The plan has patches outside the cube of shape {cube.shape}"
+            )
+        self.windows: np.ndarray = sliding_window_view(
+            cube, (self.patch_height, self.patch_width), axis=(1, 2)
+        )
+
+    def __len__(self) -> int:
+        return self.plan.patch_count
+
+    @property
+    def patch_shape(self) -> Tuple[int, int, int]:
+        """
+        The (C, h, w) shape of every patch
+        """
+        return self.cube.shape[0], self.patch_height, self.patch_width
+
+    def patch(self, index: int) -> np.ndarray:
+        """
+        The (C, h, w) patch at an index of the plan, as a read only view of the cube
+        """
+        row, col = self.plan.patch_coordinates[index]
+        return self.windows[:, row, col]
+
+    def batch_buffer(self, batch_size: int) -> np.ndarray:
+        """
+        Allocates a (batch_size, C, h, w) buffer to gather batches into
+        """
+        return np.empty((batch_size, *self.patch_shape), dtype=self.cube.dtype)
+
+    def gather(
+        self, indices: Sequence[int], out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Copies the patches at indices of the plan into a (B, C, h, w) array
+
+        Args:
+            indices (Sequence[int]): The indices of the patches in the plan
+            out (Optional[np.ndarray]): A buffer with room for at least B patches that is
+                filled instead of allocating. The first B patches of it are returned.
+        """
+        coordinates = self.plan.patch_coordinates[np.asarray(indices, dtype=np.int64)]
+        if out is None:
+            out = self.batch_buffer(coordinates.shape[0])
+        elif out.shape[0] < coordinates.shape[0] or out.shape[1:] != self.patch_shape:
+            raise ValueError(
+                f"A buffer of shape {out.shape} cannot hold {coordinates.shape[0]} "
+                f"patches of shape {self.patch_shape}"
+            )
+        # One strided copy per patch straight into the buffer, a single fancy index over
+        # the windows would go through a temporary of the whole batch first
+        for position, (row, col) in enumerate(coordinates.tolist()):
+            out[position] = self.windows[:, row, col]
+        return out[: coordinates.shape[0]]
+
+    def iter_batches(
+        self,
+        batch_size: int,
+        indices: Optional[Sequence[int]] = None,
+        out: Optional[np.ndarray] = None,
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Yields (indices, patches) batches of the plan, every batch gathered into the same
+        buffer. A batch is overwritten by the next one, copy it to keep it.
+
+        Args:
+            batch_size (int): The number of patches per batch, the last one may be smaller
+            indices (Optional[Sequence[int]]): The patches to serve in order, e.g. shuffled,
+                every patch of the plan if None
+            out (Optional[np.ndarray]): The buffer to gather into, allocated once if None
+        """
+        if batch_size <= 0:
+            raise ValueError("Batch size must be greater than 0")
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = self.batch_buffer(min(batch_size, max(indices.size, 1)))
+        for start in range(0, indices.size, batch_size):
+            batch_indices = indices[start : start + batch_size]
+            yield batch_indices, self.gather(batch_indices, out=out)
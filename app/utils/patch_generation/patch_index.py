@@ -0,0 +1,371 @@
+"""
+A persistent index of the patches of a corpus of vended scenes.
+
+Every patch of every indexed scene is a row of an SQLite table holding its coordinates,
+its valid and cloud fractions and the bands available in it. Scenes are added one at a time
+as they are vended and patches are selected and sampled from the index without touching
+any pixel data.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+from typing import List, Literal, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from app.models.dataset.vendables import VendableDataset
+from app.models.patches.patch_records import PatchRecords
+from app.models.patches.patching_request import PatchRequest
+from app.utils.patch_generation.generate_patch_plan import PatchPlanGenerator
+from app.utils.patch_generation.integral_image import summed_area_table, window_sums
+
+logger = logging.getLogger("PatchIndex")
+logger.setLevel(logging.INFO)
+
+# Bump whenever the schema changes, indexes of another version have to be rebuilt
+PATCH_INDEX_VERSION = 1
+
+# A band is available in a patch when at least this fraction of its pixels is valid
+DEFAULT_BAND_VALID_FRACTION = 0.5
+# Edges of the cloud fraction strata of balanced sampling
+DEFAULT_CLOUD_FRACTION_BINS = (0.0, 0.05, 0.25, 0.5, 1.0)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    scene_id TEXT PRIMARY KEY,
+    source_path TEXT,
+    height INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    channels INTEGER NOT NULL,
+    patch_height INTEGER NOT NULL,
+    patch_width INTEGER NOT NULL,
+    stride INTEGER NOT NULL,
+    patch_count INTEGER NOT NULL,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS patches (
+    scene_id TEXT NOT NULL REFERENCES scenes(scene_id) ON DELETE CASCADE,
+    patch_row INTEGER NOT NULL,
+    patch_col INTEGER NOT NULL,
+    valid_fraction REAL NOT NULL,
+    cloud_fraction REAL,
+    available_band_count INTEGER NOT NULL,
+    band_availability BLOB NOT NULL,
+    PRIMARY KEY (scene_id, patch_row, patch_col)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS patches_by_quality ON patches (valid_fraction, cloud_fraction);
+"""
+
+
+def _balanced_quotas(
+    sizes: np.ndarray, count: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    How many patches to draw from each stratum so that the strata are as even as possible.
+    Strata too small for their share give everything they have and the rest is shared out
+    among the others.
+    """
+    quotas = np.zeros_like(sizes)
+    remaining = min(count, int(sizes.sum()))
+    while remaining > 0:
+        open_strata = np.flatnonzero(quotas < sizes)
+        share = remaining // open_strata.size
+        if share == 0:
+            # Fewer patches left than strata, a random subset of strata gets one more
+            quotas[rng.choice(open_strata, remaining, replace=False)] += 1
+            break
+        grant = np.minimum(share, sizes[open_strata] - quotas[open_strata])
+        quotas[open_strata] += grant
+        remaining -= int(grant.sum())
+    return quotas
+
+
+class PatchIndex:
+    """
+    An SQLite index of the patches of a corpus of scenes.
+    Indexing a scene again replaces its patches, so the index can be rebuilt incrementally.
+    """
+
+    def __init__(self, index_path: str):
+        """
+        Opens the index at a path, creating it if needed
+
+        Args:
+            index_path (str): The path of the SQLite database
+        """
+        directory = os.path.dirname(os.path.abspath(index_path))
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, PATCH_INDEX_VERSION):
+            self.connection.close()
+            raise ValueError(
+                f"The patch index {index_path} is of version {version}, "
+                f"expected {PATCH_INDEX_VERSION}. Rebuild it."
+            )
+        with self.connection:
+            self.connection.executescript(_SCHEMA)
+            self.connection.execute(f"PRAGMA user_version = {PATCH_INDEX_VERSION}")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "PatchIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def scene_ids(self) -> List[str]:
+        """
+        The indexed scenes
+        """
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT scene_id FROM scenes ORDER BY scene_id"
+            )
+        ]
+
+    def has_scene(self, scene_id: str) -> bool:
+        """
+        Whether a scene is indexed
+        """
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM scenes WHERE scene_id = ?", (scene_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def remove_scene(self, scene_id: str) -> None:
+        """
+        Removes a scene and its patches
+        """
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM scenes WHERE scene_id = ?", (scene_id,)
+            )
+
+    def index_scene(
+        self,
+        scene_id: str,
+        vendable: VendableDataset,
+        request: PatchRequest,
+        cloud_mask: Optional[np.ndarray] = None,
+        source_path: Optional[str] = None,
+        band_valid_fraction: float = DEFAULT_BAND_VALID_FRACTION,
+    ) -> int:
+        """
+        Plans the patches of a vended scene and indexes them, replacing any previous
+        entry of the scene. Returns the number of patches indexed.
+
+        Only the validity is read: valid fractions come from the plan, band availability
+        and cloud fractions from summed-area tables of each band and of the cloud mask.
+
+        Args:
+            scene_id (str): A unique identifier of the scene in the corpus
+            vendable (VendableDataset): The vended scene, its validity may be packed
+            request (PatchRequest): The patch request on the scene's cube. Patches below
+                its min_valid_fraction are not indexed.
+            cloud_mask (Optional[np.ndarray]): An (H, W) or (1, H, W) boolean cloud mask
+                (True = cloud), e.g. the mask predicted by the cloud masker. Cloud fractions
+                are left unknown without one.
+            source_path (Optional[str]): The file the scene was vended from
+            band_valid_fraction (float): The fraction of valid pixels a band needs in a patch
+                to count as available
+        """
+        validity = (
+            vendable.packed_validity
+            if vendable.is_validity_packed
+            else vendable.validity_cube
+        )
+        plan = PatchPlanGenerator().generate_patching_plan(
+            request.input_cube, request, validity=validity
+        )
+        coordinates = plan.patch_coordinates
+        rows, cols = coordinates[:, 0], coordinates[:, 1]
+        channels, height, width = validity.shape
+        patch_size = request.height * request.width
+
+        # One summed-area table per band, built and discarded in turn
+        available = np.empty((plan.patch_count, channels), dtype=bool)
+        for band in range(channels):
+            table = summed_area_table(vendable.validity_band(band) != 0)
+            band_counts = window_sums(table, rows, cols, request.height, request.width)
+            available[:, band] = band_counts >= band_valid_fraction * patch_size
+        band_availability = np.packbits(available, axis=1)
+
+        if cloud_mask is None:
+            cloud_fractions = [None] * plan.patch_count
+        else:
+            cloud_mask = np.asarray(cloud_mask).reshape(height, width)
+            cloud_counts = window_sums(
+                summed_area_table(cloud_mask != 0),
+                rows,
+                cols,
+                request.height,
+                request.width,
+            )
+            cloud_fractions = (cloud_counts / patch_size).tolist()
+
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM scenes WHERE scene_id = ?", (scene_id,)
+            )
+            self.connection.execute(
+                "INSERT INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    scene_id,
+                    source_path,
+                    height,
+                    width,
+                    channels,
+                    request.height,
+                    request.width,
+                    request.stride,
+                    plan.patch_count,
+                    time.time(),
+                ),
+            )
+            self.connection.executemany(
+                "INSERT INTO patches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                zip(
+                    [scene_id] * plan.patch_count,
+                    rows.tolist(),
+                    cols.tolist(),
+                    plan.valid_fractions.tolist(),
+                    cloud_fractions,
+                    available.sum(axis=1).tolist(),
+                    [packed.tobytes() for packed in band_availability],
+                ),
+            )
+        logger.info("Indexed %d patches of %s", plan.patch_count, scene_id)
+        return plan.patch_count
+
+    def query(
+        self,
+        min_valid_fraction: float = 0.0,
+        max_cloud_fraction: Optional[float] = None,
+        min_available_bands: Optional[int] = None,
+        scene_ids: Optional[Sequence[str]] = None,
+    ) -> PatchRecords:
+        """
+        The patches matching every given condition, ordered by scene and position
+
+        Args:
+            min_valid_fraction (float): The smallest valid fraction of a patch
+            max_cloud_fraction (Optional[float]): The largest cloud fraction of a patch.
+                Patches of unknown cloud fraction never match.
+            min_available_bands (Optional[int]): The fewest available bands of a patch
+            scene_ids (Optional[Sequence[str]]): Restricts the patches to these scenes
+        """
+        conditions, parameters = ["valid_fraction >= ?"], [min_valid_fraction]
+        if max_cloud_fraction is not None:
+            conditions.append("cloud_fraction <= ?")
+            parameters.append(max_cloud_fraction)
+        if min_available_bands is not None:
+            conditions.append("available_band_count >= ?")
+            parameters.append(min_available_bands)
+        if scene_ids is not None:
+            conditions.append(f"scene_id IN ({', '.join('?' * len(scene_ids))})")
+            parameters.extend(scene_ids)
+        rows = self.connection.execute(
+            "SELECT scene_id, patch_row, patch_col, valid_fraction, cloud_fraction, "
+            "available_band_count FROM patches "
+            f"WHERE {' AND '.join(conditions)} "
+            "ORDER BY scene_id, patch_row, patch_col",
+            parameters,
+        ).fetchall()
+        columns = list(zip(*rows)) if rows else [[]] * 6
+        return PatchRecords(
+            scene_ids=np.array(columns[0], dtype=object),
+            patch_coordinates=np.array(
+                [columns[1], columns[2]], dtype=np.int32
+            ).T.reshape(-1, 2),
+            # Unknown cloud fractions (NULL) become NaN
+            valid_fractions=np.array(columns[3], dtype=np.float32),
+            cloud_fractions=np.array(columns[4], dtype=np.float64).astype(np.float32),
+            available_band_counts=np.array(columns[5], dtype=np.int32),
+        )
+
+    def band_availability(self, scene_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The (N, 2) coordinates of the patches of a scene and the (N, C) availability of
+        each band in them
+        """
+        channels = self.connection.execute(
+            "SELECT channels FROM scenes WHERE scene_id = ?", (scene_id,)
+        ).fetchone()
+        if channels is None:
+            raise KeyError(f"Scene {scene_id} is not indexed")
+        rows = self.connection.execute(
+            "SELECT patch_row, patch_col, band_availability FROM patches "
+            "WHERE scene_id = ? ORDER BY patch_row, patch_col",
+            (scene_id,),
+        ).fetchall()
+        coordinates = np.array([row[:2] for row in rows], dtype=np.int32).reshape(-1, 2)
+        packed = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.uint8)
+        available = np.unpackbits(
+            packed.reshape(len(rows), -1), axis=1, count=channels[0]
+        ).astype(bool)
+        return coordinates, available
+
+    def sample_balanced(
+        self,
+        count: int,
+        by: Literal["scene", "cloud_fraction"] = "scene",
+        cloud_fraction_bins: Sequence[float] = DEFAULT_CLOUD_FRACTION_BINS,
+        random_seed: Optional[int] = None,
+        **filters: Union[float, int, Sequence[str], None],
+    ) -> PatchRecords:
+        """
+        Draws patches without replacement so that every stratum is represented as evenly
+        as possible, in random order. Strata with too few patches give all of them and
+        the others make up for it.
+
+        Args:
+            count (int): The number of patches to draw, fewer if fewer match
+            by (Literal["scene", "cloud_fraction"]): Stratify by scene or by cloud fraction
+            cloud_fraction_bins (Sequence[float]): The edges of the cloud fraction strata.
+                Patches of unknown cloud fraction form a stratum of their own.
+            random_seed (Optional[int]): Seeds the draw. Unseeded if None.
+            filters: Conditions on the patches, refer to query
+        """
+        if by not in ("scene", "cloud_fraction"):
+            raise ValueError(f"Invalid stratification: {by}")
+        records = self.query(**filters)
+        rng = np.random.default_rng(random_seed)
+        if len(records) == 0:
+            return records
+        if count <= 0:
+            return records.take(np.empty(0, dtype=np.int64))
+
+        if by == "scene":
+            labels = records.scene_ids.astype(str)
+        else:
+            edges = np.asarray(cloud_fraction_bins, dtype=np.float64)
+            labels = np.where(
+                np.isnan(records.cloud_fractions),
+                -1,
+                np.digitize(records.cloud_fractions, edges[1:-1], right=True),
+            )
+        _, strata = np.unique(labels, return_inverse=True)
+        strata = strata.ravel()
+        quotas = _balanced_quotas(np.bincount(strata), count, rng)
+        if quotas.sum() == 0:
+            return records.take(np.empty(0, dtype=np.int64))
+
+        chosen = np.concatenate(
+            [
+                rng.choice(np.flatnonzero(strata == stratum), quota, replace=False)
+                for stratum, quota in enumerate(quotas)
+                if quota > 0
+            ]
+        )
+        rng.shuffle(chosen)
+        return records.take(chosen)
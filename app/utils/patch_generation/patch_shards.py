@@ -0,0 +1,402 @@
+"""
+Packing the patches of many scenes into fixed-size shard files for sequential reads.
+
+A shard is a raw file of fixed-size records, each record holding the data and the validity
+of one patch side by side, so a patch is one contiguous read and a shard is read front to
+back in one pass. A shard set is a directory of shards plus an index locating every patch
+(scene, coordinates, shard and byte offset) and a JSON manifest describing the records.
+"""
+
+import os
+import json
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.models.dataset.vendables import VendableDataset
+from app.models.patches.patching_response import PatchingPlan
+from app.utils.patch_generation.patch_extractor import PatchExtractor
+
+logger = logging.getLogger("PatchShards")
+logger.setLevel(logging.INFO)
+
+SHARD_MANIFEST_FILE_NAME = "shards.json"
+SHARD_INDEX_FILE_NAME = "shard_index.npy"
+SHARD_FORMAT_VERSION = 1
+
+# Shards are cut at this many bytes, large enough for reads to be sequential
+DEFAULT_SHARD_SIZE_BYTES = 256 * 1024 * 1024
+# Patches copied per write, bounds the memory of the writer
+DEFAULT_WRITE_BATCH_SIZE = 256
+
+# Locates a patch: its scene (position in the manifest's scene list), its top left
+# corner in the scene, its shard and the byte offset of its record in the shard
+SHARD_INDEX_DTYPE = np.dtype(
+    [
+        ("scene", np.int32),
+        ("row", np.int32),
+        ("col", np.int32),
+        ("shard", np.int32),
+        ("offset", np.int64),
+    ]
+)
+
+
+def shard_record_dtype(
+    patch_shape: Tuple[int, int, int], data_dtype: np.dtype
+) -> np.dtype:
+    """
+    The record of one patch: its (C, h, w) data followed by its (C, h, w) validity
+    (1 = valid). Records are padded to the alignment of the data so every patch's data
+    stays aligned in a memory mapped shard.
+    """
+    return np.dtype(
+        [
+            ("data", np.dtype(data_dtype), tuple(patch_shape)),
+            ("validity", np.uint8, tuple(patch_shape)),
+        ],
+        align=True,
+    )
+
+
+def _shard_file_name(shard: int) -> str:
+    return f"shard_{shard:05d}.bin"
+
+
+class PatchShardWriter:
+    """
+    Packs the patches of patching plans into shards, scene after scene.
+    Every patch must have the same shape and data type. Use as a context manager, or call
+    close() once done: the index and manifest are only written then.
+    """
+
+    def __init__(
+        self,
+        output_directory: str,
+        shard_size_bytes: int = DEFAULT_SHARD_SIZE_BYTES,
+        write_batch_size: int = DEFAULT_WRITE_BATCH_SIZE,
+    ):
+        """
+        Class constructor
+
+        Args:
+            output_directory (str): The directory of the shard set, created if needed.
+                An existing shard set in it is overwritten.
+            shard_size_bytes (int): The size a shard is cut at, rounded down to a whole
+                number of records (at least one)
+            write_batch_size (int): The number of patches copied and written at a time
+        """
+        if shard_size_bytes <= 0 or write_batch_size <= 0:
+            raise ValueError("Shard size and write batch size must be greater than 0")
+        os.makedirs(output_directory, exist_ok=True)
+        self.output_directory = output_directory
+        self.shard_size_bytes = shard_size_bytes
+        self.write_batch_size = write_batch_size
+
+        self.patch_shape: Optional[Tuple[int, int, int]] = None
+        self.record_dtype: Optional[np.dtype] = None
+        self.patches_per_shard: int = 0
+        self.scene_ids: List[str] = []
+        self.shard_counts: List[int] = []
+        self._index: List[np.ndarray] = []
+        self._shard_file = None
+        self._buffer: Optional[np.ndarray] = None
+        self._closed = False
+
+    def __enter__(self) -> "PatchShardWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return sum(self.shard_counts)
+
+    def _configure(self, patch_shape: Tuple[int, int, int], data_dtype: np.dtype):
+        """
+        Fixes the record layout on the first plan written
+        """
+        self.patch_shape = patch_shape
+        self.record_dtype = shard_record_dtype(patch_shape, data_dtype)
+        self.patches_per_shard = max(
+            1, self.shard_size_bytes // self.record_dtype.itemsize
+        )
+        self._buffer = np.empty(
+            min(self.write_batch_size, self.patches_per_shard), dtype=self.record_dtype
+        )
+
+    def _write_records(self, records: np.ndarray) -> Tuple[int, int]:
+        """
+        Appends records to the current shard, opening the next one when it is full.
+        The records must fit in the current shard. Returns the shard and the byte offset
+        the records were written at.
+        """
+        if self._shard_file is None or self.shard_counts[-1] == self.patches_per_shard:
+            if self._shard_file is not None:
+                self._shard_file.close()
+            self.shard_counts.append(0)
+            self._shard_file = open(
+                os.path.join(
+                    self.output_directory,
+                    _shard_file_name(len(self.shard_counts) - 1),
+                ),
+                "wb",
+            )
+        shard = len(self.shard_counts) - 1
+        offset = self.shard_counts[shard] * self.record_dtype.itemsize
+        self._shard_file.write(records.view(np.uint8).data)
+        self.shard_counts[shard] += records.shape[0]
+        return shard, offset
+
+    def add_scene(
+        self, scene_id: str, plan: PatchingPlan, vendable: VendableDataset
+    ) -> int:
+        """
+        Packs every patch of a plan with its validity from the vended scene.
+        Returns the number of patches written.
+
+        Args:
+            scene_id (str): The identifier of the scene, stored in the index
+            plan (PatchingPlan): The plan of the patches to write, e.g. filtered by valid
+                fraction or sampled from a patch index. The data is read from the cube of
+                its request.
+            vendable (VendableDataset): The vended scene the validity is read from, packed
+                or not. It must be the scene the plan was made on.
+        """
+        if self._closed:
+            raise ValueError("The shard writer is closed")
+        extractor = PatchExtractor(plan)
+        if vendable.is_validity_packed:
+            validity_shape = tuple(vendable.packed_validity.shape)
+        else:
+            validity_shape = vendable.validity_cube.shape
+        if validity_shape != extractor.cube.shape:
+            raise ValueError(
+                f"The validity of shape {validity_shape} does not match the cube of "
+                f"shape {extractor.cube.shape}"
+            )
+        if self.record_dtype is None:
+            self._configure(extractor.patch_shape, extractor.cube.dtype)
+        elif (
+            extractor.patch_shape != self.patch_shape
+            or extractor.cube.dtype != self.record_dtype["data"].base
+        ):
+            raise ValueError(
+                f"Patches of shape {extractor.patch_shape} and type {extractor.cube.dtype} "
+                f"cannot join a shard set of {self.patch_shape} "
+                f"{self.record_dtype['data'].base} patches"
+            )
+        validity_extractor = (
+            None
+            if vendable.is_validity_packed
+            else PatchExtractor(plan, input_cube=vendable.validity_cube)
+        )
+
+        scene = len(self.scene_ids)
+        self.scene_ids.append(scene_id)
+        coordinates = plan.patch_coordinates
+        index = np.empty(coordinates.shape[0], dtype=SHARD_INDEX_DTYPE)
+        index["scene"] = scene
+        index["row"] = coordinates[:, 0]
+        index["col"] = coordinates[:, 1]
+        height, width = self.patch_shape[1:]
+
+        start = 0
+        while start < coordinates.shape[0]:
+            # Never let a write straddle two shards
+            room = self.patches_per_shard
+            if self._shard_file is not None and self.shard_counts[-1] < room:
+                room -= self.shard_counts[-1]
+            count = min(self._buffer.shape[0], room, coordinates.shape[0] - start)
+            batch = np.arange(start, start + count)
+            records = self._buffer[:count]
+            extractor.gather(batch, out=records["data"])
+            if validity_extractor is not None:
+                validity_extractor.gather(batch, out=records["validity"])
+            else:
+                for position, (row, col) in enumerate(
+                    coordinates[start : start + count].tolist()
+                ):
+                    records["validity"][position] = vendable.validity_window(
+                        slice(row, row + height), slice(col, col + width)
+                    )
+            shard, offset = self._write_records(records)
+            index["shard"][start : start + count] = shard
+            index["offset"][start : start + count] = (
+                offset + np.arange(count, dtype=np.int64) * self.record_dtype.itemsize
+            )
+            start += count
+
+        self._index.append(index)
+        logger.debug("Packed %d patches of scene %s", coordinates.shape[0], scene_id)
+        return coordinates.shape[0]
+
+    def close(self) -> Optional[str]:
+        """
+        Closes the last shard and writes the index and the manifest.
+        Returns the path of the manifest, None if no patch was ever written.
+        """
+        if self._closed:
+            return None
+        self._closed = True
+        if self._shard_file is not None:
+            self._shard_file.close()
+        if self.record_dtype is None:
+            return None
+
+        index = (
+            np.concatenate(self._index)
+            if self._index
+            else np.empty(0, dtype=SHARD_INDEX_DTYPE)
+        )
+        np.save(os.path.join(self.output_directory, SHARD_INDEX_FILE_NAME), index)
+        manifest = {
+            "format_version": SHARD_FORMAT_VERSION,
+            "patch_shape": list(self.patch_shape),
+            "data_dtype": self.record_dtype["data"].base.str,
+            "record_size": self.record_dtype.itemsize,
+            "shards": [
+                {"file": _shard_file_name(shard), "patch_count": count}
+                for shard, count in enumerate(self.shard_counts)
+            ],
+            "scene_ids": self.scene_ids,
+        }
+        manifest_path = os.path.join(self.output_directory, SHARD_MANIFEST_FILE_NAME)
+        temporary_path = f"{manifest_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(temporary_path, manifest_path)
+        logger.info(
+            "Packed %d patches of %d scenes into %d shards",
+            index.shape[0],
+            len(self.scene_ids),
+            len(self.shard_counts),
+        )
+        return manifest_path
+
+
+class PatchShardReader:
+    """
+    Reads a shard set written by PatchShardWriter, either as memory mapped shards for
+    random access or as a stream of batches read front to back shard after shard.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Class constructor
+
+        Args:
+            directory (str): The directory of the shard set
+        """
+        with open(
+            os.path.join(directory, SHARD_MANIFEST_FILE_NAME), "r", encoding="utf-8"
+        ) as manifest_file:
+            manifest: Dict[str, Any] = json.load(manifest_file)
+        if manifest.get("format_version") != SHARD_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported shard format version {manifest.get('format_version')}"
+            )
+        self.directory = directory
+        self.patch_shape: Tuple[int, int, int] = tuple(manifest["patch_shape"])
+        self.record_dtype = shard_record_dtype(
+            self.patch_shape, np.dtype(manifest["data_dtype"])
+        )
+        if self.record_dtype.itemsize != manifest["record_size"]:
+            raise ValueError(
+                f"Records of {manifest['record_size']} bytes were written, "
+                f"expected {self.record_dtype.itemsize}"
+            )
+        self.scene_ids: List[str] = manifest["scene_ids"]
+        self.shard_files: List[str] = [
+            os.path.join(directory, shard["file"]) for shard in manifest["shards"]
+        ]
+        self.shard_counts: List[int] = [
+            shard["patch_count"] for shard in manifest["shards"]
+        ]
+        self.index: np.ndarray = np.load(os.path.join(directory, SHARD_INDEX_FILE_NAME))
+        self._shards: Dict[int, np.memmap] = {}
+
+    def __len__(self) -> int:
+        return self.index.shape[0]
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.shard_files)
+
+    def shard(self, shard: int) -> np.memmap:
+        """
+        The records of a shard as a read only memory map. Its "data" and "validity" fields
+        are (N, C, h, w) views onto the file.
+        """
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(
+                self.shard_files[shard],
+                dtype=self.record_dtype,
+                mode="r",
+                shape=(self.shard_counts[shard],),
+            )
+        return self._shards[shard]
+
+    def patch(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The (data, validity) of the patch at an index of the shard set, as views onto
+        its memory mapped shard
+        """
+        entry = self.index[index]
+        record = self.shard(int(entry["shard"]))[
+            int(entry["offset"]) // self.record_dtype.itemsize
+        ]
+        return record["data"], record["validity"]
+
+    def locate(self, index: int) -> Tuple[str, int, int]:
+        """
+        The scene id and (row, col) top left corner of the patch at an index
+        """
+        entry = self.index[index]
+        return self.scene_ids[entry["scene"]], int(entry["row"]), int(entry["col"])
+
+    def iter_batches(
+        self,
+        batch_size: int,
+        shuffle_shards: bool = False,
+        random_seed: Optional[int] = None,
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Yields (indices, data, validity) batches, reading every shard front to back with
+        plain sequential reads into one reused buffer. A batch is overwritten by the next
+        one, copy it to keep it. Batches do not span shards, so the last batch of each
+        shard may be smaller.
+
+        Args:
+            batch_size (int): The number of patches per batch
+            shuffle_shards (bool): Whether to visit the shards in a random order, e.g. a
+                new one every epoch. Patches within a shard keep their order.
+            random_seed (Optional[int]): Seeds the shard order
+        """
+        if batch_size <= 0:
+            raise ValueError("Batch size must be greater than 0")
+        shard_order = np.arange(self.shard_count)
+        if shuffle_shards:
+            np.random.default_rng(random_seed).shuffle(shard_order)
+        shard_starts = np.concatenate(([0], np.cumsum(self.shard_counts)))
+        buffer = np.empty(
+            min(batch_size, max(self.shard_counts, default=1)),
+            dtype=self.record_dtype,
+        )
+        # Patches are indexed in write order, which is shard order
+        for shard in shard_order.tolist():
+            with open(self.shard_files[shard], "rb") as shard_file:
+                for start in range(0, self.shard_counts[shard], buffer.shape[0]):
+                    count = min(buffer.shape[0], self.shard_counts[shard] - start)
+                    records = buffer[:count]
+                    if shard_file.readinto(records.view(np.uint8).data) != (
+                        records.nbytes
+                    ):
+                        raise ValueError(
+                            f"Shard {self.shard_files[shard]} is truncated"
+                        )
+                    indices = np.arange(
+                        shard_starts[shard] + start, shard_starts[shard] + start + count
+                    )
+                    yield indices, records["data"], records["validity"]
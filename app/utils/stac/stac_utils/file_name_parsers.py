@@ -68,6 +68,7 @@ class FileNameParser:
         return {
             ApplicableFields.PLATFORM.value: PLATFORM_MAPPINGS.get(parts[0]),
             ApplicableFields.PROCESSING_LEVEL.value: ProcessingLevels(parts[1]).value,
+            ApplicableFields.PATH_ROW.value: parts[2],
             ApplicableFields.DATETIME.value: datetime.datetime.strptime(
                 parts[3], "%Y%m%d"
             ),
@@ -2,10 +2,11 @@
 Gets the bounding box from a landsat file
 """
 
-from typing import List
+from typing import List, Optional
 import logging
 
 import rasterio
+from rasterio.io import DatasetReader
 from rasterio.warp import transform_bounds
 
 
@@ -13,22 +14,34 @@ logger = logging.getLogger("LandSatBoundingBoxIdentification")
 logger.setLevel(logging.INFO)
 
 
-def get_landsat_bounding_box(path: str) -> List[float]:
+def _wgs84_bounds(src: DatasetReader) -> List[float]:
+    """
+    Transforms the bounds of an open dataset from the File CRS to the Lat/Lon in WGS84
+    """
+    min_lon, min_lat, max_lon, max_lat = transform_bounds(
+        src.crs, "EPSG:4326", *src.bounds
+    )
+    return [min_lon, min_lat, max_lon, max_lat]
+
+
+def get_landsat_bounding_box(
+    path: str, dataset: Optional[DatasetReader] = None
+) -> List[float]:
     """
     Opens up a land sat tif file and extracts the bounds from it in the WGS84 form
     Note that STAC needs the bounds of the Item to be specified as coordinates on the 3D WGS84 ellipsoid.
     This function performs that conversion for landsat files specified as TIF.
     Applicable all Landsat and similar providers.
+
+    An already open dataset handle (e.g. from a TIFHelper) can be passed in to avoid
+    opening the file again. The handle is left open.
     """
     try:
+        if dataset is not None:
+            return _wgs84_bounds(dataset)
         # Open up the file
         with rasterio.open(path) as src:
-            # Transform the bounds from the File CRS to the Lat/Lon in WGS84
-            # This is a simple operation in the
-            min_lon, min_lat, max_lon, max_lat = transform_bounds(
-                src.crs, "EPSG:4326", *src.bounds
-            )
-            return [min_lon, min_lat, max_lon, max_lat]
+            return _wgs84_bounds(src)
     except Exception as err:
         logging.error(
             "Extraction of bounding boxes from the provided path: %s errored out", path
@@ -3,10 +3,11 @@ Class that unifies all the parsers and creates a
 proper stac item and corresponding assets
 """
 
-from typing import Dict, List, Any, Tuple
+from typing import Dict, List, Any, Tuple, Optional
 import logging
 
 from pystac import Item, Asset, MediaType
+from rasterio.io import DatasetReader
 
 from app.utils.stac.stac_utils.file_name_parsers import FileNameParser
 from app.utils.stac.stac_utils.get_landsat_bounding_box import get_landsat_bounding_box
@@ -22,9 +23,12 @@ class StacCreator:
     Creates STAC items and assets for the provided files
     """
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, raster_dataset: Optional[DatasetReader] = None):
         """
         Class constructor
+
+        An open rasterio dataset for the file can be supplied so that raster bounds
+        are read from it instead of re-opening the file.
         """
         self.file_path: str = file_path
         # First parse and create the filename
@@ -52,7 +56,9 @@ class StacCreator:
             self.bounding_box: List[float] = get_prisma_bounding_box(self.file_path)
             self.asset_role = AssetRole.HYPERSPECTRAL.value
         elif self.metadata.get("platform") == "landsat-9":
-            self.bounding_box: List[float] = get_landsat_bounding_box(self.file_path)
+            self.bounding_box: List[float] = get_landsat_bounding_box(
+                self.file_path, dataset=raster_dataset
+            )
             self.asset_role = AssetRole.THERMAL.value
         self.geom = self._build_geojson_geometry()
 
@@ -3,17 +3,27 @@ Device setter across mac and other linux devices
 """
 
 import logging
-import torch
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import torch
 
 logger = logging.getLogger("DeviceSelection")
 logger.setLevel(logging.INFO)
 
 
-def get_device():
+@lru_cache(maxsize=None)
+def get_device() -> "torch.device":
     """
     Automatically selects the best available device.
     Priority: CUDA (Nvidia) -> MPS (Mac Silicon) -> CPU
+
+    torch is imported on the first call only and the decision is made once per process,
+    so probing for devices is paid at most once however many callers ask for it.
     """
+    import torch  # pylint: disable=import-outside-toplevel
+
     if torch.cuda.is_available():
         device = "cuda"
     elif torch.backends.mps.is_available():
@@ -1,5 +1,5 @@
 from matplotlib import pyplot as plt
-from typing import List, Dict
+from typing import List, Dict, Optional
 import math
 import numpy as np
 
@@ -7,6 +7,7 @@ import numpy as np
 from app.models.images.cube_representation import CubeRepresentation
 from app.models.file_processing.sources import FileSourceConfig
 from app.utils.image_transformation.image_cube_operations import ImageCubeOperations
+from app.utils.image_transformation.lazy_cube import LazyCube
 from app.utils.files.he5_helper import HE5Helper
 from app.utils.files.tif_helper import TIFHelper
 from app.templates.template_mappings import TEMPLATE_MAPPINGS, TemplateIdentifier
@@ -35,10 +36,16 @@ class BasicBandLevelVisualizationHE5:
         self.max_cols = 3
 
     def visualize_band(
-        self, band_numbers: List[int], spectral_family: SpectralFamily, file_name: str
+        self,
+        band_numbers: List[int],
+        spectral_family: SpectralFamily,
+        file_name: str,
+        cube: Optional[LazyCube] = None,
     ):
         """
         Visualizes a band of a cube.
+        When a lazy cube is given, the band numbers index its channels and
+        the bands are read from it instead of the file.
         """
         # Get the number of plots
         num_plots = len(band_numbers)
@@ -62,20 +69,20 @@ class BasicBandLevelVisualizationHE5:
 
         for i, ax in enumerate(axes_flat):
             if i < num_plots:
-                single_band = self.helper.extract_specific_bands(
-                    bands=[band_numbers[i]],
-                    masking_needed=True,
-                    spectral_family=spectral_family,
-                    mode="specific",
-                )
-                print(single_band.min(), print(single_band.max()))
-                # Transform the image to BIP
-                single_band = self.image_cube_operations.convert_cube(
-                    single_band,
-                    from_format=CubeRepresentation.BIL,
-                    to_format=CubeRepresentation.BIP,
-                )
-                print(type(single_band))
+                if cube is None:
+                    band_cube = LazyCube(
+                        data=self.helper.extract_specific_bands(
+                            bands=[band_numbers[i]],
+                            masking_needed=True,
+                            spectral_family=spectral_family,
+                            mode="specific",
+                        ),
+                        representation=CubeRepresentation.BIL,
+                    )
+                    # Take the band as an (H, W) view, no need to convert the layout
+                    single_band = band_cube.band(0)
+                else:
+                    single_band = cube.band(band_numbers[i])
                 im = ax.imshow(single_band, cmap="Spectral")
                 plot_images.append(im)
                 label_text = f"Band : {band_numbers[i]}"
@@ -119,9 +126,16 @@ class BasicBandLevelVisualizationTIF:
         self.image_cube_operations = ImageCubeOperations()
         self.max_cols = 3
 
-    def visualize_band(self, band_numbers: List[int], file_name: str):
+    def visualize_band(
+        self,
+        band_numbers: List[int],
+        file_name: str,
+        cube: Optional[LazyCube] = None,
+    ):
         """
         Visualizes a band of a cube.
+        When a lazy cube is given, the band numbers index its channels (starting at 1 as in
+        the file) and the bands are read from it instead of the file.
         """
         # Get the number of plots
         num_plots = len(band_numbers)
@@ -149,9 +163,16 @@ class BasicBandLevelVisualizationTIF:
 
         # get the band from the file
         # A short note here - we are pulling out the bands directly from the file.
-        cube = self.helper.extract_specific_bands(
-            bands=band_numbers, mode="specific", masking_needed=True
-        )
+        if cube is None:
+            cube = LazyCube(
+                data=self.helper.extract_specific_bands(
+                    bands=band_numbers, mode="specific", masking_needed=True
+                ),
+                representation=CubeRepresentation.BSQ,
+            )
+            band_positions = list(range(num_plots))
+        else:
+            band_positions = [band - 1 for band in band_numbers]
 
         # However, we have to be careful here because the bands in TIF start at 1 and since we
         # are pulling them out specifically, the band indexes will get reset and we will have to map them back.
@@ -159,16 +180,11 @@ class BasicBandLevelVisualizationTIF:
         band_mapping: Dict[int, int] = {i: band for i, band in enumerate(band_numbers)}
 
         # We have now extracted the bands,
-        # Cast the cube to BIP format
         # By default TIF files are in BSQ format.
-        # We convert them to BIP Format for visualization
-        cube = self.image_cube_operations.convert_cube(
-            cube, CubeRepresentation.BSQ, CubeRepresentation.BIP, output_form="numpy"
-        )
-
+        # Each band is taken as an (H, W) view for visualization, without converting the cube
         for i, ax in enumerate(axes_flat):
             if i < num_plots:
-                single_band = cube[:, :, i]
+                single_band = cube.band(band_positions[i])
                 im = ax.imshow(single_band, cmap="plasma")
                 plot_images.append(im)
                 label_text = f"Band : {band_mapping[i]}"
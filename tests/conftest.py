@@ -2,7 +2,7 @@
 Test configurations
 """
 
-from typing import Dict, List
+from typing import Callable, Dict, List
 import pytest
 from app.models.file_processing.sources import FileSourceConfig
 
@@ -61,3 +61,144 @@ def hyperspectral_band_numbers() -> List[int]:
     """
 
     return [11, 12, 35, 50, 49, 30, 32]
+
+
+def write_synthetic_prisma(
+    directory,
+    height: int = 40,
+    width: int = 30,
+    swir_bands: int = 12,
+    vnir_bands: int = 8,
+) -> FileSourceConfig:
+    """
+    Writes a small PRISMA L2D shaped HE5 file to a directory.
+    Mirrors the layout of the real payloads (BIL cubes, error matrices, geolocation
+    arrays and root attributes) so the readers can be tested without the large files.
+    """
+    # Local imports keep the helper self contained
+    import h5py
+    import numpy as np
+
+    rng = np.random.default_rng(7)
+
+    path = directory / "PRS_L2D_STD_20201214060713_20201214060717_0001.he5"
+    swath = "HDFEOS/SWATHS/PRS_L2D_HCO"
+    with h5py.File(path, "w") as file:
+        for name, bands in (("SWIR", swir_bands), ("VNIR", vnir_bands)):
+            cube = rng.integers(1, 65535, size=(height, bands, width), dtype=np.uint16)
+            # Zero out a no-data border like the real scenes
+            cube[:3, :, :] = 0
+            errors = np.zeros((height, bands, width), dtype=np.uint8)
+            errors[10:12, :, 5:9] = 1
+            file.create_dataset(
+                f"{swath}/Data Fields/{name}_Cube", data=cube, chunks=(8, bands, 8)
+            )
+            file.create_dataset(
+                f"{swath}/Data Fields/{name}_PIXEL_L2_ERR_MATRIX", data=errors
+            )
+        lats, lons = np.meshgrid(
+            np.linspace(10.0, 10.5, width), np.linspace(70.0, 70.5, height)
+        )
+        file.create_dataset(f"{swath}/Geolocation Fields/Latitude", data=lats)
+        file.create_dataset(f"{swath}/Geolocation Fields/Longitude", data=lons)
+        file.attrs["List_Cw_Swir"] = np.linspace(2500.0, 1000.0, swir_bands)
+        file.attrs["List_Cw_Swir_Flags"] = np.array(
+            [1] * (swir_bands - 2) + [0, 0], dtype=np.int8
+        )
+        file.attrs["List_Fwhm_Swir"] = np.full(swir_bands, 10.0)
+        file.attrs["List_Cw_Vnir"] = np.linspace(1000.0, 400.0, vnir_bands)
+        file.attrs["List_Cw_Vnir_Flags"] = np.ones(vnir_bands, dtype=np.int8)
+        file.attrs["List_Fwhm_Vnir"] = np.full(vnir_bands, 12.0)
+        file.attrs["L2ScaleSwirMax"] = 0.9
+        file.attrs["L2ScaleSwirMin"] = 0.0
+        file.attrs["L2ScaleVnirMax"] = 0.8
+        file.attrs["L2ScaleVnirMin"] = 0.0
+        file.attrs["Product_ID"] = b"PRS_L2D_STD"
+
+    return FileSourceConfig(source_path=str(path))
+
+
+@pytest.fixture
+def synthetic_prisma_source(tmp_path) -> FileSourceConfig:
+    """
+    A small synthetic PRISMA L2D HE5 file
+    """
+    return write_synthetic_prisma(tmp_path)
+
+
+@pytest.fixture
+def synthetic_prisma_factory(tmp_path_factory) -> Callable[..., FileSourceConfig]:
+    """
+    Writes synthetic PRISMA L2D HE5 files of a requested size
+    """
+
+    def factory(**kwargs) -> FileSourceConfig:
+        return write_synthetic_prisma(tmp_path_factory.mktemp("prisma"), **kwargs)
+
+    return factory
+
+
+def write_synthetic_landsat(
+    directory, height: int = 120, width: int = 100
+) -> FileSourceConfig:
+    """
+    Writes a Landsat 9 L2SP B10 shaped GeoTIFF to a directory.
+    Warm land with a cold cloud bank and a no-data border, in surface temperature DNs.
+    """
+    # Local imports keep the helper self contained
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(11)
+
+    # Land sits around 30C and the cloud bank around -5C after DN -> ST conversion
+    dn = rng.normal(loc=44_700, scale=900, size=(height, width))
+    cloud_rows = slice(height // 6, height // 2)
+    cloud_cols = slice(int(width * 0.15), int(width * 0.55))
+    dn[cloud_rows, cloud_cols] = rng.normal(
+        loc=37_300, scale=600, size=dn[cloud_rows, cloud_cols].shape
+    )
+    dn = np.clip(dn, 1, 65_535).astype(np.uint16)
+    dn[:, :4] = 0
+    dn[-5:, :] = 0
+
+    path = directory / "LC09_L2SP_150044_20251009_20251010_02_T1_ST_B10.TIF"
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype="uint16",
+        crs="EPSG:32643",
+        transform=from_origin(300_000.0, 2_400_000.0, 30.0, 30.0),
+        nodata=0,
+        tiled=True,
+        blockxsize=32,
+        blockysize=32,
+    ) as dst:
+        dst.write(dn, 1)
+
+    return FileSourceConfig(source_path=str(path))
+
+
+@pytest.fixture
+def synthetic_landsat_source(tmp_path) -> FileSourceConfig:
+    """
+    A small synthetic Landsat 9 L2SP B10 GeoTIFF
+    """
+    return write_synthetic_landsat(tmp_path)
+
+
+@pytest.fixture
+def synthetic_landsat_factory(tmp_path_factory) -> Callable[..., FileSourceConfig]:
+    """
+    Writes synthetic Landsat 9 L2SP B10 GeoTIFFs of a requested size
+    """
+
+    def factory(**kwargs) -> FileSourceConfig:
+        return write_synthetic_landsat(tmp_path_factory.mktemp("landsat"), **kwargs)
+
+    return factory
@@ -0,0 +1,78 @@
+"""
+Tests the pairing of image cubes with their validity
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.validated_cube import ValidatedCube
+
+
+@pytest.fixture
+def masked_cube() -> np.ma.MaskedArray:
+    """
+    A small masked cube with a masked border
+    """
+    data = np.arange(2 * 5 * 11, dtype=np.float32).reshape(2, 5, 11)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[:, 0, :] = True
+    mask[1, :, -1] = True
+    return np.ma.MaskedArray(data=data, mask=mask)
+
+
+def test_masked_array_round_trip(masked_cube):
+    """
+    Converting from and to masked arrays keeps the data and the mask and shares the data
+    """
+    cube = ValidatedCube.from_masked_array(masked_cube)
+
+    assert np.shares_memory(cube.data, masked_cube.data)
+    assert np.array_equal(cube.validity, ~masked_cube.mask)
+    assert cube.valid_count == masked_cube.count()
+    assert np.array_equal(cube.valid_values(), masked_cube.compressed())
+
+    restored = cube.to_masked_array()
+    assert np.array_equal(restored.mask, masked_cube.mask)
+    assert np.array_equal(restored.data, masked_cube.data)
+
+
+def test_fully_valid_cubes_hold_no_validity(masked_cube):
+    """
+    Masks without invalid pixels are never kept
+    """
+    for mask in (None, np.ma.nomask, np.zeros(masked_cube.shape, dtype=bool)):
+        cube = ValidatedCube.from_mask(masked_cube.data, mask)
+        assert cube.is_fully_valid
+        assert cube.valid_count == masked_cube.size
+        assert cube.pack_validity() is None
+        assert cube.validity_mask().all()
+        assert np.array_equal(cube.valid_values(), masked_cube.data.ravel())
+
+
+def test_derived_cubes_share_validity(masked_cube):
+    """
+    New data and transposes reuse the validity without copies
+    """
+    cube = ValidatedCube.from_masked_array(masked_cube)
+
+    derived = cube.with_data(cube.data * 2)
+    assert derived.validity is cube.validity
+
+    transposed = cube.transpose((1, 2, 0))
+    assert np.shares_memory(transposed.validity, cube.validity)
+    assert np.array_equal(transposed.validity, cube.validity.transpose(1, 2, 0))
+
+    packed = cube.pack_validity()
+    assert np.array_equal(packed.unpack() != 0, cube.validity)
+
+
+def test_validation(masked_cube):
+    """
+    Validity must be a boolean array of the shape of the data
+    """
+    with pytest.raises(ValueError):
+        ValidatedCube(data=masked_cube.data, validity=np.ones((2, 5), dtype=bool))
+    with pytest.raises(ValueError):
+        ValidatedCube(
+            data=masked_cube.data, validity=np.ones(masked_cube.shape, dtype=np.int8)
+        )
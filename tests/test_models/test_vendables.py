@@ -0,0 +1,161 @@
+"""
+Tests persisting and memory mapping vendable datasets
+"""
+
+import os
+import json
+
+import numpy as np
+import pytest
+
+from app.models.dataset.vendables import (
+    MANIFEST_FILE_NAME,
+    VendableHyperspectralDataset,
+    VendableThermalDataset,
+)
+from app.models.dataset.packed_validity import PackedValidity
+from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
+from app.utils.dataset_builder.prisma_dataset_builder import PrismaDatasetBuilder
+
+
+def test_hyperspectral_round_trip(synthetic_prisma_source, tmp_path):
+    """
+    A saved dataset must load back as read only memory maps with the same contents
+    """
+    builder = PrismaDatasetBuilder(file_source_configuration=synthetic_prisma_source)
+    vendable = builder.vend_dataset()
+    directory = str(tmp_path / "scene")
+    manifest_path = vendable.save(directory)
+
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert manifest["spectral_family_order"][0] == SpectralFamily.SWIR.value
+    assert len(manifest["band_fwhm_order"]) == len(vendable.band_cw_order)
+
+    loaded = VendableHyperspectralDataset.load(directory)
+    assert isinstance(loaded.normalized_hyperspectral_cube, np.memmap)
+    assert isinstance(loaded.validity_cube, np.memmap)
+    assert not loaded.normalized_hyperspectral_cube.flags.writeable
+    assert np.array_equal(
+        loaded.normalized_hyperspectral_cube, vendable.normalized_hyperspectral_cube
+    )
+    assert np.array_equal(loaded.validity_cube, vendable.validity_cube)
+    assert loaded.validity_cube.dtype == vendable.validity_cube.dtype
+    assert loaded.spectral_family_order == vendable.spectral_family_order
+    assert loaded.band_cw_order == vendable.band_cw_order
+    assert loaded.band_fwhm_order == vendable.band_fwhm_order
+
+    # Reading fully into memory is still possible
+    in_memory = VendableHyperspectralDataset.load(directory, mmap_mode=None)
+    assert not isinstance(in_memory.normalized_hyperspectral_cube, np.memmap)
+
+
+def test_streaming_output_is_loadable(synthetic_prisma_source, tmp_path):
+    """
+    Streaming into a directory must leave a complete persisted dataset behind
+    """
+    builder = PrismaDatasetBuilder(file_source_configuration=synthetic_prisma_source)
+    directory = str(tmp_path / "streamed")
+    vendable = builder.vend_dataset(
+        streaming=True, block_rows=16, output_directory=directory
+    )
+    assert os.path.exists(os.path.join(directory, MANIFEST_FILE_NAME))
+
+    loaded = VendableHyperspectralDataset.load(directory)
+    assert np.array_equal(
+        loaded.normalized_hyperspectral_cube, vendable.normalized_hyperspectral_cube
+    )
+    assert np.array_equal(loaded.validity_cube, vendable.validity_cube)
+
+
+def test_thermal_round_trip(tmp_path):
+    """
+    Thermal datasets are persisted the same way and cannot be loaded as hyperspectral ones
+    """
+    rng = np.random.default_rng(0)
+    vendable = VendableThermalDataset(
+        normalized_thermal_cube=rng.random((1, 20, 10), dtype=np.float32),
+        validity_cube=rng.integers(0, 2, (1, 20, 10), dtype=np.int8),
+    )
+    directory = str(tmp_path / "thermal")
+    vendable.save(directory)
+
+    loaded = VendableThermalDataset.load(directory)
+    assert isinstance(loaded.normalized_thermal_cube, np.memmap)
+    assert np.array_equal(
+        loaded.normalized_thermal_cube, vendable.normalized_thermal_cube
+    )
+    assert np.array_equal(loaded.validity_cube, vendable.validity_cube)
+
+    with pytest.raises(ValueError):
+        VendableHyperspectralDataset.load(directory)
+
+
+def test_packed_validity_accessors():
+    """
+    Unpacking bands and windows must agree with slicing the unpacked cube,
+    including windows that do not start or end on a byte boundary
+    """
+    rng = np.random.default_rng(1)
+    cube = rng.integers(0, 2, (5, 17, 29), dtype=np.int8)
+    packed = PackedValidity.from_cube(cube)
+
+    assert packed.packed.shape == (5, 17, 4)
+    assert packed.nbytes * 7 < cube.nbytes
+    assert np.array_equal(packed.unpack(), cube)
+    assert packed.unpack().dtype == np.int8
+    for index in range(cube.shape[0]):
+        assert np.array_equal(packed.band(index), cube[index])
+    for rows, cols in [
+        (slice(0, 17), slice(0, 29)),
+        (slice(3, 9), slice(5, 6)),
+        (slice(2, 11), slice(7, 25)),
+        (slice(0, 1), slice(16, 24)),
+        (slice(4, 5), slice(28, None)),
+    ]:
+        assert np.array_equal(packed.window(rows, cols), cube[:, rows, cols])
+    assert np.array_equal(
+        packed.window(slice(1, 4), slice(3, 20), bands=[4, 0]),
+        cube[[4, 0], 1:4, 3:20],
+    )
+
+
+def test_packed_vend(synthetic_prisma_source, tmp_path):
+    """
+    Packed validity from every vend path must match the unpacked validity cube
+    and survive a save and load
+    """
+    builder = PrismaDatasetBuilder(file_source_configuration=synthetic_prisma_source)
+    reference = builder.vend_dataset(streaming=True)
+    expected = reference.validity_cube
+
+    packed_in_memory = builder.vend_dataset(pack_validity=True)
+    directory = str(tmp_path / "packed")
+    packed_streamed = builder.vend_dataset(
+        streaming=True, block_rows=7, output_directory=directory, pack_validity=True
+    )
+    loaded = VendableHyperspectralDataset.load(directory)
+
+    for vendable in [packed_in_memory, packed_streamed, loaded]:
+        assert vendable.is_validity_packed
+        assert vendable.validity_cube is None
+        assert np.array_equal(vendable.full_validity(), expected)
+        assert np.array_equal(vendable.validity_band(3), expected[3])
+        assert np.array_equal(
+            vendable.validity_window(slice(5, 20), slice(3, 14)),
+            expected[:, 5:20, 3:14],
+        )
+    assert not os.path.exists(os.path.join(directory, "validity_cube.npy"))
+
+    # The accessors behave the same on unpacked datasets
+    assert np.array_equal(reference.validity_band(3), expected[3])
+    assert np.array_equal(
+        reference.pack_validity().full_validity(), reference.full_validity()
+    )
+
+    with pytest.raises(ValueError):
+        VendableHyperspectralDataset(
+            normalized_hyperspectral_cube=reference.normalized_hyperspectral_cube,
+            spectral_family_order=reference.spectral_family_order,
+            band_cw_order=reference.band_cw_order,
+        )
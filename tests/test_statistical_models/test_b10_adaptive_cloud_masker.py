@@ -9,6 +9,7 @@ from app.utils.data_transformations.l2sp_dn_to_temperature_transformer import (
     Lc09L2spStTransformer,
 )
 from app.models.units.surface_temperature import Temperature
+from app.models.images.validated_cube import ValidatedCube
 from app.utils.files.tif_helper import TIFHelper
 from app.models.intermediate_concepts.adaptive_cloud_masker_response import (
     AdaptiveCloudMaskerResponse,
@@ -109,3 +110,51 @@ def test_adaptive_b10_cloud_masker_benchmark(benchmark, base_data):
     # Run the benchmark
     result = benchmark(model.train, base_data)
     assert result is None
+
+
+def test_validated_cube_matches_masked_array(synthetic_landsat_source):
+    """
+    A model fit on a validated cube must label pixels as it does a masked array
+    """
+    helper = TIFHelper(
+        file_source_config=synthetic_landsat_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.LANDSAT_THERMAL),
+    )
+    temperature_converter = Lc09L2spStTransformer()
+    validated = temperature_converter.transform(
+        input_data=helper.extract_specific_bands(mode="all", validated=True),
+        unit=Temperature.CELSIUS,
+    )
+    masked = temperature_converter.transform(
+        input_data=helper.extract_specific_bands(masking_needed=True, mode="all"),
+        unit=Temperature.CELSIUS,
+    )
+    helper.close()
+    assert isinstance(validated, ValidatedCube)
+    assert np.array_equal(validated.valid_values(), masked.compressed())
+
+    model = B10AdaptiveCloudMasker()
+    model.configure()
+    model.train(validated)
+    validated_response = model.predict(validated)
+    masked_response = model.predict(masked)
+
+    assert np.array_equal(validated_response.cloud_mask, masked_response.cloud_mask)
+    # The cold cloud bank is found and no-data pixels are never clouds
+    assert validated_response.cloud_mask[0, 25:55, 20:50].mean() > 0.9
+    assert not validated_response.cloud_mask[~validated.validity].any()
+
+
+@pytest.mark.large_files
+@pytest.mark.parametrize("prediction_mode", ["labels", "thresholds"])
+def test_adaptive_b10_cloud_masker_prediction_benchmark(
+    benchmark, base_data, prediction_mode
+):
+    """
+    Benchmarks prediction on the thermal payload in each prediction mode
+    """
+    model = B10AdaptiveCloudMasker()
+    model.configure(sampling_ratio=0.1, prediction_mode=prediction_mode)
+    model.train(base_data)
+    result = benchmark(model.predict, base_data)
+    assert result.pixels_masked > 1000
@@ -0,0 +1,112 @@
+"""
+Tests persisting, restoring and warm starting cloud masker models
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.validated_cube import ValidatedCube
+from app.statistical_models.b10_adaptive_cloud_masker import B10AdaptiveCloudMasker
+from app.statistical_models.cloud_masker_registry import CloudMaskerRegistry, scene_key
+
+
+def make_scene(seed: int, land_temperature: float) -> ValidatedCube:
+    """
+    A celsius scene of warm land with a cloud bank and a no-data strip
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(land_temperature, 4.0, size=(1, 400, 400)).astype(np.float32)
+    data[0, 50:200, 50:300] = rng.normal(-5.0, 5.0, size=(150, 250))
+    validity = np.ones(data.shape, dtype=bool)
+    validity[:, :, :20] = False
+    return ValidatedCube(data=data, validity=validity)
+
+
+def test_scene_key():
+    """
+    Path, row and month come from the Landsat file name
+    """
+    assert scene_key("/data/LC09_L2SP_150044_20251009_20251010_02_T1_ST_B10.TIF") == (
+        150,
+        44,
+        10,
+    )
+
+
+def test_registry_round_trip(tmp_path):
+    """
+    Stored parameters come back unchanged and broken files are ignored
+    """
+    registry = CloudMaskerRegistry(registry_directory=str(tmp_path))
+    assert registry.load(150, 44, 10) is None
+
+    model = B10AdaptiveCloudMasker()
+    model.configure(engine="histogram")
+    model.train(make_scene(0, 30.0))
+    parameters = model.export_parameters(150, 44, 10)
+    path = registry.store(parameters)
+
+    assert registry.load(150, 44, 10) == parameters
+    assert registry.load(150, 44, 11) is None
+
+    with open(path, "w", encoding="utf-8") as parameters_file:
+        parameters_file.write("{not json")
+    assert registry.load(150, 44, 10) is None
+
+
+@pytest.mark.parametrize("prediction_mode", ["labels", "thresholds"])
+def test_restored_model_predicts_identically(prediction_mode):
+    """
+    A model restored from exported parameters must predict the masks of the original
+    """
+    scene = make_scene(0, 30.0)
+    model = B10AdaptiveCloudMasker()
+    model.configure(engine="histogram", prediction_mode=prediction_mode)
+    model.train(scene)
+
+    restored = B10AdaptiveCloudMasker()
+    restored.configure(prediction_mode=prediction_mode)
+    restored.restore(model.export_parameters(150, 44, 10))
+
+    assert np.array_equal(
+        restored.predict(scene).cloud_mask, model.predict(scene).cloud_mask
+    )
+
+
+def test_seeded_training_is_reproducible():
+    """
+    Seeded sampling makes the sklearn engine deterministic
+    """
+    scene = make_scene(0, 30.0)
+    fits = []
+    for _ in range(2):
+        model = B10AdaptiveCloudMasker()
+        model.configure(sampling_ratio=0.05, random_seed=7)
+        model.train(scene)
+        fits.append(model.export_parameters(150, 44, 10))
+    assert fits[0] == fits[1]
+
+
+@pytest.mark.parametrize("engine", ["sklearn", "histogram"])
+def test_warm_start(engine):
+    """
+    Warm starting from a similar scene converges at least as fast to the same clouds
+    """
+    previous = B10AdaptiveCloudMasker()
+    previous.configure(engine=engine, random_seed=0)
+    previous.train(make_scene(1, 31.0))
+    parameters = previous.export_parameters(150, 44, 10)
+
+    scene = make_scene(2, 29.0)
+    cold = B10AdaptiveCloudMasker()
+    cold.configure(engine=engine, random_seed=0)
+    cold.train(scene)
+    warm = B10AdaptiveCloudMasker()
+    warm.configure(engine=engine, random_seed=0, warm_start=parameters)
+    warm.train(scene)
+
+    assert warm.model.n_iter_ <= cold.model.n_iter_
+    assert warm.export_parameters(150, 44, 10).scene_count == 2
+    assert (
+        np.mean(warm.predict(scene).cloud_mask != cold.predict(scene).cloud_mask) < 0.01
+    )
@@ -0,0 +1,105 @@
+"""
+Tests the histogram driven Gaussian mixture and its use by the cloud masker
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.validated_cube import ValidatedCube
+from app.statistical_models.b10_adaptive_cloud_masker import B10AdaptiveCloudMasker
+from app.statistical_models.histogram_gaussian_mixture import (
+    HistogramGaussianMixture,
+    build_histogram,
+    histogram_percentiles,
+    truncate_histogram,
+)
+
+BIN_WIDTH = 0.01
+
+
+@pytest.fixture(scope="module")
+def temperature_scene() -> ValidatedCube:
+    """
+    A celsius scene of warm land with a cloud bank, an ice cloud, a hot spot and a no-data strip
+    """
+    rng = np.random.default_rng(0)
+    data = rng.normal(30.0, 4.0, size=(1, 600, 600)).astype(np.float32)
+    data[0, 50:200, 50:400] = rng.normal(-5.0, 5.0, size=(150, 350))
+    data[0, 350:450, 100:200] = rng.normal(-35.0, 6.0, size=(100, 100))
+    data[0, 500:520, 500:520] = rng.normal(60.0, 3.0, size=(20, 20))
+    validity = np.ones(data.shape, dtype=bool)
+    validity[:, :, :20] = False
+    return ValidatedCube(data=data, validity=validity)
+
+
+def test_histogram_percentiles():
+    """
+    Percentiles read from the histogram are within a bin of the exact percentiles
+    """
+    values = np.random.default_rng(1).normal(10.0, 7.0, size=200_000)
+    counts, edges = build_histogram(values, bin_width=BIN_WIDTH)
+    assert counts.sum() == values.size
+
+    percentiles = [2, 8, 50, 92, 95, 98]
+    assert np.allclose(
+        histogram_percentiles(counts, edges, percentiles),
+        np.percentile(values, percentiles),
+        atol=BIN_WIDTH,
+    )
+
+    weights = truncate_histogram(counts, edges, 10.0)
+    assert weights.sum() == pytest.approx((values <= 10.0).sum(), abs=counts.max())
+
+    with pytest.raises(ValueError):
+        build_histogram(values, bin_width=0.0)
+
+
+def test_mixture_recovers_components():
+    """
+    A two component mixture fit on a histogram recovers the generating parameters
+    """
+    rng = np.random.default_rng(2)
+    values = np.concatenate(
+        [rng.normal(-5.0, 2.0, size=60_000), rng.normal(20.0, 4.0, size=140_000)]
+    )
+    counts, edges = build_histogram(values, bin_width=BIN_WIDTH)
+    model = HistogramGaussianMixture(
+        n_components=2, means_init=np.array([[0.0], [10.0]])
+    ).fit_histogram((edges[:-1] + edges[1:]) / 2, counts, bin_width=BIN_WIDTH)
+
+    assert model.converged_
+    assert model.means_.shape == (2, 1)
+    assert model.covariances_.shape == (2, 1, 1)
+    assert np.allclose(model.means_.ravel(), [-5.0, 20.0], atol=0.1)
+    assert np.allclose(np.sqrt(model.covariances_.ravel()), [2.0, 4.0], atol=0.1)
+    assert np.allclose(model.weights_, [0.3, 0.7], atol=0.01)
+    assert np.array_equal(model.predict(np.array([[-6.0], [25.0]])), [0, 1])
+
+
+def test_histogram_engine_matches_sklearn_engine(temperature_scene):
+    """
+    Both engines must find the same clouds up to a small fraction of pixels
+    """
+    masks = {}
+    for engine in ("sklearn", "histogram"):
+        model = B10AdaptiveCloudMasker()
+        model.configure(engine=engine)
+        model.train(temperature_scene)
+        masks[engine] = model.predict(temperature_scene).cloud_mask
+
+    assert masks["histogram"][0, 60:190, 60:390].mean() > 0.95
+    assert not masks["histogram"][~temperature_scene.validity].any()
+    assert np.mean(masks["histogram"] != masks["sklearn"]) < 0.01
+
+    with pytest.raises(ValueError):
+        B10AdaptiveCloudMasker().configure(engine="invalid")
+
+
+@pytest.mark.parametrize("engine", ["sklearn", "histogram"])
+def test_cloud_masker_training_benchmark(benchmark, temperature_scene, engine):
+    """
+    Benchmarks training the cloud masker with each engine
+    """
+    model = B10AdaptiveCloudMasker()
+    model.configure(engine=engine)
+    benchmark(model.train, temperature_scene)
@@ -0,0 +1,134 @@
+"""
+Tests closed form cloud mask prediction from mixture decision intervals
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.validated_cube import ValidatedCube
+from app.statistical_models.b10_adaptive_cloud_masker import B10AdaptiveCloudMasker
+from app.statistical_models.mixture_decision_intervals import (
+    decision_intervals,
+    interval_expression,
+)
+
+
+@pytest.fixture(scope="module")
+def temperature_scene() -> ValidatedCube:
+    """
+    A celsius scene of warm land with a cloud bank, an ice cloud and a no-data strip
+    """
+    rng = np.random.default_rng(3)
+    data = rng.normal(30.0, 4.0, size=(1, 500, 500)).astype(np.float32)
+    data[0, 50:200, 50:400] = rng.normal(-5.0, 5.0, size=(150, 350))
+    data[0, 300:400, 100:200] = rng.normal(-35.0, 6.0, size=(100, 100))
+    validity = np.ones(data.shape, dtype=bool)
+    validity[:, :, :20] = False
+    return ValidatedCube(data=data, validity=validity)
+
+
+def test_intervals_match_brute_force():
+    """
+    The intervals must select exactly the values whose most likely component is selected
+    """
+    weights = np.array([0.1, 0.2, 0.5, 0.15, 0.05])
+    means = np.array([-30.0, -5.0, 25.0, 32.0, 45.0])
+    variances = np.array([36.0, 30.0, 9.0, 4.0, 25.0])
+    values = np.linspace(-120.0, 150.0, 200_001)
+    winners = np.argmax(
+        np.log(weights)
+        - 0.5 * np.log(2 * np.pi * variances)
+        - 0.5 * (values[:, None] - means) ** 2 / variances,
+        axis=1,
+    )
+
+    for components in ([0, 1], [2], [4], []):
+        intervals = decision_intervals(weights, means, variances, components)
+        inside = np.zeros(values.shape, dtype=bool)
+        for lower, upper in intervals:
+            inside |= (values > lower) & (values <= upper)
+        assert np.array_equal(inside, np.isin(winners, components))
+
+    # The widest component wins again in both tails
+    assert decision_intervals(weights, means, variances, [0])[0][0] == -np.inf
+    assert decision_intervals(weights, means, variances, [0, 1])[-1][1] == np.inf
+
+
+def test_interval_expression():
+    """
+    Infinite bounds are dropped from the expression
+    """
+    expression, bounds = interval_expression([(-np.inf, 1.5), (4.0, np.inf)])
+    assert expression == "((x <= upper_0)) | ((x > lower_1))"
+    assert bounds == {"upper_0": 1.5, "lower_1": 4.0}
+    assert interval_expression([(-np.inf, np.inf)])[0] == "(x == x)"
+
+
+@pytest.mark.parametrize("engine", ["sklearn", "histogram"])
+def test_thresholds_match_labels(temperature_scene, engine):
+    """
+    Threshold prediction must flag exactly the pixels that label prediction flags
+    """
+    model = B10AdaptiveCloudMasker()
+    model.configure(engine=engine)
+    model.train(temperature_scene)
+    labels = model.predict(temperature_scene)
+    model.configure(engine=engine, prediction_mode="thresholds")
+    thresholds = model.predict(temperature_scene)
+    masked_thresholds = model.predict(temperature_scene.to_masked_array())
+
+    assert labels.cloud_intervals is None
+    assert thresholds.cloud_intervals == model.cloud_intervals
+    assert np.array_equal(thresholds.cloud_mask, labels.cloud_mask)
+    assert np.array_equal(masked_thresholds.cloud_mask, labels.cloud_mask)
+    assert thresholds.pixels_masked == labels.pixels_masked
+
+    with pytest.raises(ValueError):
+        model.configure(prediction_mode="invalid")
+
+
+def test_intervals_derived_once_per_fit(temperature_scene, monkeypatch):
+    """
+    The cloud intervals are derived when the model is fit or restored, predicting tile
+    after tile only reads them
+    """
+    model = B10AdaptiveCloudMasker()
+    model.configure(engine="histogram", prediction_mode="thresholds")
+    model.train(temperature_scene)
+    assert model.cloud_intervals
+    intervals = list(model.cloud_intervals)
+    whole = model.predict(temperature_scene).cloud_mask
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Intervals must not be derived at prediction")
+
+    monkeypatch.setattr(
+        "app.statistical_models.b10_adaptive_cloud_masker.decision_intervals", fail
+    )
+    for rows in (slice(0, 250), slice(250, 500)):
+        tile = ValidatedCube(
+            data=temperature_scene.data[:, rows],
+            validity=temperature_scene.validity[:, rows],
+        )
+        assert np.array_equal(model.predict(tile).cloud_mask, whole[:, rows])
+    assert model.cloud_intervals == intervals
+    monkeypatch.undo()
+
+    restored = B10AdaptiveCloudMasker()
+    restored.configure(engine="histogram", prediction_mode="thresholds")
+    restored.restore(model.export_parameters(wrs_path=1, wrs_row=1, month=1))
+    assert restored.cloud_intervals == intervals
+    assert np.array_equal(restored.cloud_indices, model.cloud_indices)
+
+
+@pytest.mark.parametrize("prediction_mode", ["labels", "thresholds"])
+def test_cloud_masker_prediction_benchmark(
+    benchmark, temperature_scene, prediction_mode
+):
+    """
+    Benchmarks cloud mask prediction in each mode
+    """
+    model = B10AdaptiveCloudMasker()
+    model.configure(engine="histogram", prediction_mode=prediction_mode)
+    model.train(temperature_scene)
+    benchmark(model.predict, temperature_scene)
@@ -0,0 +1,101 @@
+"""
+Tests the streaming statistics and the streaming training of the cloud masker
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.validated_cube import ValidatedCube
+from app.statistical_models.b10_adaptive_cloud_masker import B10AdaptiveCloudMasker
+from app.statistical_models.streaming_statistics import (
+    ReservoirSampler,
+    StreamingHistogram,
+)
+
+BIN_WIDTH = 0.01
+
+
+def test_streaming_histogram_matches_single_pass():
+    """
+    Chunks of any range accumulate into the histogram of all of their values
+    """
+    rng = np.random.default_rng(0)
+    chunks = [
+        rng.normal(20.0, 3.0, size=5_000),
+        rng.normal(-30.0, 2.0, size=3_000),
+        rng.normal(55.0, 1.0, size=500),
+        np.array([]),
+    ]
+    histogram = StreamingHistogram(bin_width=BIN_WIDTH)
+    for chunk in chunks:
+        histogram.add(chunk)
+    counts, edges = histogram.histogram()
+    values = np.concatenate(chunks)
+
+    assert histogram.total == values.size
+    assert np.allclose(np.diff(edges), BIN_WIDTH)
+    assert edges[0] <= values.min() and values.max() < edges[-1]
+    # The same counts as binning every value at once on the same grid
+    assert np.array_equal(counts, np.histogram(values, bins=edges)[0])
+
+    with pytest.raises(ValueError):
+        StreamingHistogram(bin_width=BIN_WIDTH).histogram()
+    with pytest.raises(ValueError):
+        StreamingHistogram(bin_width=0)
+
+
+def test_reservoir_sampler():
+    """
+    The reservoir holds everything until it is full and a uniform sample afterwards
+    """
+    sampler = ReservoirSampler(capacity=100, random_seed=0)
+    sampler.add(np.arange(60))
+    assert np.array_equal(sampler.sample(), np.arange(60))
+
+    # Every value of the stream is held with probability capacity / stream size
+    capacity, stream_size, repeats = 200, 2_000, 300
+    held = np.zeros(stream_size)
+    for seed in range(repeats):
+        sampler = ReservoirSampler(capacity=capacity, random_seed=seed)
+        for chunk in np.array_split(np.arange(stream_size), 7):
+            sampler.add(chunk)
+        assert sampler.seen == stream_size
+        sample = sampler.sample().astype(np.int64)
+        assert sample.size == capacity
+        assert np.unique(sample).size == capacity
+        held[sample] += 1
+    frequencies = held / repeats
+    expected = capacity / stream_size
+    assert np.all(np.abs(frequencies - expected) < 0.1)
+    # Early and late values are equally likely
+    halves = np.array_split(frequencies, 2)
+    assert abs(halves[0].mean() - halves[1].mean()) < 0.01
+
+
+@pytest.mark.parametrize("engine", ["sklearn", "histogram"])
+def test_train_streaming_matches_train(engine):
+    """
+    Training on the tiles of a scene fits the same mixture as training on the scene
+    """
+    rng = np.random.default_rng(2)
+    data = rng.normal(30.0, 4.0, size=(1, 200, 150)).astype(np.float32)
+    data[0, 20:90, 10:100] = rng.normal(-10.0, 5.0, size=(70, 90))
+    validity = np.ones(data.shape, dtype=bool)
+    validity[:, :, :10] = False
+    scene = ValidatedCube(data=data, validity=validity)
+
+    masker = B10AdaptiveCloudMasker()
+    masker.configure(engine=engine, random_seed=0)
+    masker.train(scene)
+    reference = masker.predict(scene).cloud_mask
+
+    streamed = B10AdaptiveCloudMasker()
+    streamed.configure(engine=engine, random_seed=0)
+    streamed.train_streaming(
+        ValidatedCube(data=data[:, rows], validity=validity[:, rows])
+        for rows in np.array_split(np.arange(200), 9)
+    )
+    assert np.mean(streamed.predict(scene).cloud_mask != reference) < 0.01
+
+    with pytest.raises(ValueError):
+        streamed.train_streaming(iter([]))
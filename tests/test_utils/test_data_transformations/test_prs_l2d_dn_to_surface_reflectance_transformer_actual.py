@@ -70,3 +70,51 @@ def test_sr_transformation_on_actual_data(benchmark, live_source_data):
         0.0,
     )
     assert result is not None
+
+
+@pytest.mark.large_files
+def test_fused_sr_and_validity_on_actual_data(benchmark, live_source_data):
+    """
+    Benchmarks the fused reflectance and validity kernel on the same cube as
+    test_sr_transformation_on_actual_data, which also has to build the masks separately
+    """
+    helper = HE5Helper(
+        file_source_config=live_source_data.get("hyperspectral_1"),
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+    )
+    cubes = []
+    errors = []
+    band_mappings = []
+    for family in [SpectralFamily.SWIR, SpectralFamily.VNIR]:
+        cube = helper.extract_specific_bands(
+            bands=[], spectral_family=family, masking_needed=False, mode="all"
+        )
+        cubes.append(cube)
+        errors.append(
+            helper.extract_error_matrices(bands=[], spectral_family=family, mode="all")
+        )
+        band_mappings.extend([family] * cube.shape[1])
+    full_bands = np.concatenate(cubes, axis=1)
+    full_errors = np.concatenate(errors, axis=1)
+
+    converter = PrsL2dDnToSurfaceReflectanceTransformer()
+    reflectance = np.empty(full_bands.shape, dtype=np.float32)
+    validity = np.empty(full_bands.shape, dtype=np.int8)
+
+    benchmark(
+        converter.transform_with_validity,
+        full_bands,
+        full_errors,
+        CubeRepresentation.BIL,
+        band_mappings,
+        helper.file_metadata,
+        None,
+        reflectance,
+        validity,
+    )
+
+    assert reflectance.max() <= 1.0
+    assert reflectance.min() >= 0.0
+    assert np.array_equal(
+        validity, ((full_bands != 0) & (full_errors == 0)).astype(np.int8)
+    )
@@ -13,6 +13,8 @@ from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
 from app.utils.image_transformation.image_cube_operations import (
     CubeRepresentation,
 )
+from app.utils.image_transformation.lazy_cube import LazyCube
+from app.models.images.validated_cube import ValidatedCube
 from app.utils.data_transformations.prs_l2d_dn_to_surface_reflectance_transformer import (
     PrsL2dDnToSurfaceReflectanceTransformer,
 )
@@ -278,3 +280,197 @@ def test_conversions_on_mock_masked_data(
         / 65535,
         4,
     )
+
+
+@pytest.mark.parametrize(
+    "representation,axes",
+    [
+        (CubeRepresentation.BIL, (0, 1, 2)),
+        (CubeRepresentation.BIP, (0, 2, 1)),
+        (CubeRepresentation.BSQ, (1, 0, 2)),
+    ],
+)
+def test_fused_conversion_matches_separate_passes(
+    file_metadata_mock, sample_input_data, representation, axes
+):
+    """
+    The fused kernel must match the reflectance of transform and the combined validity
+    of the separate non-zero, error and band checks in every representation
+    """
+    band_mapping, bil_cube = sample_input_data
+    rng = np.random.default_rng(3)
+    bil_errors = rng.integers(0, 2, bil_cube.shape, dtype=np.uint8)
+    band_validity = np.ones(len(band_mapping), dtype=bool)
+    band_validity[[2, 7]] = False
+
+    converter = PrsL2dDnToSurfaceReflectanceTransformer()
+    expected_reflectance = converter.transform(
+        input_data=bil_cube.copy(),
+        cube_representation=CubeRepresentation.BIL,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+    )
+    expected_validity = (
+        (bil_cube != 0) & (bil_errors == 0) & band_validity[None, :, None]
+    ).astype(np.int8)
+
+    reflectance, validity = converter.transform_with_validity(
+        input_data=np.ascontiguousarray(bil_cube.transpose(axes)),
+        error_data=np.ascontiguousarray(bil_errors.transpose(axes)),
+        cube_representation=representation,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        band_validity=band_validity,
+    )
+    assert reflectance.dtype == np.float32
+    assert validity.dtype == np.int8
+    assert np.allclose(reflectance, expected_reflectance.transpose(axes))
+    assert np.array_equal(validity, expected_validity.transpose(axes))
+
+    # Writing into views of larger buffers leaves the rest untouched
+    reflectance_buffer = np.full((5, 14, 4), -1.0, dtype=np.float32)
+    validity_buffer = np.full((5, 14, 4), -1, dtype=np.int8)
+    converter.transform_with_validity(
+        input_data=bil_cube,
+        error_data=bil_errors,
+        cube_representation=CubeRepresentation.BIL,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        band_validity=band_validity,
+        reflectance_out=reflectance_buffer[:, 1:13, :],
+        validity_out=validity_buffer[:, 1:13, :],
+    )
+    assert np.allclose(reflectance_buffer[:, 1:13, :], expected_reflectance)
+    assert np.array_equal(validity_buffer[:, 1:13, :], expected_validity)
+    assert (validity_buffer[:, [0, 13], :] == -1).all()
+
+    with pytest.raises(ValueError):
+        converter.transform_with_validity(
+            input_data=bil_cube,
+            error_data=bil_errors[:, :6, :],
+            cube_representation=CubeRepresentation.BIL,
+            band_mapping=band_mapping,
+            file_metadata=file_metadata_mock,
+        )
+
+
+@pytest.mark.parametrize(
+    "input_representation,input_axes",
+    [
+        (CubeRepresentation.BIL, (0, 1, 2)),
+        (CubeRepresentation.BIP, (0, 2, 1)),
+        (CubeRepresentation.BSQ, (1, 0, 2)),
+    ],
+)
+@pytest.mark.parametrize(
+    "output_representation,output_axes",
+    [
+        (CubeRepresentation.BIL, (0, 1, 2)),
+        (CubeRepresentation.BIP, (0, 2, 1)),
+        (CubeRepresentation.BSQ, (1, 0, 2)),
+    ],
+)
+def test_layout_aware_conversion(
+    file_metadata_mock,
+    sample_input_data,
+    input_representation,
+    input_axes,
+    output_representation,
+    output_axes,
+):
+    """
+    Converting from any layout straight into any other layout must match converting
+    the BIL cube and permuting the result, for plain and masked inputs
+    """
+    band_mapping, bil_cube = sample_input_data
+    converter = PrsL2dDnToSurfaceReflectanceTransformer()
+    reference = converter.transform(
+        input_data=bil_cube,
+        cube_representation=CubeRepresentation.BIL,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+    )
+
+    input_cube = np.ascontiguousarray(bil_cube.transpose(input_axes))
+    output = converter.transform(
+        input_data=input_cube,
+        cube_representation=input_representation,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        output_representation=output_representation,
+    )
+    assert output.flags.c_contiguous
+    assert np.allclose(output, reference.transpose(output_axes))
+
+    masked_cube = np.ma.masked_where(input_cube == 0, input_cube)
+    original = masked_cube.data.copy()
+    masked_output = converter.transform(
+        input_data=masked_cube,
+        cube_representation=input_representation,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        masking_indicator=0.0,
+        output_representation=output_representation,
+    )
+    assert isinstance(masked_output, np.ma.MaskedArray)
+    assert np.array_equal(masked_output.mask, (bil_cube == 0).transpose(output_axes))
+    assert np.allclose(masked_output.data, reference.transpose(output_axes))
+    # The caller's data is never modified
+    assert np.array_equal(masked_cube.data, original)
+
+    validated_output = converter.transform(
+        input_data=ValidatedCube.from_masked_array(masked_cube),
+        cube_representation=input_representation,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        masking_indicator=0.0,
+        output_representation=output_representation,
+    )
+    assert isinstance(validated_output, ValidatedCube)
+    assert validated_output.data.flags.c_contiguous
+    assert np.array_equal(validated_output.data, masked_output.data)
+    assert np.array_equal(validated_output.validity, ~masked_output.mask)
+
+    reflectance, validity = converter.transform_with_validity(
+        input_data=input_cube,
+        error_data=np.zeros_like(input_cube, dtype=np.uint8),
+        cube_representation=input_representation,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        output_representation=output_representation,
+    )
+    assert np.allclose(reflectance, reference.transpose(output_axes))
+    assert np.array_equal(
+        validity, (bil_cube != 0).transpose(output_axes).astype(np.int8)
+    )
+
+
+def test_conversion_of_lazy_cube(file_metadata_mock, sample_input_data):
+    """
+    A lazy cube carries its representation into the transformer
+    """
+    band_mapping, bil_cube = sample_input_data
+    converter = PrsL2dDnToSurfaceReflectanceTransformer()
+    expected = converter.transform(
+        input_data=bil_cube,
+        cube_representation=CubeRepresentation.BIL,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+    )
+    lazy = LazyCube(data=bil_cube, representation=CubeRepresentation.BIL)
+    output = converter.transform(
+        input_data=lazy,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+        output_representation=CubeRepresentation.BSQ,
+    )
+    assert np.allclose(output, expected.transpose(1, 0, 2))
+
+    reflectance, _ = converter.transform_with_validity(
+        input_data=lazy,
+        error_data=np.zeros_like(bil_cube, dtype=np.uint8),
+        cube_representation=None,
+        band_mapping=band_mapping,
+        file_metadata=file_metadata_mock,
+    )
+    assert np.allclose(reflectance, expected)
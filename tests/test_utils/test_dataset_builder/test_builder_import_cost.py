@@ -0,0 +1,93 @@
+"""
+Tests and benchmarks the cost of importing and constructing dataset builders
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+from app.utils.dataset_builder.prisma_dataset_builder import PrismaDatasetBuilder
+from app.utils.dataset_builder.landsat_dataset_builder import LandsatDataBuilder
+from app.utils.torch_helpers.device_selection import get_device
+
+BUILDER_MODULES = [
+    "app.utils.dataset_builder.prisma_dataset_builder",
+    "app.utils.dataset_builder.landsat_dataset_builder",
+]
+
+
+def run_in_fresh_interpreter(code: str) -> str:
+    """
+    Runs code in a new interpreter so that nothing is already imported
+    """
+    completed = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    return completed.stdout.strip()
+
+
+@pytest.mark.parametrize("module", BUILDER_MODULES)
+def test_builders_do_not_import_torch(module):
+    """
+    Importing a builder must not pull in torch or sklearn
+    """
+    output = run_in_fresh_interpreter(
+        f"import sys, {module}; print('torch' in sys.modules, 'sklearn' in sys.modules)"
+    )
+    assert output == "False False"
+
+
+def test_numpy_conversions_do_not_import_torch():
+    """
+    Constructing cube operations and converting with numpy must stay torch free
+    """
+    output = run_in_fresh_interpreter(
+        "import sys\n"
+        "import numpy as np\n"
+        "from app.models.images.cube_representation import CubeRepresentation\n"
+        "from app.utils.image_transformation.image_cube_operations import ImageCubeOperations\n"
+        "operations = ImageCubeOperations()\n"
+        "cube = np.zeros((4, 3, 5), dtype=np.float32)\n"
+        "for backend in ('auto', 'numpy', 'blocked'):\n"
+        "    operations.convert_cube(cube, CubeRepresentation.BIL, CubeRepresentation.BSQ,"
+        " backend=backend)\n"
+        "print('torch' in sys.modules)"
+    )
+    assert output == "False"
+
+
+def test_device_is_selected_once():
+    """
+    The device decision is shared across the process
+    """
+    assert get_device() is get_device()
+
+
+@pytest.mark.parametrize("module", BUILDER_MODULES)
+def test_builder_import_benchmark(benchmark, module):
+    """
+    Benchmarks a cold import of a builder module
+    """
+    benchmark.pedantic(
+        run_in_fresh_interpreter, args=(f"import {module}",), rounds=3, iterations=1
+    )
+
+
+def test_prisma_builder_construction_benchmark(benchmark, synthetic_prisma_source):
+    """
+    Benchmarks constructing a PRISMA builder on a synthetic scene
+    """
+    benchmark(PrismaDatasetBuilder, file_source_configuration=synthetic_prisma_source)
+
+
+def test_landsat_builder_construction_benchmark(benchmark, synthetic_landsat_source):
+    """
+    Benchmarks constructing a Landsat builder on a synthetic scene
+    """
+
+    def build_and_close():
+        builder = LandsatDataBuilder(file_source_configuration=synthetic_landsat_source)
+        builder.close()
+
+    benchmark(build_and_close)
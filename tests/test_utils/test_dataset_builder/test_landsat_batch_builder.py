@@ -0,0 +1,126 @@
+"""
+Tests vending batches of landsat scenes over a process pool
+"""
+
+import gc
+import os
+
+import pytest
+import numpy as np
+
+from app.models.dataset.vendables import VendableThermalDataset
+from app.models.file_processing.sources import FileSourceConfig
+from app.utils.dataset_builder.landsat_batch_builder import LandsatBatchBuilder
+from app.utils.dataset_builder.landsat_dataset_builder import LandsatDataBuilder
+
+SHARED_MEMORY_DIRECTORY = "/dev/shm"
+
+
+def shared_blocks() -> set:
+    """
+    The shared memory blocks created by python on this machine
+    """
+    if not os.path.isdir(SHARED_MEMORY_DIRECTORY):
+        return set()
+    return {
+        name for name in os.listdir(SHARED_MEMORY_DIRECTORY) if name.startswith("psm_")
+    }
+
+
+@pytest.fixture
+def scene_batch(synthetic_landsat_factory, tmp_path):
+    """
+    Two good scenes of different sizes around a corrupt one
+    """
+    corrupt_path = tmp_path / "LC09_L2SP_150044_20251009_20251010_02_T1_ST_B10.TIF"
+    corrupt_path.write_bytes(b"not a tif")
+    return [
+        synthetic_landsat_factory(),
+        FileSourceConfig(source_path=str(corrupt_path)),
+        synthetic_landsat_factory(height=90, width=140),
+    ]
+
+
+def test_batch_vend_isolates_errors(scene_batch):
+    """
+    Every good scene vends the same dataset as a serial build and the corrupt
+    scene is reported without affecting the others
+    """
+    blocks_before = shared_blocks()
+    results = LandsatBatchBuilder(max_workers=2, max_in_flight=2).vend(
+        scene_batch, random_seed=3, pack_validity=True
+    )
+
+    assert [result.index for result in results] == [0, 1, 2]
+    assert [result.succeeded for result in results] == [True, False, True]
+    assert results[1].dataset is None
+    assert "RasterioIOError" in results[1].error
+
+    for source, result in zip(scene_batch, results):
+        if not result.succeeded:
+            continue
+        builder = LandsatDataBuilder(file_source_configuration=source)
+        reference = builder.vend_dataset(random_seed=3)
+        builder.close()
+        assert result.source_path == source.source_path
+        assert {
+            "initialize",
+            "read",
+            "transform",
+            "cloud_mask",
+            "write",
+            "vend",
+            "handoff",
+            "total",
+            "collect",
+        } <= set(result.timings)
+        assert np.array_equal(
+            result.dataset.normalized_thermal_cube, reference.normalized_thermal_cube
+        )
+        assert result.dataset.is_validity_packed
+        assert np.array_equal(result.dataset.full_validity(), reference.validity_cube)
+        # The cube is mapped from the worker's shared memory rather than copied out
+        assert not result.dataset.normalized_thermal_cube.flags.owndata
+    assert shared_blocks() == blocks_before
+
+    # Views outlive the results, their shared memory stays mapped until they are gone
+    row = results[0].dataset.normalized_thermal_cube[0, 5]
+    expected = row.copy()
+    del results, result
+    gc.collect()
+    assert np.array_equal(row, expected)
+
+
+def test_batch_vend_to_directory(scene_batch, tmp_path):
+    """
+    With an output directory every scene is saved by its worker and loads memory mapped
+    """
+    output_directory = tmp_path / "vended"
+    results = LandsatBatchBuilder(max_workers=2, max_in_flight=1).vend(
+        scene_batch,
+        output_directory=str(output_directory),
+        streaming=True,
+        block_rows=16,
+        random_seed=3,
+    )
+
+    assert [result.succeeded for result in results] == [True, False, True]
+    for result in results[::2]:
+        assert isinstance(result.dataset.normalized_thermal_cube, np.memmap)
+        reloaded = VendableThermalDataset.load(result.output_directory)
+        assert np.array_equal(reloaded.validity_cube, result.dataset.validity_cube)
+    assert len(os.listdir(output_directory)) == 2
+
+
+def test_abandoned_batch_releases_shared_memory(scene_batch):
+    """
+    Results that are never consumed do not leak their shared memory
+    """
+    blocks_before = shared_blocks()
+    results = LandsatBatchBuilder(max_workers=2, max_in_flight=3).iter_vend(scene_batch)
+    next(results)
+    results.close()
+    assert shared_blocks() == blocks_before
+
+    with pytest.raises(ValueError):
+        LandsatBatchBuilder(max_workers=0)
@@ -2,13 +2,19 @@
 Test out building vendable thermal datasets from landsat images
 """
 
-import pytest
+import logging
+import tracemalloc
 
+import pytest
+import numpy as np
 from pystac import Item
 
 from app.utils.dataset_builder.landsat_dataset_builder import LandsatDataBuilder
 from app.utils.files.tif_helper import TIFHelper
 from app.models.images.cube_representation import CubeRepresentation
+from app.statistical_models.cloud_masker_registry import CloudMaskerRegistry
+
+logger = logging.getLogger("LandsatTester")
 
 
 @pytest.mark.large_files
@@ -33,3 +39,185 @@ def test_landsat_data_builder(live_source_data):
     assert vendable.normalized_thermal_cube.shape[0] == 1
     assert vendable.validity_cube.min() == 0
     assert int(vendable.validity_cube.sum()) > 0
+
+
+def test_landsat_builder_opens_file_once(synthetic_landsat_source):
+    """
+    The STAC item and the helper metadata must come from the same open handle
+    """
+    builder = LandsatDataBuilder(file_source_configuration=synthetic_landsat_source)
+
+    assert isinstance(builder.stac_item, Item)
+    assert len(builder.stac_item.bbox) == 4
+    assert builder.file_helper.open_count == 1
+    builder.close()
+
+
+def test_landsat_packed_validity(synthetic_landsat_source):
+    """
+    Packed validity must unpack to the same mask as the byte per pixel validity
+    """
+    builder = LandsatDataBuilder(file_source_configuration=synthetic_landsat_source)
+    vendable = builder.vend_dataset()
+    packed = builder.vend_dataset(pack_validity=True)
+
+    assert packed.is_validity_packed
+    assert np.array_equal(
+        packed.full_validity().reshape(vendable.validity_cube.shape),
+        vendable.validity_cube != 0,
+    )
+    builder.close()
+
+
+def test_landsat_histogram_cloud_masker(synthetic_landsat_source):
+    """
+    The histogram engine with threshold prediction must vend the same validity as the
+    default masker, up to a few pixels
+    """
+    builder = LandsatDataBuilder(file_source_configuration=synthetic_landsat_source)
+    vendable = builder.vend_dataset()
+    histogram_vendable = builder.vend_dataset(
+        cloud_masker_engine="histogram", cloud_prediction_mode="thresholds"
+    )
+
+    assert np.array_equal(
+        vendable.normalized_thermal_cube, histogram_vendable.normalized_thermal_cube
+    )
+    assert np.mean(vendable.validity_cube != histogram_vendable.validity_cube) < 0.01
+    builder.close()
+
+
+def test_landsat_masker_registry(synthetic_landsat_source, tmp_path):
+    """
+    Vending stores the masker fit for the scene's path/row and month and warm starts from it,
+    and seeded vending is reproducible
+    """
+    registry = CloudMaskerRegistry(registry_directory=str(tmp_path / "registry"))
+    builder = LandsatDataBuilder(
+        file_source_configuration=synthetic_landsat_source, masker_registry=registry
+    )
+    first = builder.vend_dataset(random_seed=3)
+    assert registry.load(150, 44, 10).scene_count == 1
+    builder.vend_dataset(random_seed=3)
+    assert registry.load(150, 44, 10).scene_count == 2
+
+    seeded = LandsatDataBuilder(file_source_configuration=synthetic_landsat_source)
+    assert np.array_equal(
+        seeded.vend_dataset(random_seed=3).validity_cube,
+        seeded.vend_dataset(random_seed=3).validity_cube,
+    )
+    assert np.mean(first.validity_cube != seeded.vend_dataset().validity_cube) < 0.01
+    builder.close()
+    seeded.close()
+
+
+def test_landsat_streaming_vend(synthetic_landsat_source, tmp_path):
+    """
+    Streaming in row blocks must vend the same dataset as the in memory build.
+    The reservoir holds every pixel of the small scene so the seeded sklearn fit is the same,
+    the histogram engine bins on a fixed grid and may differ by a few pixels.
+    """
+    builder = LandsatDataBuilder(file_source_configuration=synthetic_landsat_source)
+    reference = builder.vend_dataset(random_seed=3)
+
+    # A block size that does not divide the scene height exercises the edge block
+    for output_directory in (None, str(tmp_path / "vended")):
+        streamed = builder.vend_dataset(
+            random_seed=3,
+            streaming=True,
+            block_rows=7,
+            output_directory=output_directory,
+        )
+        assert np.array_equal(
+            streamed.normalized_thermal_cube, reference.normalized_thermal_cube
+        )
+        assert np.array_equal(streamed.validity_cube, reference.validity_cube)
+        assert streamed.validity_cube.dtype == np.int8
+    assert isinstance(streamed.normalized_thermal_cube, np.memmap)
+    assert (tmp_path / "vended" / "validity_cube.npy").exists()
+
+    packed = builder.vend_dataset(
+        random_seed=3, streaming=True, block_rows=7, pack_validity=True
+    )
+    assert np.array_equal(packed.full_validity(), reference.validity_cube)
+
+    histogram_reference = builder.vend_dataset(
+        cloud_masker_engine="histogram", cloud_prediction_mode="thresholds"
+    )
+    histogram_streamed = builder.vend_dataset(
+        cloud_masker_engine="histogram",
+        cloud_prediction_mode="thresholds",
+        streaming=True,
+        block_rows=16,
+    )
+    assert (
+        np.mean(histogram_streamed.validity_cube != histogram_reference.validity_cube)
+        < 0.01
+    )
+    builder.close()
+
+
+def test_landsat_streaming_vend_peak_memory(synthetic_landsat_factory, tmp_path):
+    """
+    Measures the peak traced memory of a streaming vend. Memory mapped outputs leave only
+    the blocks and the masker statistics, which do not grow with the scene.
+    """
+    height, width, block_rows = 1200, 1000, 64
+    source = synthetic_landsat_factory(height=height, width=width)
+    builder = LandsatDataBuilder(file_source_configuration=source)
+    # A handful of float64 temporaries per pixel of a block, plus the histogram
+    block_budget = block_rows * width * 64 + (1 << 20)
+
+    def traced_peak(**kwargs) -> int:
+        tracemalloc.start()
+        try:
+            vendable = builder.vend_dataset(
+                cloud_masker_engine="histogram",
+                cloud_prediction_mode="thresholds",
+                **kwargs,
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del vendable
+        return peak
+
+    in_memory_peak = traced_peak()
+    memory_mapped_peak = traced_peak(
+        streaming=True, block_rows=block_rows, output_directory=str(tmp_path / "out")
+    )
+    logger.info(
+        "Peak traced bytes: in memory %d, memory mapped %d",
+        in_memory_peak,
+        memory_mapped_peak,
+    )
+
+    assert memory_mapped_peak <= block_budget
+    assert memory_mapped_peak < in_memory_peak / 4
+    builder.close()
+
+
+def test_landsat_builder_context_manager(synthetic_landsat_source):
+    """
+    Leaving the builder's context closes the file handle it owns
+    """
+    with LandsatDataBuilder(
+        file_source_configuration=synthetic_landsat_source
+    ) as builder:
+        dataset = builder.file_helper.dataset
+        assert not dataset.closed
+    assert dataset.closed
+
+
+def test_landsat_stage_timings(synthetic_landsat_source):
+    """
+    Every vend records the time spent in each of its stages, in memory and streamed
+    """
+    stages = {"read", "transform", "cloud_mask", "write"}
+    with LandsatDataBuilder(
+        file_source_configuration=synthetic_landsat_source
+    ) as builder:
+        for streaming in (False, True):
+            builder.vend_dataset(random_seed=3, streaming=streaming, block_rows=7)
+            assert set(builder.stage_timings) == stages
+            assert all(seconds >= 0.0 for seconds in builder.stage_timings.values())
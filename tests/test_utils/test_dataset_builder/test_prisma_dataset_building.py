@@ -3,8 +3,11 @@ Full suite of tests for Prisma Dataset Building
 """
 
 import logging
+import tracemalloc
 from typing import Dict
+
 import pytest
+import numpy as np
 
 from pystac import Item
 
@@ -47,3 +50,73 @@ def test_initialization_of_dataset_builder(live_source_data):
     assert vendable.normalized_hyperspectral_cube.max() <= 1
     assert vendable.validity_cube.sum() > 0
     assert vendable.validity_cube.shape[0] == 239
+
+
+def test_streaming_vend_matches_in_memory_vend(synthetic_prisma_source, tmp_path):
+    """
+    Streaming in row blocks must produce the same dataset as the in memory build
+    """
+    builder = PrismaDatasetBuilder(file_source_configuration=synthetic_prisma_source)
+    reference = builder.vend_dataset()
+
+    # A block size that does not divide the scene height exercises the edge block
+    for output_directory in (None, str(tmp_path / "vended")):
+        streamed = builder.vend_dataset(
+            streaming=True, block_rows=7, output_directory=output_directory
+        )
+        assert np.allclose(
+            streamed.normalized_hyperspectral_cube,
+            reference.normalized_hyperspectral_cube,
+        )
+        assert np.array_equal(streamed.validity_cube, reference.validity_cube)
+        assert streamed.validity_cube.dtype == np.int8
+        assert streamed.band_cw_order == reference.band_cw_order
+        assert streamed.spectral_family_order == reference.spectral_family_order
+
+    assert isinstance(streamed.normalized_hyperspectral_cube, np.memmap)
+    assert (tmp_path / "vended" / "validity_cube.npy").exists()
+
+    with pytest.raises(ValueError):
+        builder.vend_dataset(streaming=True, block_rows=0)
+
+
+def test_streaming_vend_peak_memory(synthetic_prisma_factory, tmp_path):
+    """
+    Measures the peak traced memory of a streaming vend and checks it against the
+    documented bound: the outputs plus ~20 bytes per voxel of a single block.
+    """
+    height, width, swir_bands, vnir_bands = 600, 200, 40, 30
+    block_rows = 32
+    source = synthetic_prisma_factory(
+        height=height, width=width, swir_bands=swir_bands, vnir_bands=vnir_bands
+    )
+    builder = PrismaDatasetBuilder(file_source_configuration=source)
+
+    block_budget = block_rows * max(swir_bands, vnir_bands) * width * 20
+    output_bytes = (swir_bands + vnir_bands) * height * width * (4 + 1)
+
+    def traced_peak(**kwargs) -> int:
+        tracemalloc.start()
+        try:
+            vendable = builder.vend_dataset(**kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del vendable
+        return peak
+
+    in_memory_peak = traced_peak()
+    streaming_peak = traced_peak(streaming=True, block_rows=block_rows)
+    memory_mapped_peak = traced_peak(
+        streaming=True, block_rows=block_rows, output_directory=str(tmp_path / "out")
+    )
+    logger.info(
+        "Peak traced bytes: in memory %d, streaming %d, memory mapped %d",
+        in_memory_peak,
+        streaming_peak,
+        memory_mapped_peak,
+    )
+
+    assert streaming_peak <= output_bytes + block_budget
+    assert memory_mapped_peak <= block_budget
+    assert streaming_peak < in_memory_peak
@@ -2,6 +2,8 @@
 Tests the he5 helper implementation of the file helper abstraction
 """
 
+import tracemalloc
+
 import pytest
 import numpy as np
 from app.utils.files.he5_helper import HE5Helper
@@ -12,6 +14,8 @@ from app.models.file_processing.file_metadata_models import (
 )
 
 from app.models.file_processing.file_categories import FileCategory
+from app.models.images.image_window import ImageWindow
+from app.models.images.validated_cube import ValidatedCube
 from app.models.hyperspectral_concepts.spectral_family import SpectralFamily
 from app.models.hyperspectral_concepts.file_components import (
     HyperspectralFileComponents,
@@ -261,3 +265,212 @@ def test_pixel_error_extraction(live_source_data):
 
     assert vnir_error.max() > 0
     assert vnir_error.min() == 0
+
+
+def test_hyperslab_matches_full_read(synthetic_prisma_source):
+    """
+    Ensures that hyperslab reads return exactly what slicing the full cube would
+    """
+    helper = HE5Helper(
+        file_source_config=synthetic_prisma_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+    )
+    path = helper.template.get(HyperspectralFileComponents.SWIR_CUBE_DATA).file_name
+    full_cube = helper.access_dataset(path)
+
+    # Unsorted, duplicated and negative band indices must keep their order
+    for bands in ([4, 5, 6], [10, 2, 7], [3, 3, 1], [-1, 0]):
+        subset = helper.access_hyperslab(path, bands=bands)
+        assert np.array_equal(subset, full_cube[:, bands, :])
+
+    # Row and column windows are pushed down along with the bands
+    window = helper.access_hyperslab(
+        path, bands=[1, 8], rows=slice(5, 17), cols=slice(2, 20, 3)
+    )
+    assert np.array_equal(window, full_cube[5:17, [1, 8], 2:20:3])
+
+    # Specific band extraction goes through the hyperslab path
+    specific = helper.extract_specific_bands(
+        bands=[9, 0],
+        masking_needed=True,
+        spectral_family=SpectralFamily.SWIR,
+        mode="specific",
+    )
+    assert isinstance(specific, np.ma.MaskedArray)
+    assert np.array_equal(specific.data, full_cube[:, [9, 0], :])
+
+    errors = helper.extract_error_matrices(
+        bands=[2], spectral_family=SpectralFamily.VNIR, mode="specific"
+    )
+    assert errors.shape == (full_cube.shape[0], 1, full_cube.shape[2])
+
+    with pytest.raises(IndexError):
+        helper.access_hyperslab(path, bands=[full_cube.shape[1]])
+
+
+def _read_with_peak_memory(read_function):
+    """
+    Runs a read and reports the peak traced allocation in bytes alongside the output
+    """
+    tracemalloc.start()
+    try:
+        output = read_function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return output, peak
+
+
+@pytest.mark.large_files
+@pytest.mark.parametrize("read_path", ["full_read", "hyperslab"])
+def test_band_subset_read_benchmark(
+    benchmark, live_source_data, hyperspectral_band_numbers, read_path
+):
+    """
+    Benchmarks pulling a handful of bands by reading the whole cube and slicing it
+    against pushing the band selection down into h5py.
+    Peak traced memory and the bytes returned are attached to the benchmark report.
+    """
+    helper = HE5Helper(
+        file_source_config=live_source_data.get(PHASE2),
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+    )
+    path = helper.template.get(HyperspectralFileComponents.SWIR_CUBE_DATA).file_name
+
+    if read_path == "full_read":
+
+        def read_function():
+            return helper.access_dataset(path)[:, hyperspectral_band_numbers, :]
+
+    else:
+
+        def read_function():
+            return helper.access_hyperslab(path, bands=hyperspectral_band_numbers)
+
+    output, peak = _read_with_peak_memory(read_function)
+    benchmark.extra_info["peak_traced_bytes"] = peak
+    benchmark.extra_info["bytes_returned"] = output.nbytes
+
+    result = benchmark(read_function)
+    assert result.shape[1] == len(hyperspectral_band_numbers)
+
+
+def test_window_extraction(synthetic_prisma_source):
+    """
+    Ensures that spatial windows are read as BIL hyperslabs and tile the scene fully
+    """
+    helper = HE5Helper(
+        file_source_config=synthetic_prisma_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+    )
+    full_cube = helper.extract_specific_bands(
+        bands=[], spectral_family=SpectralFamily.VNIR, mode="all"
+    )
+    full_errors = helper.extract_error_matrices(
+        bands=[], spectral_family=SpectralFamily.VNIR, mode="all"
+    )
+    assert helper.spatial_shape(SpectralFamily.VNIR) == (
+        full_cube.shape[0],
+        full_cube.shape[2],
+    )
+
+    window = ImageWindow(row_offset=2, col_offset=5, height=10, width=7)
+    output = helper.extract_window(
+        window, bands=[0, 3], masking_needed=True, spectral_family=SpectralFamily.VNIR
+    )
+    assert isinstance(output, np.ma.MaskedArray)
+    assert np.array_equal(output.data, full_cube[2:12, [0, 3], 5:12])
+    assert output.mask[0].all()
+
+    validated = helper.extract_window(
+        window, bands=[0, 3], spectral_family=SpectralFamily.VNIR, validated=True
+    )
+    assert isinstance(validated, ValidatedCube)
+    assert np.array_equal(validated.data, output.data)
+    assert np.array_equal(validated.validity, ~output.mask)
+    validated_bands = helper.extract_specific_bands(
+        bands=[0, 3], spectral_family=SpectralFamily.VNIR, validated=True
+    )
+    assert np.array_equal(validated_bands.data, full_cube[:, [0, 3], :])
+    assert np.array_equal(validated_bands.validity, full_cube[:, [0, 3], :] != 0)
+
+    errors = helper.extract_error_window(window, spectral_family=SpectralFamily.VNIR)
+    assert np.array_equal(errors, full_errors[2:12, :, 5:12])
+
+    # Reassembling the tiles gives back the full scene
+    rebuilt = np.zeros_like(full_cube)
+    for tile in helper.iter_windows(16, 12, spectral_family=SpectralFamily.VNIR):
+        rebuilt[tile.row_slice, :, tile.col_slice] = helper.extract_window(
+            tile, spectral_family=SpectralFamily.VNIR
+        )
+    assert np.array_equal(rebuilt, full_cube)
+
+    with pytest.raises(ValueError):
+        helper.extract_window(
+            ImageWindow(row_offset=35, col_offset=0, height=10, width=5),
+            spectral_family=SpectralFamily.VNIR,
+        )
+
+
+def test_lazy_component_metadata(synthetic_prisma_source):
+    """
+    Ensures component metadata is only built on first access and matches an eager build
+    """
+    lazy_helper = HE5Helper(
+        file_source_config=synthetic_prisma_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+    )
+    eager_helper = HE5Helper(
+        file_source_config=synthetic_prisma_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+        eager_metadata=True,
+    )
+    lazy_metadata = lazy_helper.file_metadata.component_metadata
+    eager_metadata = eager_helper.file_metadata.component_metadata
+
+    # Only the paths are known after construction
+    assert len(lazy_metadata.loaded_paths) == 0
+    assert len(eager_metadata.loaded_paths) == len(eager_metadata)
+    assert list(lazy_metadata.keys()) == lazy_helper.file_metadata.components
+
+    # Reading a band only builds what it touches
+    lazy_helper.extract_specific_bands(
+        bands=[1], spectral_family=SpectralFamily.SWIR, mode="specific"
+    )
+    assert len(lazy_metadata.loaded_paths) == 0
+
+    path = lazy_helper.template.get(
+        HyperspectralFileComponents.SWIR_CUBE_DATA
+    ).file_name
+    component = lazy_metadata.get(path)
+    assert lazy_metadata.loaded_paths == [path]
+    # Cached per file
+    assert lazy_metadata[path] is component
+    assert component.shape == eager_metadata[path].shape
+    assert component.is_scalar is False
+
+    for key in eager_metadata:
+        assert lazy_metadata[key] == eager_metadata[key]
+    assert lazy_metadata.get("xxxxxx") is None
+
+
+@pytest.mark.large_files
+@pytest.mark.parametrize("eager_metadata", [True, False])
+def test_helper_construction_benchmark(benchmark, live_source_data, eager_metadata):
+    """
+    Benchmarks helper start up with an eager visit of every component against
+    lazily populated component metadata
+    """
+    source = live_source_data.get(PHASE2)
+
+    def construct():
+        helper = HE5Helper(
+            file_source_config=source,
+            template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+            eager_metadata=eager_metadata,
+        )
+        helper.close()
+        return helper
+
+    helper = benchmark(construct)
+    assert len(helper.file_metadata.root_metadata.file_attributes.keys()) > 0
@@ -0,0 +1,124 @@
+"""
+Tests the persistent metadata sidecar cache
+"""
+
+import os
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.coords import BoundingBox
+from rasterio.transform import Affine
+
+from app.utils.files.metadata_cache import MetadataCache, encode_value, decode_value
+from app.utils.dataset_builder.prisma_dataset_builder import PrismaDatasetBuilder
+from app.utils.dataset_builder.landsat_dataset_builder import LandsatDataBuilder
+
+
+def test_value_round_trip():
+    """
+    Values that JSON cannot represent must be restored with their types
+    """
+    values = {
+        "array": np.linspace(0.0, 1.0, 5, dtype=np.float32),
+        "flags": np.array([1, 0, 1], dtype=np.int8),
+        "scalar": np.float64(0.25),
+        "crs": CRS.from_epsg(32643),
+        "transform": Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 2400000.0),
+        "bounds": BoundingBox(0.0, 1.0, 2.0, 3.0),
+        "nested": {"name": "value", "items": [1, 2.5, None]},
+    }
+    restored = decode_value(encode_value(values))
+
+    assert np.array_equal(restored["array"], values["array"])
+    assert restored["array"].dtype == np.float32
+    assert restored["flags"].dtype == np.int8
+    assert isinstance(restored["scalar"], np.float64)
+    assert restored["crs"] == values["crs"]
+    assert restored["transform"] == values["transform"]
+    assert restored["bounds"] == values["bounds"]
+    assert restored["nested"] == values["nested"]
+
+
+def test_prisma_builder_warm_start(synthetic_prisma_source, tmp_path):
+    """
+    A warm builder must come back with the same metadata as a cold one
+    """
+    cache = MetadataCache(cache_directory=str(tmp_path / "cache"))
+    assert cache.load(synthetic_prisma_source.source_path) is None
+
+    cold = PrismaDatasetBuilder(
+        file_source_configuration=synthetic_prisma_source, metadata_cache=cache
+    )
+    assert cache.load(synthetic_prisma_source.source_path) is not None
+
+    warm = PrismaDatasetBuilder(
+        file_source_configuration=synthetic_prisma_source, metadata_cache=cache
+    )
+
+    assert warm.stac_item.to_dict() == cold.stac_item.to_dict()
+    assert warm.band_information == cold.band_information
+    assert warm.file_helper.file_metadata.components == (
+        cold.file_helper.file_metadata.components
+    )
+    cold_attributes = cold.file_helper.file_metadata.root_metadata.file_attributes
+    warm_attributes = warm.file_helper.file_metadata.root_metadata.file_attributes
+    assert warm_attributes.keys() == cold_attributes.keys()
+    for key, value in cold_attributes.items():
+        assert np.array_equal(warm_attributes[key], value)
+
+    # Component metadata is still available lazily from the file
+    path = warm.file_helper.file_metadata.components[-1]
+    assert warm.file_helper.file_metadata.component_metadata[path] == (
+        cold.file_helper.file_metadata.component_metadata[path]
+    )
+
+    # The vended datasets are identical
+    cold_vendable = cold.vend_dataset()
+    warm_vendable = warm.vend_dataset()
+    assert np.array_equal(
+        cold_vendable.normalized_hyperspectral_cube,
+        warm_vendable.normalized_hyperspectral_cube,
+    )
+
+
+def test_landsat_builder_warm_start(synthetic_landsat_source, tmp_path):
+    """
+    A warm Landsat builder must not open the file at all during construction
+    """
+    cache = MetadataCache(cache_directory=str(tmp_path / "cache"))
+    cold = LandsatDataBuilder(
+        file_source_configuration=synthetic_landsat_source, metadata_cache=cache
+    )
+    warm = LandsatDataBuilder(
+        file_source_configuration=synthetic_landsat_source, metadata_cache=cache
+    )
+
+    assert cold.file_helper.open_count == 1
+    assert warm.file_helper.open_count == 0
+    assert warm.stac_item.to_dict() == cold.stac_item.to_dict()
+    assert warm.file_helper.spatial_shape() == cold.file_helper.spatial_shape()
+    assert warm.file_helper.file_metadata.metadata.get("crs").value == (
+        cold.file_helper.file_metadata.metadata.get("crs").value
+    )
+    cold.close()
+
+
+def test_cache_invalidation(synthetic_landsat_source, tmp_path):
+    """
+    Modifying the source file or corrupting the sidecar forces a rebuild
+    """
+    cache = MetadataCache(cache_directory=str(tmp_path / "cache"))
+    path = synthetic_landsat_source.source_path
+    sidecar_path = cache.store(cache.new_record(path))
+    assert cache.load(path) is not None
+
+    # A corrupt sidecar is treated as a miss
+    with open(sidecar_path, "w", encoding="utf-8") as sidecar:
+        sidecar.write("{not json")
+    assert cache.load(path) is None
+
+    # Touching the file changes the fingerprint
+    cache.store(cache.new_record(path))
+    stats = os.stat(path)
+    os.utime(path, ns=(stats.st_atime_ns, stats.st_mtime_ns + 1_000_000_000))
+    assert cache.load(path) is None
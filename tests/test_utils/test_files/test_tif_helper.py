@@ -9,6 +9,10 @@ from app.templates.template_mappings import TEMPLATE_MAPPINGS, TemplateIdentifie
 from app.models.file_processing.file_categories import FileCategory
 from app.models.file_processing.file_metadata_models import TIFMetadata, TIFProperty
 from app.models.hyperspectral_concepts.file_components import ThermalComponents
+from app.models.images.image_window import ImageWindow
+from app.models.images.validated_cube import ValidatedCube
+from app.utils.stac.stac_utils.get_landsat_bounding_box import get_landsat_bounding_box
+from app.utils.stac.stac_utils.stac_items import StacCreator
 
 
 PHASE1 = "thermal_1"
@@ -141,3 +145,94 @@ def test_exceptions(live_source_data):
             bands=[4], masking_needed=False, mode="specific"
         )
         del thermal_cube
+
+
+def test_window_extraction(synthetic_landsat_source):
+    """
+    Ensures that window reads match slicing the full raster and tile the scene fully
+    """
+    helper = TIFHelper(
+        file_source_config=synthetic_landsat_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.LANDSAT_THERMAL),
+    )
+    full_cube = helper.extract_specific_bands(masking_needed=True, mode="all")
+    assert helper.spatial_shape() == full_cube.shape[1:]
+
+    window = ImageWindow(row_offset=100, col_offset=0, height=20, width=33)
+    output = helper.extract_window(window, bands=1, masking_needed=True)
+    assert isinstance(output, np.ma.MaskedArray)
+    assert np.array_equal(output.data, full_cube.data[:, 100:120, 0:33])
+    assert np.array_equal(output.mask, full_cube.mask[:, 100:120, 0:33])
+
+    rebuilt = np.zeros_like(full_cube.data)
+    for tile in helper.iter_windows(50, 40):
+        rebuilt[:, tile.row_slice, tile.col_slice] = helper.extract_window(tile)
+    assert np.array_equal(rebuilt, full_cube.data)
+
+    with pytest.raises(ValueError):
+        helper.extract_window(
+            ImageWindow(row_offset=0, col_offset=90, height=5, width=20)
+        )
+    with pytest.raises(ValueError):
+        list(helper.iter_windows(0, 10))
+
+
+def test_single_dataset_handle(synthetic_landsat_source):
+    """
+    Ensures that metadata, band, window and bounds reads share a single open handle
+    and that the handle is released when the helper is closed
+    """
+    with TIFHelper(
+        file_source_config=synthetic_landsat_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.LANDSAT_THERMAL),
+    ) as helper:
+        helper.extract_specific_bands(masking_needed=True, mode="all")
+        helper.extract_specific_bands(bands=[1], mode="specific")
+        for tile in helper.iter_windows(64, 64):
+            helper.extract_window(tile, masking_needed=True)
+        bounds = get_landsat_bounding_box(
+            synthetic_landsat_source.source_path, dataset=helper.dataset
+        )
+        stac_creator = StacCreator(
+            file_path=synthetic_landsat_source.source_path,
+            raster_dataset=helper.dataset,
+        )
+        assert stac_creator.bounding_box == bounds
+        assert helper.open_count == 1
+        dataset = helper.dataset
+
+    # Leaving the context closes the handle
+    assert dataset.closed
+
+    # Accessing after a close re-opens and is counted
+    helper.extract_specific_bands(mode="all")
+    assert helper.open_count == 2
+    helper.close()
+    assert dataset.closed
+
+
+def test_validated_extraction(synthetic_landsat_source):
+    """
+    Validated reads must carry the same data and validity as masked reads
+    and drop the validity of fully valid windows
+    """
+    helper = TIFHelper(
+        file_source_config=synthetic_landsat_source,
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.LANDSAT_THERMAL),
+    )
+    masked = helper.extract_specific_bands(masking_needed=True, mode="all")
+    validated = helper.extract_specific_bands(mode="all", validated=True)
+    assert isinstance(validated, ValidatedCube)
+    assert validated.validity.dtype == np.bool_
+    assert np.array_equal(validated.data, masked.data)
+    assert np.array_equal(validated.validity, ~masked.mask)
+
+    border = ImageWindow(row_offset=100, col_offset=0, height=20, width=33)
+    window = helper.extract_window(border, bands=1, validated=True)
+    assert np.array_equal(window.validity, ~masked.mask[:, 100:120, 0:33])
+
+    interior = ImageWindow(row_offset=10, col_offset=10, height=20, width=20)
+    window = helper.extract_window(interior, validated=True)
+    assert window.is_fully_valid
+    assert np.array_equal(window.data, masked.data[:, 10:30, 10:30])
+    helper.close()
@@ -156,3 +156,35 @@ def test_image_transformation_benchmark(benchmark, live_source_data):
     )
 
     assert result is not None
+
+
+@pytest.mark.large_files
+@pytest.mark.parametrize("contiguous", [True, False])
+def test_numpy_image_transformation_benchmark(benchmark, live_source_data, contiguous):
+    """
+    Benchmarks the numpy backend on the cube of test_image_transformation_benchmark,
+    as one contiguous copy and as a zero-copy view
+    """
+    transformer = ImageCubeOperations()
+    helper = HE5Helper(
+        file_source_config=live_source_data.get(HYPERSPECTRAL),
+        template=TEMPLATE_MAPPINGS.get(TemplateIdentifier.PRISMA_HYPERSPECTRAL),
+    )
+    raw_cube = helper.extract_specific_bands(
+        bands=[1],
+        masking_needed=True,
+        spectral_family=SpectralFamily.VNIR,
+        mode="all",
+    )
+
+    result = benchmark(
+        transformer.convert_cube,
+        raw_cube,
+        CubeRepresentation.BIL,
+        CubeRepresentation.BSQ,
+        "numpy",
+        "numpy",
+        contiguous,
+    )
+
+    assert result.shape == (raw_cube.shape[1], raw_cube.shape[0], raw_cube.shape[2])
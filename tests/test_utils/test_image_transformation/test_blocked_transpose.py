@@ -0,0 +1,155 @@
+"""
+Tests the cache blocked cube transposition engine
+"""
+
+import itertools
+
+import pytest
+import numpy as np
+
+from app.utils.image_transformation.blocked_transpose import (
+    blocked_transpose,
+    plan_tiles,
+)
+from app.utils.image_transformation.image_cube_operations import ImageCubeOperations
+from app.models.images.cube_representation import CubeRepresentation
+
+FORMAT_PAIRS = list(itertools.permutations(list(CubeRepresentation), 2))
+DTYPES = [np.uint16, np.float32, np.int8]
+
+# Full scene shape used by the benchmark matrix, in BIL (H, C, W)
+SCENE_SHAPE = (1000, 230, 1000)
+
+
+@pytest.mark.parametrize("permutation", list(itertools.permutations(range(3))))
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("workers", [1, 3])
+def test_blocked_transpose_matches_numpy(permutation, dtype, workers):
+    """
+    Tiles that do not divide the shape must still reproduce np.transpose exactly
+    """
+    cube = np.arange(37 * 11 * 23).reshape(37, 11, 23).astype(dtype)
+    expected = np.transpose(cube, permutation)
+
+    output = blocked_transpose(
+        cube, permutation, block_edge=8, block_depth=3, workers=workers
+    )
+    assert output.flags.c_contiguous
+    assert output.dtype == cube.dtype
+    assert np.array_equal(output, expected)
+
+    buffer = np.empty(expected.shape, dtype=dtype)
+    assert blocked_transpose(cube, permutation, out=buffer) is buffer
+    assert np.array_equal(buffer, expected)
+
+
+def test_blocked_transpose_validation():
+    """
+    Invalid permutations, buffers and block sizes are rejected
+    """
+    cube = np.zeros((4, 5, 6), dtype=np.uint16)
+    with pytest.raises(ValueError):
+        blocked_transpose(cube, (0, 0, 1))
+    with pytest.raises(ValueError):
+        blocked_transpose(cube, (2, 1, 0), out=np.empty((4, 5, 6), dtype=np.uint16))
+    with pytest.raises(ValueError):
+        blocked_transpose(cube, (2, 1, 0), out=np.empty((6, 5, 4), dtype=np.float32))
+    with pytest.raises(ValueError):
+        blocked_transpose(cube, (0, 1, 2), out=cube)
+    with pytest.raises(ValueError):
+        blocked_transpose(cube, (2, 1, 0), workers=0)
+    with pytest.raises(ValueError):
+        plan_tiles(cube.shape, (2, 1, 0), block_edge=0)
+
+
+def test_tile_plan():
+    """
+    Tiles are long along both contiguous axes, and whole rows when the last axis stays
+    """
+    assert plan_tiles((1000, 230, 1000), (1, 0, 2)) == (1, 1000, 1000)
+    assert plan_tiles((1000, 230, 1000), (2, 0, 1)) == (256, 4, 230)
+    assert plan_tiles((1000, 230, 1000), (0, 2, 1)) == (4, 256, 230)
+
+
+@pytest.mark.parametrize("from_format,to_format", FORMAT_PAIRS)
+def test_blocked_backend(from_format, to_format):
+    """
+    The blocked backend of convert_cube matches the numpy backend, with masks and buffers
+    """
+    transformer = ImageCubeOperations()
+    rng = np.random.default_rng(5)
+    cube = np.ma.masked_array(
+        rng.integers(0, 1000, (13, 9, 17), dtype=np.uint16),
+        mask=rng.random((13, 9, 17)) < 0.3,
+    )
+    expected = transformer.convert_cube(
+        cube=cube, from_format=from_format, to_format=to_format
+    )
+    buffer = np.empty(expected.shape, dtype=np.uint16)
+    output = transformer.convert_cube(
+        cube=cube,
+        from_format=from_format,
+        to_format=to_format,
+        backend="blocked",
+        out=buffer,
+        workers=2,
+    )
+    assert isinstance(output, np.ma.MaskedArray)
+    assert np.shares_memory(output.data, buffer)
+    assert np.array_equal(output.data, expected.data)
+    assert np.array_equal(output.mask, expected.mask)
+
+
+@pytest.fixture(scope="module", params=DTYPES, ids=lambda dtype: dtype.__name__)
+def scene_cube(request) -> np.ndarray:
+    """
+    A full size BIL scene of the given dtype
+    """
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 100, SCENE_SHAPE, dtype=np.uint16).astype(request.param)
+
+
+def _scene_in_format(cube: np.ndarray, representation: CubeRepresentation):
+    return ImageCubeOperations().convert_cube(
+        cube=cube,
+        from_format=CubeRepresentation.BIL,
+        to_format=representation,
+        contiguous=True,
+    )
+
+
+@pytest.mark.large_benchmarks
+@pytest.mark.parametrize("engine", ["numpy", "blocked"])
+@pytest.mark.parametrize(
+    "from_format,to_format",
+    FORMAT_PAIRS,
+    ids=[f"{source.value}-{target.value}" for source, target in FORMAT_PAIRS],
+)
+def test_full_scene_conversion_benchmark(
+    benchmark, scene_cube, from_format, to_format, engine
+):
+    """
+    Benchmark matrix of full scene conversions over every format pair and dtype,
+    comparing a plain strided copy with the blocked engine writing into a reused buffer
+    """
+    transformer = ImageCubeOperations()
+    source = _scene_in_format(scene_cube, from_format)
+    buffer = np.empty(
+        tuple(
+            source.shape[axis]
+            for axis in transformer.permutation(from_format, to_format)
+        ),
+        dtype=source.dtype,
+    )
+
+    result = benchmark(
+        transformer.convert_cube,
+        source,
+        from_format,
+        to_format,
+        "numpy",
+        engine,
+        True,
+        buffer,
+    )
+    assert result.shape == buffer.shape
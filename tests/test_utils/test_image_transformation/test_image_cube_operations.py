@@ -8,6 +8,7 @@ import numpy as np
 import torch
 from app.utils.image_transformation.image_cube_operations import ImageCubeOperations
 from app.models.images.cube_representation import CubeRepresentation
+from app.models.images.validated_cube import ValidatedCube
 
 
 @pytest.fixture
@@ -397,3 +398,100 @@ def test_cube_manipulations_on_masked_array(masked_numpy_array):
 
     assert isinstance(tensor_output, torch.Tensor)
     assert tensor_output.shape == (2000, 2000, 3)
+
+
+@pytest.mark.parametrize("from_format", list(CubeRepresentation))
+@pytest.mark.parametrize("to_format", list(CubeRepresentation))
+def test_numpy_backend_matches_torch_backend(from_format, to_format):
+    """
+    The numpy backend must produce the same cube as the torch backend, keep the dtype
+    and only copy when a contiguous output is requested
+    """
+    transformer = ImageCubeOperations()
+    shape = {
+        CubeRepresentation.BIL: (6, 4, 5),
+        CubeRepresentation.BIP: (6, 5, 4),
+        CubeRepresentation.BSQ: (4, 6, 5),
+    }[from_format]
+    cube = np.arange(np.prod(shape), dtype=np.uint16).reshape(shape)
+
+    expected = transformer.convert_cube(
+        cube=cube, from_format=from_format, to_format=to_format, backend="torch"
+    )
+    contiguous = transformer.convert_cube(
+        cube=cube, from_format=from_format, to_format=to_format, contiguous=True
+    )
+    view = transformer.convert_cube(
+        cube=cube, from_format=from_format, to_format=to_format
+    )
+
+    assert np.array_equal(contiguous, expected)
+    assert np.array_equal(view, expected)
+    assert contiguous.dtype == np.uint16
+    assert contiguous.flags.c_contiguous
+    # A permuted cube is copied once, an identity conversion needs no copy at all
+    assert np.shares_memory(contiguous, cube) == (from_format == to_format)
+    assert np.shares_memory(view, cube)
+
+    # float64 is no longer downcast and masks follow the data
+    masked = np.ma.masked_array(
+        cube.astype(np.float64), mask=(cube % 3 == 0), dtype=np.float64
+    )
+    masked_output = transformer.convert_cube(
+        cube=masked, from_format=from_format, to_format=to_format
+    )
+    assert isinstance(masked_output, np.ma.MaskedArray)
+    assert masked_output.dtype == np.float64
+    assert np.array_equal(masked_output.data, expected)
+    assert np.array_equal(
+        masked_output.mask,
+        transformer.convert_cube(
+            cube=masked.mask, from_format=from_format, to_format=to_format
+        ),
+    )
+
+    with pytest.raises(ValueError):
+        transformer.convert_cube(
+            cube=cube,
+            from_format=from_format,
+            to_format=to_format,
+            output_form="tensor",
+            backend="numpy",
+        )
+
+
+@pytest.mark.parametrize("backend", ["auto", "numpy", "blocked"])
+def test_validated_cube_conversion(backend):
+    """
+    Validated cubes are converted together with their validity
+    """
+    transformer = ImageCubeOperations()
+    data = np.arange(4 * 6 * 5, dtype=np.uint16).reshape(4, 6, 5)
+    validity = data % 3 != 0
+
+    output = transformer.convert_cube(
+        cube=ValidatedCube(data=data, validity=validity),
+        from_format=CubeRepresentation.BSQ,
+        to_format=CubeRepresentation.BIP,
+        backend=backend,
+    )
+    assert isinstance(output, ValidatedCube)
+    assert np.array_equal(output.data, data.transpose(1, 2, 0))
+    assert np.array_equal(output.validity, validity.transpose(1, 2, 0))
+
+    fully_valid = transformer.convert_cube(
+        cube=ValidatedCube(data=data),
+        from_format=CubeRepresentation.BSQ,
+        to_format=CubeRepresentation.BIL,
+        backend=backend,
+    )
+    assert fully_valid.validity is None
+    assert np.array_equal(fully_valid.data, data.transpose(1, 0, 2))
+
+    with pytest.raises(ValueError):
+        transformer.convert_cube(
+            cube=ValidatedCube(data=data),
+            from_format=CubeRepresentation.BSQ,
+            to_format=CubeRepresentation.BIL,
+            backend="torch",
+        )
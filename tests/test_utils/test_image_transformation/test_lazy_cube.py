@@ -0,0 +1,116 @@
+"""
+Tests the lazy cube view
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.cube_representation import CubeRepresentation
+from app.models.patches.patching_request import PatchRequest
+from app.utils.image_transformation.lazy_cube import LazyCube
+from app.utils.patch_generation.generate_patch_plan import PatchPlanGenerator
+
+# Axes that take a BSQ cube to each representation
+BSQ_TO = {
+    CubeRepresentation.BSQ: (0, 1, 2),
+    CubeRepresentation.BIL: (1, 0, 2),
+    CubeRepresentation.BIP: (1, 2, 0),
+}
+
+
+@pytest.fixture
+def bsq_cube() -> np.ndarray:
+    """
+    A small BSQ cube with unique values
+    """
+    return np.arange(5 * 7 * 9, dtype=np.uint16).reshape(5, 7, 9)
+
+
+@pytest.mark.parametrize("representation", list(CubeRepresentation))
+def test_accessors(bsq_cube, representation):
+    """
+    Bands, pixels and windows must be the same whatever the native layout
+    """
+    native = np.ascontiguousarray(bsq_cube.transpose(BSQ_TO[representation]))
+    cube = LazyCube(data=native, representation=representation)
+
+    assert cube.shape == (5, 7, 9)
+    assert (cube.channels, cube.height, cube.width) == (5, 7, 9)
+    for band in range(5):
+        assert np.array_equal(cube.band(band), bsq_cube[band])
+        assert np.shares_memory(cube.band(band), native)
+    assert np.array_equal(cube.pixel(3, 4), bsq_cube[:, 3, 4])
+
+    window = cube.window(slice(1, 4), slice(2, 8), layout=CubeRepresentation.BSQ)
+    assert np.array_equal(window, bsq_cube[:, 1:4, 2:8])
+    # Windows in the native layout are views, converted windows are contiguous copies
+    if representation == CubeRepresentation.BSQ:
+        assert np.shares_memory(window, native)
+    else:
+        assert window.flags.c_contiguous
+    native_window = cube.window(slice(1, 4), slice(2, 8), bands=[4, 1])
+    assert np.array_equal(
+        native_window,
+        bsq_cube[[4, 1], 1:4, 2:8].transpose(BSQ_TO[representation]),
+    )
+    # Only the requested window was converted
+    assert cube.cached_layouts == [representation]
+
+
+def test_layout_memoisation(bsq_cube):
+    """
+    Full conversions are made once per layout and the native layout is never copied
+    """
+    cube = LazyCube(data=bsq_cube, representation=CubeRepresentation.BSQ)
+    assert cube.as_layout(CubeRepresentation.BSQ) is bsq_cube
+
+    bip = cube.as_layout(CubeRepresentation.BIP)
+    assert np.array_equal(bip, bsq_cube.transpose(1, 2, 0))
+    assert bip.flags.c_contiguous
+    assert cube.as_layout(CubeRepresentation.BIP) is bip
+    assert set(cube.cached_layouts) == {CubeRepresentation.BSQ, CubeRepresentation.BIP}
+
+    cube.clear_cache()
+    assert cube.cached_layouts == [CubeRepresentation.BSQ]
+
+
+def test_masked_cube(bsq_cube):
+    """
+    Masks follow bands, windows and conversions
+    """
+    masked = np.ma.masked_where(bsq_cube % 4 == 0, bsq_cube)
+    cube = LazyCube(data=masked, representation=CubeRepresentation.BSQ)
+    assert np.array_equal(cube.band(2).mask, masked.mask[2])
+    bil = cube.as_layout(CubeRepresentation.BIL)
+    assert isinstance(bil, np.ma.MaskedArray)
+    assert np.array_equal(bil.mask, masked.mask.transpose(1, 0, 2))
+
+
+def test_wrap(bsq_cube):
+    """
+    Wrapping is idempotent and refuses mismatched representations
+    """
+    cube = LazyCube.wrap(bsq_cube, CubeRepresentation.BSQ)
+    assert LazyCube.wrap(cube) is cube
+    with pytest.raises(ValueError):
+        LazyCube.wrap(cube, CubeRepresentation.BIL)
+    with pytest.raises(ValueError):
+        LazyCube.wrap(bsq_cube)
+    with pytest.raises(ValueError):
+        LazyCube(data=bsq_cube[0], representation=CubeRepresentation.BSQ)
+
+
+def test_patch_plan_from_lazy_cube(bsq_cube):
+    """
+    A patch plan from a lazy cube in any layout equals the plan from the BSQ array
+    """
+    request = PatchRequest(input_cube=bsq_cube, width=4, height=3, stride=2)
+    generator = PatchPlanGenerator()
+    expected = generator.generate_patching_plan(bsq_cube, request)
+    lazy = LazyCube(
+        data=np.ascontiguousarray(bsq_cube.transpose(1, 2, 0)),
+        representation=CubeRepresentation.BIP,
+    )
+    plan = generator.generate_patching_plan(lazy, request)
+    assert np.array_equal(plan.patch_coordinates, expected.patch_coordinates)
+    assert lazy.cached_layouts == [CubeRepresentation.BIP]
@@ -0,0 +1,166 @@
+"""
+Tests patch plan generation
+"""
+
+from typing import List
+
+import pytest
+import numpy as np
+
+from app.models.dataset.packed_validity import PackedValidity
+from app.models.patches.patching_request import PatchRequest
+from app.models.patches.patching_response import PatchingPlan
+from app.utils.patch_generation.generate_patch_plan import PatchPlanGenerator
+
+# (stride, patch size) sweep of the benchmark, from dense to sparse plans
+# The densest plan holds 64M patches and is only run with the heavy benchmarks
+BENCHMARK_SWEEP = [
+    pytest.param(1, 16, marks=pytest.mark.large_benchmarks, id="stride1-patch16"),
+    pytest.param(4, 32, id="stride4-patch32"),
+    pytest.param(8, 64, id="stride8-patch64"),
+    pytest.param(32, 64, id="stride32-patch64"),
+    pytest.param(64, 128, id="stride64-patch128"),
+]
+
+
+def reference_axis_coordinates(
+    extent: int, patch_extent: int, stride: int
+) -> List[int]:
+    """
+    The offsets along one axis as generated by the original loop
+    """
+    coords = []
+    offset = 0
+    while offset < extent:
+        if offset + patch_extent >= extent:
+            coords.append(extent - patch_extent)
+            break
+        coords.append(offset)
+        offset += stride
+    return coords
+
+
+def scene(height: int, width: int, channels: int = 3) -> np.ndarray:
+    """
+    A BSQ scene of the given size that takes no memory
+    """
+    return np.broadcast_to(np.zeros(1, dtype=np.float32), (channels, height, width))
+
+
+@pytest.mark.parametrize("height,width", [(10, 10), (37, 53), (64, 20), (7, 128)])
+@pytest.mark.parametrize("patch_height,patch_width", [(1, 1), (4, 6), (7, 7)])
+@pytest.mark.parametrize("stride", [1, 3, 4, 7, 200])
+def test_patch_plan_matches_loop(height, width, patch_height, patch_width, stride):
+    """
+    The plan holds the coordinates of the original loop, in the same order
+    """
+    cube = scene(height, width)
+    request = PatchRequest(
+        input_cube=cube, width=patch_width, height=patch_height, stride=stride
+    )
+    plan = PatchPlanGenerator().generate_patching_plan(cube, request)
+
+    expected = [
+        (row, col)
+        for row in reference_axis_coordinates(height, patch_height, stride)
+        for col in reference_axis_coordinates(width, patch_width, stride)
+    ]
+    assert plan.patch_coordinates.dtype == np.int32
+    assert plan.patch_coordinates.shape == (len(expected), 2)
+    assert plan.patch_count == len(expected)
+    assert [tuple(pair) for pair in plan.patch_coordinates.tolist()] == expected
+
+
+def test_patch_plan_validation():
+    """
+    Invalid requests and coordinates are rejected
+    """
+    cube = scene(10, 10)
+    generator = PatchPlanGenerator()
+    with pytest.raises(ValueError):
+        generator.generate_patching_plan(
+            cube, PatchRequest(input_cube=cube, width=4, height=4, stride=0)
+        )
+    with pytest.raises(ValueError):
+        generator.generate_patching_plan(
+            cube, PatchRequest(input_cube=cube, width=4, height=11, stride=1)
+        )
+    request = PatchRequest(input_cube=cube, width=4, height=4, stride=2)
+    with pytest.raises(ValueError):
+        PatchingPlan(originating_request=request, patch_coordinates=np.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        PatchingPlan(
+            originating_request=request, patch_coordinates=np.zeros((3, 2), np.float32)
+        )
+
+
+def test_validity_filtered_patch_plan():
+    """
+    Patches are scored by their valid fraction and those below the minimum are dropped
+    """
+    height, width = 48, 40
+    cube = scene(height, width)
+    validity = np.ones((3, height, width), dtype=np.int8)
+    validity[:, :, :10] = 0  # No-data border
+    validity[1, 30:, 20:] = 0  # A cloud in one band invalidates its pixels
+    generator = PatchPlanGenerator()
+
+    request = PatchRequest(input_cube=cube, width=8, height=8, stride=4)
+    scored = generator.generate_patching_plan(cube, request, validity=validity)
+    unscored = generator.generate_patching_plan(cube, request)
+    assert np.array_equal(scored.patch_coordinates, unscored.patch_coordinates)
+    assert unscored.valid_fractions is None
+    assert scored.valid_fractions.dtype == np.float32
+    valid_pixels = validity.all(axis=0)
+    expected = [
+        valid_pixels[row : row + 8, col : col + 8].mean()
+        for row, col in scored.patch_coordinates
+    ]
+    assert np.allclose(scored.valid_fractions, expected)
+
+    filtering = request.model_copy(update={"min_valid_fraction": 0.75})
+    filtered = generator.generate_patching_plan(
+        cube, filtering, validity=PackedValidity.from_cube(validity)
+    )
+    keep = np.asarray(expected) >= 0.75
+    assert 0 < filtered.patch_count < scored.patch_count
+    assert np.array_equal(filtered.patch_coordinates, scored.patch_coordinates[keep])
+    assert np.all(filtered.valid_fractions >= 0.75)
+
+    with pytest.raises(ValueError):
+        generator.generate_patching_plan(cube, filtering)
+    with pytest.raises(ValueError):
+        generator.generate_patching_plan(cube, request, validity=validity[:, 1:])
+    with pytest.raises(ValueError):
+        PatchRequest(input_cube=cube, width=8, height=8, stride=4, min_valid_fraction=2)
+
+
+def test_validity_filtered_patch_plan_benchmark(benchmark):
+    """
+    Benchmarks scoring and filtering a dense plan on a Landsat sized validity mask
+    """
+    cube = scene(8000, 8000, channels=1)
+    validity = np.ones((1, 8000, 8000), dtype=np.int8)
+    validity[:, :, :1500] = 0
+    request = PatchRequest(
+        input_cube=cube, width=64, height=64, stride=16, min_valid_fraction=0.5
+    )
+    plan = benchmark(
+        PatchPlanGenerator().generate_patching_plan, cube, request, validity
+    )
+    assert np.all(plan.patch_coordinates[:, 1] >= 1500 - 32)
+
+
+@pytest.mark.parametrize("stride,patch_size", BENCHMARK_SWEEP)
+def test_patch_plan_benchmark(benchmark, stride, patch_size):
+    """
+    Benchmarks plan generation on a full Landsat sized mosaic over a stride and patch size sweep
+    """
+    cube = scene(8000, 8000, channels=1)
+    request = PatchRequest(
+        input_cube=cube, width=patch_size, height=patch_size, stride=stride
+    )
+    plan = benchmark(PatchPlanGenerator().generate_patching_plan, cube, request)
+    assert plan.patch_count == (
+        len(reference_axis_coordinates(8000, patch_size, stride)) ** 2
+    )
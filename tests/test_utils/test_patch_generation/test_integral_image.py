@@ -0,0 +1,44 @@
+"""
+Tests summed-area tables and window sums
+"""
+
+import numpy as np
+
+from app.models.dataset.packed_validity import PackedValidity
+from app.utils.patch_generation.integral_image import (
+    pixel_validity,
+    summed_area_table,
+    window_sums,
+)
+
+
+def test_window_sums_match_brute_force():
+    """
+    Window sums read from the table equal the sums of the windows
+    """
+    rng = np.random.default_rng(0)
+    mask = rng.random((41, 33)) < 0.7
+    table = summed_area_table(mask)
+    assert table.shape == (42, 34)
+    assert table.dtype == np.int32
+
+    rows = rng.integers(0, 41 - 6, size=200)
+    cols = rng.integers(0, 33 - 9, size=200)
+    sums = window_sums(table, rows, cols, 6, 9)
+    expected = [
+        mask[row : row + 6, col : col + 9].sum() for row, col in zip(rows, cols)
+    ]
+    assert np.array_equal(sums, expected)
+    # The whole mask is a single window
+    assert window_sums(table, [0], [0], 41, 33)[0] == mask.sum()
+
+
+def test_pixel_validity():
+    """
+    A pixel is valid when it is valid in every band, whatever the representation
+    """
+    validity = (np.random.default_rng(1).random((3, 10, 12)) < 0.9).astype(np.int8)
+    expected = validity.all(axis=0)
+    assert np.array_equal(pixel_validity(validity), expected)
+    assert np.array_equal(pixel_validity(PackedValidity.from_cube(validity)), expected)
+    assert np.array_equal(pixel_validity(validity[0]), validity[0] != 0)
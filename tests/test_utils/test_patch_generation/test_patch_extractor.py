@@ -0,0 +1,99 @@
+"""
+Tests extracting patches from a patching plan
+"""
+
+import pytest
+import numpy as np
+
+from app.models.images.cube_representation import CubeRepresentation
+from app.models.patches.patching_request import PatchRequest
+from app.utils.image_transformation.lazy_cube import LazyCube
+from app.utils.patch_generation.generate_patch_plan import PatchPlanGenerator
+from app.utils.patch_generation.patch_extractor import PatchExtractor
+
+
+@pytest.fixture
+def bsq_cube() -> np.ndarray:
+    return np.random.default_rng(0).random((4, 37, 29)).astype(np.float32)
+
+
+@pytest.fixture
+def plan(bsq_cube):
+    request = PatchRequest(input_cube=bsq_cube, width=6, height=5, stride=4)
+    return PatchPlanGenerator().generate_patching_plan(bsq_cube, request)
+
+
+def expected_patch(cube: np.ndarray, row: int, col: int) -> np.ndarray:
+    return cube[:, row : row + 5, col : col + 6]
+
+
+def test_patch_views(bsq_cube, plan):
+    """
+    Single patches are views of the cube at the coordinates of the plan
+    """
+    extractor = PatchExtractor(plan)
+    assert len(extractor) == plan.patch_count
+    assert extractor.patch_shape == (4, 5, 6)
+    for index, (row, col) in enumerate(plan.patch_coordinates):
+        patch = extractor.patch(index)
+        assert np.shares_memory(patch, bsq_cube)
+        assert np.array_equal(patch, expected_patch(bsq_cube, row, col))
+
+
+def test_patches_of_lazy_cubes(bsq_cube, plan):
+    """
+    Lazy cubes in another layout are patched through a view, without a conversion
+    """
+    bip_cube = np.ascontiguousarray(bsq_cube.transpose(1, 2, 0))
+    lazy = LazyCube(data=bip_cube, representation=CubeRepresentation.BIP)
+    extractor = PatchExtractor(plan, input_cube=lazy)
+
+    assert lazy.cached_layouts == [CubeRepresentation.BIP]
+    assert np.shares_memory(extractor.patch(3), bip_cube)
+    assert np.array_equal(
+        extractor.gather(range(len(extractor))),
+        PatchExtractor(plan).gather(range(len(extractor))),
+    )
+
+
+def test_gather_batches(bsq_cube, plan):
+    """
+    Batches are gathered into a single reused buffer, the last one may be smaller
+    """
+    extractor = PatchExtractor(plan)
+    order = np.random.default_rng(1).permutation(len(extractor))
+    buffer = extractor.batch_buffer(7)
+
+    served = []
+    for batch_indices, patches in extractor.iter_batches(7, indices=order, out=buffer):
+        assert np.shares_memory(patches, buffer)
+        assert patches.shape == (len(batch_indices), 4, 5, 6)
+        for index, patch in zip(batch_indices, patches):
+            row, col = plan.patch_coordinates[index]
+            assert np.array_equal(patch, expected_patch(bsq_cube, row, col))
+        served.extend(batch_indices.tolist())
+    assert served == order.tolist()
+
+    with pytest.raises(ValueError):
+        extractor.gather(range(8), out=buffer)
+    with pytest.raises(ValueError):
+        next(extractor.iter_batches(0))
+    with pytest.raises(ValueError):
+        PatchExtractor(plan, input_cube=bsq_cube[:, :10])
+
+
+@pytest.mark.parametrize("channels", [1, 64])
+def test_gather_benchmark(benchmark, channels):
+    """
+    Benchmarks gathering a batch of 256 random 32x32 patches into a reused buffer
+    """
+    cube = np.random.default_rng(2).random((channels, 1000, 1000)).astype(np.float32)
+    request = PatchRequest(input_cube=cube, width=32, height=32, stride=8)
+    extractor = PatchExtractor(
+        PatchPlanGenerator().generate_patching_plan(cube, request)
+    )
+    indices = np.random.default_rng(3).choice(len(extractor), 256, replace=False)
+    buffer = extractor.batch_buffer(256)
+
+    patches = benchmark(extractor.gather, indices, buffer)
+    assert patches.shape == (256, channels, 32, 32)
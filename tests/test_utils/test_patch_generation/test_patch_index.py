@@ -0,0 +1,189 @@
+"""
+Tests the persistent patch index
+"""
+
+import sqlite3
+
+import pytest
+import numpy as np
+
+from app.models.dataset.vendables import VendableThermalDataset
+from app.models.patches.patching_request import PatchRequest
+from app.utils.patch_generation.patch_index import PatchIndex, _balanced_quotas
+
+PATCH = 8
+
+
+def make_scene(height: int, width: int, seed: int):
+    """
+    A vended three band scene with a no-data border, a band dropping out over a region
+    and a cloud bank
+    """
+    rng = np.random.default_rng(seed)
+    cube = rng.random((3, height, width)).astype(np.float32)
+    validity = np.ones((3, height, width), dtype=np.int8)
+    validity[:, :, :6] = 0
+    validity[2, : height // 2, :] = 0
+    cloud_mask = np.zeros((height, width), dtype=bool)
+    cloud_mask[height // 2 :, width // 2 :] = True
+    validity[:, cloud_mask] = 0
+    vendable = VendableThermalDataset(
+        normalized_thermal_cube=cube, validity_cube=validity
+    )
+    return vendable, cloud_mask
+
+
+def request_for(vendable: VendableThermalDataset, **kwargs) -> PatchRequest:
+    return PatchRequest(
+        input_cube=vendable.normalized_thermal_cube,
+        width=PATCH,
+        height=PATCH,
+        stride=4,
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def patch_index(tmp_path):
+    index = PatchIndex(str(tmp_path / "index" / "patches.sqlite"))
+    yield index
+    index.close()
+
+
+def test_index_scene(patch_index):
+    """
+    Indexed patches carry the fractions and band availability of their pixels
+    """
+    vendable, cloud_mask = make_scene(40, 48, seed=0)
+    count = patch_index.index_scene(
+        "scene_a",
+        vendable,
+        request_for(vendable),
+        cloud_mask=cloud_mask,
+        source_path="scene_a.TIF",
+    )
+    records = patch_index.query()
+    assert len(records) == count == 9 * 11
+    assert patch_index.scene_ids() == ["scene_a"]
+
+    validity = vendable.validity_cube != 0
+    for (row, col), valid, cloud, bands in zip(
+        records.patch_coordinates,
+        records.valid_fractions,
+        records.cloud_fractions,
+        records.available_band_counts,
+    ):
+        window = np.s_[row : row + PATCH, col : col + PATCH]
+        assert np.isclose(valid, validity.all(axis=0)[window].mean())
+        assert np.isclose(cloud, cloud_mask[window].mean())
+        assert bands == sum(validity[band][window].mean() >= 0.5 for band in range(3))
+
+    coordinates, available = patch_index.band_availability("scene_a")
+    assert np.array_equal(coordinates, records.patch_coordinates)
+    assert available.shape == (count, 3)
+    assert np.array_equal(available.sum(axis=1), records.available_band_counts)
+
+    clear = patch_index.query(
+        min_valid_fraction=0.9, max_cloud_fraction=0.0, min_available_bands=3
+    )
+    assert 0 < len(clear) < count
+    assert np.all(clear.valid_fractions >= 0.9)
+    assert np.all(clear.cloud_fractions == 0.0)
+    assert np.all(clear.available_band_counts == 3)
+
+
+def test_incremental_index(patch_index, tmp_path):
+    """
+    Scenes are added, replaced and removed one at a time and the index persists
+    """
+    first, first_clouds = make_scene(40, 48, seed=0)
+    second, _ = make_scene(32, 32, seed=1)
+    patch_index.index_scene("scene_a", first, request_for(first), first_clouds)
+    patch_index.index_scene(
+        "scene_b", second, request_for(second, min_valid_fraction=0.5)
+    )
+    assert patch_index.has_scene("scene_b")
+    second_records = patch_index.query(scene_ids=["scene_b"])
+    assert np.all(second_records.valid_fractions >= 0.5)
+    # Scenes indexed without a cloud mask have unknown cloud fractions
+    assert np.all(np.isnan(second_records.cloud_fractions))
+    assert len(patch_index.query(max_cloud_fraction=1.0, scene_ids=["scene_b"])) == 0
+
+    # Indexing a scene again replaces its patches
+    patch_index.index_scene("scene_b", second, request_for(second))
+    assert len(patch_index.query(scene_ids=["scene_b"])) == 7 * 7
+
+    patch_index.close()
+    reopened = PatchIndex(patch_index.index_path)
+    assert reopened.scene_ids() == ["scene_a", "scene_b"]
+    reopened.remove_scene("scene_a")
+    assert reopened.scene_ids() == ["scene_b"]
+    assert set(reopened.query().scene_ids) == {"scene_b"}
+    reopened.close()
+
+    outdated = str(tmp_path / "outdated.sqlite")
+    with sqlite3.connect(outdated) as connection:
+        connection.execute("PRAGMA user_version = 999")
+    with pytest.raises(ValueError):
+        PatchIndex(outdated)
+
+
+def test_balanced_sampling(patch_index):
+    """
+    Sampling draws evenly from every stratum, small strata give everything they have
+    """
+    large, large_clouds = make_scene(64, 64, seed=0)
+    small, small_clouds = make_scene(16, 20, seed=1)
+    patch_index.index_scene("large", large, request_for(large), large_clouds)
+    patch_index.index_scene("small", small, request_for(small), small_clouds)
+    small_count = len(patch_index.query(scene_ids=["small"]))
+
+    sample = patch_index.sample_balanced(40, by="scene", random_seed=0)
+    assert len(sample) == 40
+    _, per_scene = np.unique(sample.scene_ids, return_counts=True)
+    assert sorted(per_scene.tolist()) == [small_count, 40 - small_count]
+    # Every patch is drawn at most once
+    keys = {
+        (scene, *coords)
+        for scene, coords in zip(sample.scene_ids, sample.patch_coordinates.tolist())
+    }
+    assert len(keys) == 40
+    assert np.array_equal(
+        sample.scene_ids,
+        patch_index.sample_balanced(40, by="scene", random_seed=0).scene_ids,
+    )
+
+    by_cloud = patch_index.sample_balanced(
+        30, by="cloud_fraction", cloud_fraction_bins=(0.0, 0.5, 1.0), random_seed=1
+    )
+    clouded = np.count_nonzero(by_cloud.cloud_fractions > 0.5)
+    assert clouded == 15
+
+    assert len(patch_index.sample_balanced(10_000)) == len(patch_index.query())
+    assert len(patch_index.sample_balanced(5, min_valid_fraction=1.1)) == 0
+    for empty_count in (0, -3):
+        empty = patch_index.sample_balanced(empty_count, random_seed=0)
+        assert len(empty) == 0
+        assert empty.patch_coordinates.shape == (0, 2)
+    with pytest.raises(ValueError):
+        patch_index.sample_balanced(5, by="band")
+
+
+def test_balanced_quotas():
+    """
+    Quotas fill small strata and share the rest evenly
+    """
+    rng = np.random.default_rng(0)
+    assert _balanced_quotas(np.array([2, 50, 50]), 30, rng).tolist() == [2, 14, 14]
+    assert _balanced_quotas(np.array([2, 3]), 30, rng).tolist() == [2, 3]
+    assert sorted(_balanced_quotas(np.array([9, 9, 9]), 2, rng).tolist()) == [0, 1, 1]
+
+
+def test_empty_sample_of_single_scene(patch_index):
+    """
+    Asking for no patches of a single scene index gives an empty selection
+    """
+    vendable, cloud_mask = make_scene(24, 24, seed=2)
+    patch_index.index_scene("scene", vendable, request_for(vendable), cloud_mask)
+    for by in ("scene", "cloud_fraction"):
+        assert len(patch_index.sample_balanced(0, by=by)) == 0
@@ -0,0 +1,157 @@
+"""
+Tests packing patches into shards and reading them back
+"""
+
+import os
+
+import pytest
+import numpy as np
+
+from app.models.dataset.vendables import VendableThermalDataset
+from app.models.patches.patching_request import PatchRequest
+from app.utils.patch_generation.generate_patch_plan import PatchPlanGenerator
+from app.utils.patch_generation.patch_shards import (
+    PatchShardReader,
+    PatchShardWriter,
+    shard_record_dtype,
+)
+
+
+def make_scene(height: int, width: int, seed: int, packed: bool = False):
+    """
+    A vended three band scene and a plan of its mostly valid 6x5 patches
+    """
+    rng = np.random.default_rng(seed)
+    cube = rng.random((3, height, width)).astype(np.float32)
+    validity = (rng.random((3, height, width)) > 0.1).astype(np.int8)
+    vendable = VendableThermalDataset(
+        normalized_thermal_cube=cube, validity_cube=validity
+    )
+    if packed:
+        vendable = vendable.pack_validity()
+    request = PatchRequest(
+        input_cube=cube, width=6, height=5, stride=3, min_valid_fraction=0.5
+    )
+    plan = PatchPlanGenerator().generate_patching_plan(cube, request, validity=validity)
+    return vendable, plan, validity
+
+
+@pytest.fixture
+def scenes():
+    return {
+        "scene_a": make_scene(31, 40, seed=0),
+        "scene_b": make_scene(22, 25, seed=1, packed=True),
+    }
+
+
+def write_shards(directory: str, scenes, **kwargs) -> PatchShardWriter:
+    with PatchShardWriter(directory, **kwargs) as writer:
+        for scene_id, (vendable, plan, _) in scenes.items():
+            assert writer.add_scene(scene_id, plan, vendable) == plan.patch_count
+    return writer
+
+
+def expected_patch(scenes, scene_id: str, row: int, col: int):
+    vendable, _, validity = scenes[scene_id]
+    window = np.s_[:, row : row + 5, col : col + 6]
+    return vendable.normalized_thermal_cube[window], validity[window]
+
+
+def test_shard_round_trip(tmp_path, scenes):
+    """
+    Every patch is read back from its shard with its validity, packed or not
+    """
+    record_size = shard_record_dtype((3, 5, 6), np.float32).itemsize
+    writer = write_shards(str(tmp_path), scenes, shard_size_bytes=10 * record_size)
+    reader = PatchShardReader(str(tmp_path))
+
+    total = sum(plan.patch_count for _, plan, _ in scenes.values())
+    assert len(reader) == len(writer) == total
+    assert reader.shard_count == -(-total // 10)
+    assert all(count == 10 for count in reader.shard_counts[:-1])
+    for shard_file, count in zip(reader.shard_files, reader.shard_counts):
+        assert os.path.getsize(shard_file) == count * record_size
+
+    for index in range(len(reader)):
+        data, validity = reader.patch(index)
+        expected_data, expected_validity = expected_patch(scenes, *reader.locate(index))
+        assert np.array_equal(data, expected_data)
+        assert np.array_equal(validity, expected_validity)
+    assert [reader.locate(index)[0] for index in (0, len(reader) - 1)] == [
+        "scene_a",
+        "scene_b",
+    ]
+
+
+def test_streamed_batches(tmp_path, scenes):
+    """
+    Streaming serves every patch once, shard by shard, in write or shuffled shard order
+    """
+    record_size = shard_record_dtype((3, 5, 6), np.float32).itemsize
+    write_shards(
+        str(tmp_path), scenes, shard_size_bytes=25 * record_size, write_batch_size=7
+    )
+    reader = PatchShardReader(str(tmp_path))
+
+    served = []
+    for indices, data, validity in reader.iter_batches(8):
+        assert data.shape == validity.shape == (len(indices), 3, 5, 6)
+        for index, patch, patch_validity in zip(indices, data, validity):
+            expected_data, expected_validity = expected_patch(
+                scenes, *reader.locate(index)
+            )
+            assert np.array_equal(patch, expected_data)
+            assert np.array_equal(patch_validity, expected_validity)
+        served.extend(indices.tolist())
+    assert served == list(range(len(reader)))
+
+    shuffled = [
+        indices.tolist()
+        for indices, _, _ in reader.iter_batches(25, shuffle_shards=True, random_seed=3)
+    ]
+    assert sorted(sum(shuffled, [])) == served
+    assert shuffled != [served[i : i + 25] for i in range(0, len(served), 25)]
+
+    with pytest.raises(ValueError):
+        next(reader.iter_batches(0))
+
+
+def test_mismatched_scenes(tmp_path, scenes):
+    """
+    Patches of another shape or a validity of another scene cannot be written
+    """
+    vendable, plan, _ = scenes["scene_a"]
+    other_vendable, other_plan, _ = scenes["scene_b"]
+    cube = vendable.normalized_thermal_cube
+    with PatchShardWriter(str(tmp_path)) as writer:
+        writer.add_scene("scene_a", plan, vendable)
+        with pytest.raises(ValueError):
+            writer.add_scene("scene_b", plan, other_vendable)
+        larger = PatchPlanGenerator().generate_patching_plan(
+            cube, PatchRequest(input_cube=cube, width=8, height=8, stride=8)
+        )
+        with pytest.raises(ValueError):
+            writer.add_scene("scene_a", larger, vendable)
+    with pytest.raises(ValueError):
+        writer.add_scene("scene_b", other_plan, other_vendable)
+
+
+def test_stream_benchmark(benchmark, tmp_path):
+    """
+    Benchmarks streaming a shard set of 4096 32x32 patches of 8 bands in batches of 256
+    """
+    cube = np.random.default_rng(4).random((8, 536, 536)).astype(np.float32)
+    vendable = VendableThermalDataset(
+        normalized_thermal_cube=cube, validity_cube=np.ones(cube.shape, dtype=np.int8)
+    )
+    plan = PatchPlanGenerator().generate_patching_plan(
+        cube, PatchRequest(input_cube=cube, width=32, height=32, stride=8)
+    )
+    with PatchShardWriter(str(tmp_path), shard_size_bytes=16 * 1024 * 1024) as writer:
+        writer.add_scene("scene", plan, vendable)
+    reader = PatchShardReader(str(tmp_path))
+
+    def stream() -> int:
+        return sum(len(indices) for indices, _, _ in reader.iter_batches(256))
+
+    assert benchmark(stream) == plan.patch_count == 4096
@@ -41,4 +41,5 @@ def test_lc09_parsing(helper):
     assert parsed_data.get("platform") == "landsat-9"
     assert parsed_data.get("processing:level") == "L2SP"
     assert parsed_data.get("product_type") == "ST"
+    assert parsed_data.get("part_row") == "141045"
     assert parsed_data.get("datetime") == datetime.strptime("20250604", "%Y%m%d")